@@ -0,0 +1,483 @@
+from __future__ import absolute_import
+
+import os
+import copy
+import json
+import time
+import uuid
+import shutil
+import tempfile
+import numpy as np
+import numpy.random as npr
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import NLModels as nlm
+import CorpusUtils as cu
+from HalfStorage import HalfTable, wrap_half_data, store_tables
+
+############################
+# BINARY MODEL CHECKPOINTS #
+############################
+
+# A checkpoint is a directory with one .npy file per array and a JSON
+# manifest. The arrays are each layer's params, optionally its adagrad moms,
+# and the row logs of its lazy l2 decay (see HelperFuncs.LazyDecay). The
+# manifest has the model type and config (see the get_config() method of the
+# models in NLModels), each array's file, shape, dtype and storage type, the
+# decay totals, and optionally the vocab (a list of words, by key). Grads are
+# not saved. Tables kept in half precision (see HalfStorage) are saved as
+# stored, i.e. as float16, or as bfloat16 bits in uint16 arrays.
+#
+# Pending l2 decay is saved as is, rather than being applied first, so that
+# a decay doesn't make every row count as changed. A loaded model applies it
+# lazily, as usual. Save with flush=True to apply it first, e.g. to get a
+# checkpoint whose params can be read directly.
+#
+# Each layer's unsaved_rows tracker holds the rows changed since the last
+# save (by updates, decay, clipping or reset_moms()). If the directory holds
+# the checkpoint that the model last saved or loaded, and nothing else about
+# the layout has changed, a save just rewrites those rows in place, in each
+# array file. Otherwise, it writes all files anew. The manifest is marked as
+# incomplete while files are being written, so an interrupted save can't be
+# loaded by mistake.
+#
+# load_checkpoint() can map the arrays with np.memmap, instead of reading
+# them. With mmap_mode='r', the params are read-only, which suits serving
+# lookups straight from the tables (e.g. nearest words), but the kernels
+# need writeable tables. With mmap_mode='c', the maps are copy-on-write, so
+# pages are shared with the page cache until something writes to them, and
+# nothing is ever written back to the files.
+
+CHECKPOINT_FORMAT = 'nlp-checkpoint'
+CHECKPOINT_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+MODEL_CLASSES = {'PVModel': nlm.PVModel, 'CAModel': nlm.CAModel, \
+                 'W2VModel': nlm.W2VModel}
+MODEL_LAYERS = {'PVModel': ('word_layer', 'context_layer', 'class_layer'), \
+                'CAModel': ('word_layer', 'context_layer', 'class_layer'), \
+                'W2VModel': ('w2v_layer',)}
+
+def _array_file(layer_name, group, name):
+    return "{0:s}.{1:s}.{2:s}.npy".format(layer_name, group, name)
+
+def _decay_items(layer):
+    """Get (name, LazyDecay) for each of a layer's decay trackers."""
+    if isinstance(layer.decay, dict):
+        return sorted(layer.decay.items())
+    return [('all', layer.decay)]
+
+def _layer_arrays(layer_name, layer, moms):
+    """Get (group, name, file, array, storage) for each array to save."""
+    arrays = []
+    groups = ['params', 'moms'] if moms else ['params']
+    for group in groups:
+        tables = getattr(layer, group)
+        for name in sorted(tables.keys()):
+            T = tables[name]
+            if isinstance(T, HalfTable):
+                A, storage = T.data, T.storage
+            else:
+                A, storage = np.asarray(T), 'float32'
+            arrays.append((group, name, _array_file(layer_name, group, name), \
+                           A, storage))
+    for (name, decay) in _decay_items(layer):
+        arrays.append(('decay', name, _array_file(layer_name, 'decay', name), \
+                       decay.row_logs, 'float64'))
+    return arrays
+
+def _layer_info(layer, arrays):
+    """Get the manifest entry for a layer, given its arrays."""
+    info = {'class': layer.__class__.__name__, 'storage': layer.storage, \
+            'stochastic': layer.stochastic, 'arrays': [], 'decay': {}}
+    for (group, name, f_name, A, storage) in arrays:
+        info['arrays'].append({'group': group, 'name': name, 'file': f_name, \
+                'shape': list(A.shape), 'dtype': A.dtype.name, \
+                'storage': storage})
+    for (name, decay) in _decay_items(layer):
+        info['decay'][name] = decay.log_scale
+    return info
+
+def read_manifest(path):
+    """Read the manifest of the checkpoint in directory path."""
+    with open(os.path.join(path, MANIFEST_NAME), 'r') as f:
+        manifest = json.load(f)
+    return manifest
+
+def _write_manifest(path, manifest):
+    # write to a temp file first, so the manifest is never left truncated
+    f_name = os.path.join(path, MANIFEST_NAME)
+    tmp_name = "{0:s}.{1:d}.tmp".format(f_name, os.getpid())
+    with open(tmp_name, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(tmp_name, f_name)
+    return
+
+def _write_array(path, f_name, A):
+    f_name = os.path.join(path, f_name)
+    tmp_name = "{0:s}.{1:d}.tmp".format(f_name, os.getpid())
+    with open(tmp_name, 'wb') as f:
+        np.save(f, A)
+    os.rename(tmp_name, f_name)
+    return
+
+def _write_rows(path, f_name, A, rows):
+    """Rewrite the given rows of an array file, in place."""
+    M = np.load(os.path.join(path, f_name), mmap_mode='r+')
+    M[rows] = A[rows]
+    M.flush()
+    del M
+    return
+
+def _can_update(old, manifest, model):
+    """Check if the checkpoint old can be brought up to date in place."""
+    if (old is None) or (not old['complete']) or \
+       (old['save_id'] != model.checkpoint_id) or \
+       (old['model'] != manifest['model']) or \
+       (old['moms'] != manifest['moms']):
+        return False
+    for layer_name in manifest['layers']:
+        old_arrays = old['layers'][layer_name]['arrays']
+        new_arrays = manifest['layers'][layer_name]['arrays']
+        if old_arrays != new_arrays:
+            return False
+    return True
+
+def save_checkpoint(model, path, moms=False, vocab=None, incremental=True, \
+                    flush=False):
+    """Save model (a PVModel, CAModel or W2VModel) to the directory path.
+
+    Parameters:
+        model: the model to save
+        path: directory for the checkpoint (created if needed)
+        moms: whether to save the adagrad moms, e.g. to resume training
+        vocab: list of words by key, or a dict from keys to words (e.g. the
+               keys_to_words from CorpusUtils.build_vocab()), or None
+        incremental: if possible, just rewrite rows changed since the last
+                     save (see above)
+        flush: apply any pending l2 decay before saving
+    Returns the manifest, with the number of rows written per layer in
+    manifest['rows_written'] (None for a full write).
+    """
+    model_name = model.__class__.__name__
+    assert (model_name in MODEL_LAYERS), \
+            "can't checkpoint a {0:s}".format(model_name)
+    if flush:
+        model.flush_decay()
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    old = None
+    if os.path.exists(os.path.join(path, MANIFEST_NAME)):
+        old = read_manifest(path)
+    layers = [(name, getattr(model, name)) for name in MODEL_LAYERS[model_name]]
+    layer_arrays = {}
+    manifest = {'format': CHECKPOINT_FORMAT, 'version': CHECKPOINT_VERSION, \
+                'model': model_name, 'config': model.get_config(), \
+                'moms': moms, 'layers': {}, 'complete': False}
+    for (layer_name, layer) in layers:
+        layer_arrays[layer_name] = _layer_arrays(layer_name, layer, moms)
+        manifest['layers'][layer_name] = _layer_info(layer, \
+                layer_arrays[layer_name])
+    if isinstance(vocab, dict):
+        vocab = [vocab[k] for k in range(len(vocab))]
+    update = incremental and _can_update(old, manifest, model)
+    if update:
+        manifest['save_id'] = old['save_id']
+        manifest['step'] = old['step'] + 1
+        manifest['vocab'] = old['vocab'] if (vocab is None) else vocab
+    else:
+        manifest['save_id'] = uuid.uuid4().hex
+        manifest['step'] = 0
+        manifest['vocab'] = vocab
+    # mark the directory as mid-save, then write the arrays
+    if old is not None:
+        old['complete'] = False
+        _write_manifest(path, old)
+    rows_written = {}
+    for (layer_name, layer) in layers:
+        rows = layer.unsaved_rows.rows()
+        for (group, name, f_name, A, storage) in layer_arrays[layer_name]:
+            if update:
+                _write_rows(path, f_name, A, rows)
+            else:
+                _write_array(path, f_name, A)
+        rows_written[layer_name] = int(rows.size) if update else None
+        layer.unsaved_rows.clear()
+    manifest['complete'] = True
+    _write_manifest(path, manifest)
+    model.checkpoint_id = manifest['save_id']
+    manifest['rows_written'] = rows_written
+    return manifest
+
+def _load_array(path, entry, mmap_mode, stochastic):
+    A = np.load(os.path.join(path, entry['file']), mmap_mode=mmap_mode)
+    assert (list(A.shape) == entry['shape']), \
+            "{0:s} doesn't match the manifest".format(entry['file'])
+    if entry['storage'] in ('float16', 'bfloat16'):
+        return wrap_half_data(A, entry['storage'], stochastic)
+    return A
+
+def _build_model(model_name, config):
+    """Make a model from its config, with its params set to 0.
+
+    Random init takes a while for big tables, and is wasted on params that
+    get loaded, while zeros cost nothing until written.
+    """
+    model = MODEL_CLASSES[model_name](rand_init=False, **config['args'])
+    for (name, value) in config['attrs'].items():
+        setattr(model, name, value)
+    if 'drop_rate' in config['attrs']:
+        model.set_noise(config['attrs']['drop_rate'], \
+                        config['attrs']['fuzz_scale'])
+    return model
+
+def load_checkpoint(path, mmap_mode=None, moms=True):
+    """Load the model saved in the directory path by save_checkpoint().
+
+    Parameters:
+        path: directory holding the checkpoint
+        mmap_mode: None to read the params (and moms) into memory, or 'r'
+                   or 'c' to map them with np.memmap (see above)
+        moms: whether to load the adagrad moms, if they were saved
+    Returns [model, manifest]. The vocab, if saved, is manifest['vocab'].
+    """
+    manifest = read_manifest(path)
+    assert (manifest['format'] == CHECKPOINT_FORMAT), \
+            "{0:s} isn't a model checkpoint".format(path)
+    assert (manifest['version'] <= CHECKPOINT_VERSION), \
+            "checkpoint version {0:d} is newer than this code".format( \
+            manifest['version'])
+    assert manifest['complete'], "checkpoint {0:s} is incomplete".format(path)
+    model = _build_model(manifest['model'], manifest['config'])
+    for layer_name in MODEL_LAYERS[manifest['model']]:
+        layer = getattr(model, layer_name)
+        info = manifest['layers'][layer_name]
+        layer.storage = info['storage']
+        layer.stochastic = info['stochastic']
+        decay = dict(_decay_items(layer))
+        for entry in info['arrays']:
+            if entry['group'] == 'decay':
+                row_logs = np.load(os.path.join(path, entry['file']))
+                decay[entry['name']].row_logs[:] = row_logs
+                decay[entry['name']].log_scale = info['decay'][entry['name']]
+                assert ((mmap_mode != 'r') or \
+                        np.all(row_logs == info['decay'][entry['name']])), \
+                        "pending l2 decay needs writeable params; save " \
+                        "with flush=True, or load with mmap_mode='c'"
+            elif (entry['group'] == 'params') or moms:
+                tables = getattr(layer, entry['group'])
+                tables[entry['name']] = _load_array(path, entry, mmap_mode, \
+                                                    info['stochastic'])
+        # moms that weren't loaded still need the layer's storage type
+        store_tables(layer.moms, layer.storage, layer.stochastic)
+        layer._reset_clippers()
+        layer.unsaved_rows.clear()
+    model.checkpoint_id = manifest['save_id']
+    return [model, manifest]
+
+##############################
+# CHECKS AND TIMING OF SAVES #
+##############################
+
+def _train_w2v(model, rs, batch_count, batch_size, neg_count, hot_words):
+    """Train a W2VModel for a few batches, on keys < hot_words."""
+    for b in range(batch_count):
+        anc_keys = rs.randint(0, hot_words, size=(batch_size,))
+        pos_keys = rs.randint(0, hot_words, size=(batch_size,))
+        neg_keys = rs.randint(0, hot_words, size=(batch_size, neg_count))
+        model.batch_update(anc_keys.astype(np.uint32), \
+                pos_keys.astype(np.uint32), neg_keys.astype(np.uint32), \
+                learn_rate=1e-2)
+        if (b % 5) == 4:
+            model.w2v_layer.l2_regularize(1e-3)
+    return
+
+def _flushed_params(model):
+    """Get copies of all params in model, with pending decay applied."""
+    model.flush_decay()
+    params = []
+    for layer_name in MODEL_LAYERS[model.__class__.__name__]:
+        layer = getattr(model, layer_name)
+        for name in sorted(layer.params.keys()):
+            params.append(np.array(np.asarray(layer.params[name])))
+    return params
+
+def _dir_arrays(path):
+    """Read all arrays in a checkpoint directory, by file name."""
+    manifest = read_manifest(path)
+    arrays = {}
+    for layer_name in manifest['layers']:
+        for entry in manifest['layers'][layer_name]['arrays']:
+            arrays[entry['file']] = np.load(os.path.join(path, entry['file']))
+    return arrays
+
+def _train_context_model(model, sampler, var_param, batch_count, \
+                         batch_size):
+    """Train a CAModel/PVModel for a few batches, with lazy l2 decay."""
+    for b in range(batch_count):
+        batch = model.sample_batch(sampler, var_param, batch_size)
+        if isinstance(model, nlm.PVModel):
+            model.batch_update(*batch[0:4], learn_rate=1e-2, \
+                               post_code_offsets=batch[4])
+        else:
+            model.batch_update(*batch[0:4], learn_rate=1e-2, \
+                               code_offsets=batch[4])
+        if (b % 5) == 4:
+            model.word_layer.l2_regularize(1e-3)
+            model.class_layer.l2_regularize(1e-3)
+            model.context_layer.l2_regularize(1e-3, 1e-3)
+    return
+
+def _check_saves(model, train, vocab=None):
+    """Check that incremental saves of model match full saves, and that
+    loads work.
+
+    Does an incremental save (to one directory) after each of a few calls
+    to train(), and checks that it holds the same arrays as a full save of
+    a copy of the model (to another). Then checks that the model loaded in
+    each mmap mode has the same config and params.
+    """
+    inc_dir = tempfile.mkdtemp()
+    full_dir = tempfile.mkdtemp()
+    model_name = model.__class__.__name__
+    try:
+        save_checkpoint(model, inc_dir, moms=True, vocab=vocab)
+        for i in range(3):
+            train()
+            man = save_checkpoint(model, inc_dir, moms=True)
+            save_checkpoint(copy.deepcopy(model), full_dir, moms=True, \
+                            vocab=vocab, incremental=False)
+            rows = man['rows_written']
+            print("{0:s} save {1:d}: rewrote rows {2:s}".format(model_name, \
+                  man['step'], ", ".join(["{0:s}: {1:d}/{2:d}".format( \
+                  name, rows[name], getattr(model, name).unsaved_rows.flags.size) \
+                  for name in sorted(rows)])))
+            assert all([(rows[name] is not None) for name in rows])
+            A_inc = _dir_arrays(inc_dir)
+            A_full = _dir_arrays(full_dir)
+            assert (sorted(A_inc.keys()) == sorted(A_full.keys()))
+            for f_name in A_full:
+                assert np.array_equal(A_inc[f_name], A_full[f_name]), \
+                        "incremental save of {0:s} doesn't match".format(f_name)
+        P = _flushed_params(model)
+        for mmap_mode in [None, 'c']:
+            loaded, manifest = load_checkpoint(inc_dir, mmap_mode=mmap_mode)
+            assert (manifest['vocab'] == vocab)
+            assert (loaded.get_config() == model.get_config())
+            for (P1, P2) in zip(P, _flushed_params(loaded)):
+                assert np.allclose(P1, P2, rtol=1e-6, atol=1e-7), \
+                        "params loaded with mmap_mode={0:s} don't match".format( \
+                        str(mmap_mode))
+        # a flushed checkpoint can be mapped read-only
+        save_checkpoint(model, inc_dir, flush=True)
+        loaded, manifest = load_checkpoint(inc_dir, mmap_mode='r')
+        for (P1, P2) in zip(P, _flushed_params(loaded)):
+            assert np.array_equal(P1, P2)
+    finally:
+        shutil.rmtree(inc_dir)
+        shutil.rmtree(full_dir)
+    return
+
+def check_checkpoints(word_count=5000, dim=32, storage='float32', \
+                      phrase_count=500):
+    """Check saves and loads (see _check_saves()) for each type of model.
+
+    Covers a W2VModel, a CAModel with negative sampling and one with HSM,
+    and a PVModel, trained on random keys/phrases between saves.
+    """
+    rs = npr.RandomState(1)
+    model = nlm.W2VModel(dim, (word_count - 1))
+    model.init_params(0.05)
+    model.set_storage(storage)
+    model.reset_moms(1.0)
+    vocab = ["w{0:d}".format(k) for k in range(word_count)]
+    def train_w2v():
+        _train_w2v(model, rs, 20, 100, 5, (word_count // 4))
+        model.w2v_layer.clip_params(0.5)
+        return
+    _check_saves(model, train_w2v, vocab=vocab)
+    # models with context layers train on random phrases
+    phrases = [rs.randint(0, word_count, size=(rs.randint(5, 30),)).astype( \
+               np.uint32) for i in range(phrase_count)]
+    sampler = cu.PhraseSampler(phrases, 5, max_phrase_key=phrase_count, \
+                               seed=1)
+    neg_sampler = cu.NegSampler(neg_table=np.arange(word_count, \
+                                dtype=np.uint32), neg_count=5)
+    w2v = dict([(w, cu.Vocab(count=int(rs.randint(1, 1000)), index=k)) \
+                for (k, w) in enumerate(vocab)])
+    hs_tree = cu._create_binary_tree(w2v)
+    max_hs_key = hs_tree['max_code_key']
+    cam_ns = nlm.CAModel(dim, 10, (word_count - 1), phrase_count, use_ns=True)
+    cam_hs = nlm.CAModel(dim, 10, (word_count - 1), phrase_count, \
+                         use_ns=False, max_hs_key=max_hs_key)
+    cam_hs.use_tanh = False
+    pvm = nlm.PVModel(dim, 10, (word_count - 1), phrase_count, max_hs_key, \
+                      pre_words=3)
+    for (model, var_param) in [(cam_ns, neg_sampler), (cam_hs, hs_tree), \
+                               (pvm, hs_tree)]:
+        model.init_params(0.05)
+        model.set_storage(storage)
+        model.reset_moms(1.0)
+        model.set_noise(drop_rate=0.25)
+        train = lambda: _train_context_model(model, sampler, var_param, \
+                                             20, 100)
+        _check_saves(model, train, vocab=vocab)
+    print("checkpoints OK (storage: {0:s})".format(storage))
+    return
+
+def run_checkpoint_bench(word_count=500000, dim=128, batch_count=20, \
+                         batch_size=500, neg_count=8):
+    """Time saving/loading a W2VModel by pickling vs. with checkpoints.
+
+    The incremental save follows batch_count more batches of training.
+    """
+    rs = npr.RandomState(1)
+    model = nlm.W2VModel(dim, (word_count - 1))
+    model.init_params(0.05)
+    model.reset_moms(1.0)
+    tmp_dir = tempfile.mkdtemp()
+    pkl_name = os.path.join(tmp_dir, 'model.pkl')
+    ckpt_dir = os.path.join(tmp_dir, 'ckpt')
+    times = {}
+    try:
+        t0 = time.time()
+        with open(pkl_name, 'wb') as f:
+            pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+        times['pickle save'] = time.time() - t0
+        t0 = time.time()
+        with open(pkl_name, 'rb') as f:
+            pickle.load(f)
+        times['pickle load'] = time.time() - t0
+        t0 = time.time()
+        save_checkpoint(model, ckpt_dir)
+        times['full save'] = time.time() - t0
+        _train_w2v(model, rs, batch_count, batch_size, neg_count, word_count)
+        t0 = time.time()
+        manifest = save_checkpoint(model, ckpt_dir)
+        times['incremental save'] = time.time() - t0
+        t0 = time.time()
+        load_checkpoint(ckpt_dir)
+        times['load'] = time.time() - t0
+        t0 = time.time()
+        load_checkpoint(ckpt_dir, mmap_mode='c')
+        times['mmap load'] = time.time() - t0
+        pkl_mb = os.path.getsize(pkl_name) / 1e6
+        ckpt_mb = sum(os.path.getsize(os.path.join(ckpt_dir, f_name)) for \
+                      f_name in os.listdir(ckpt_dir)) / 1e6
+    finally:
+        shutil.rmtree(tmp_dir)
+    print("vocab: {0:d}, dim: {1:d}, pickle: {2:.1f}MB, checkpoint: {3:.1f}MB".format( \
+          word_count, dim, pkl_mb, ckpt_mb))
+    print("-- incremental save rewrote {0:d} rows".format( \
+          manifest['rows_written']['w2v_layer']))
+    for name in ['pickle save', 'pickle load', 'full save', \
+                 'incremental save', 'load', 'mmap load']:
+        print("-- {0:s}: {1:.3f}s".format(name, times[name]))
+    return times
+
+if __name__ == '__main__':
+    check_checkpoints(storage='float32')
+    check_checkpoints(storage='bfloat16')
+    run_checkpoint_bench()
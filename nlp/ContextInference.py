@@ -0,0 +1,515 @@
+from __future__ import absolute_import
+
+import time
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+import numpy as np
+import numpy.random as npr
+import numba
+
+import NLMLayers as nlml
+import NLModels as nlm
+import CorpusUtils as cu
+from CorpusUtils import fast_rand
+from HelperFuncs import zeros, ones
+from KernelPool import POOL, get_thread_num
+from KernelBackends import hsm_ff_bp
+from PackedGrads import PackedGrads, run_packed_kernel
+
+####################################
+# BATCHED CONTEXT VECTOR INFERENCE #
+####################################
+
+# The models' infer_context_vectors() methods train a new context layer for
+# a set of phrases by running batch_update() with train_lut/train_cls off,
+# one batch at a time, for a fixed number of batches. A ContextInferencer
+# does the same job for many documents at once:
+#   -- The model is frozen. Its word and class params are only read, so one
+#      model can serve any number of inferencers (and threads).
+#   -- Each call to infer() gets a private CMLayer with a row per document,
+#      and splits the documents into blocks of block_docs rows. Each thread
+#      on the KernelPool takes blocks from a shared queue, and trains each
+#      block with a CMLayer whose params/moms are views of the block's rows.
+#      The class layer grads (which are dropped, but which the kernels have
+#      to write, as they give dLdX) go into a per-thread PackedGrads store.
+#   -- Each block gets its own seed when infer() is called, and all of its
+#      random draws (initial vectors, samples, negatives and noise) come
+#      from RNGs seeded with it. So a block's results don't depend on which
+#      thread trains it, and with a fixed seed, infer() gives the same
+#      results for any number of threads.
+#   -- Each step draws samples_per_doc samples from every document in the
+#      block that is still training, so all documents get the same number
+#      of updates, and the loss for each document can be tracked. A running
+#      mean of each document's loss is checked every check_freq steps (after
+#      min_steps), and a document stops training once the loss fell by less
+#      than a fraction tol since the last check, or after max_steps steps.
+# With the kernels run unsplit inside each thread (see KernelPool), the
+# number of threads used is set via KernelPool.set_thread_num().
+
+@numba.jit("void(u4[:], i8[:], u4[:], i8, i8, u4[:], u4[:], u4[:], u8[:], i8)", \
+           nopython=True, nogil=True, cache=True)
+def fast_doc_pairs(tokens, offsets, docs, per_doc, max_window, anc_keys, \
+                   pos_keys, doc_keys, rng_state, s):
+    """
+    Fill anc_keys/pos_keys/doc_keys with per_doc skip-gram pairs for each of
+    the documents in docs, as in CorpusUtils.fast_pair_batch() (but without
+    subsampling). Document d holds tokens offsets[d]:offsets[d+1], and the
+    pairs for docs[i] go in entries i*per_doc:(i+1)*per_doc.
+    """
+    j = 0
+    for i in range(docs.shape[0]):
+        d_start = offsets[docs[i]]
+        doc_len = offsets[docs[i]+1] - d_start
+        for r in range(per_doc):
+            a_idx = fast_rand(rng_state, s) % doc_len
+            red_win = (fast_rand(rng_state, s) % max_window) + 1
+            c_min = a_idx - red_win
+            if (c_min < 0):
+                c_min = 0
+            c_max = a_idx + red_win
+            if (c_max >= doc_len):
+                c_max = doc_len - 1
+            # draw uniformly from the (reduced) window, skipping the anchor
+            c_span = c_max - c_min + 1
+            c_idx = a_idx
+            if (c_span > 1):
+                c_idx = c_min + (fast_rand(rng_state, s) % (c_span - 1))
+                if (c_idx >= a_idx):
+                    c_idx += 1
+            anc_keys[j] = tokens[d_start+a_idx]
+            pos_keys[j] = tokens[d_start+c_idx]
+            doc_keys[j] = docs[i]
+            j += 1
+    return
+
+@numba.jit("void(u4[:], i8[:], u4[:], i8, i8, i8, u4[:,:], u4[:], u8[:], i8)", \
+           nopython=True, nogil=True, cache=True)
+def fast_doc_ngrams(tokens, offsets, docs, per_doc, gram_n, pad_key, key_seqs, \
+                    doc_keys, rng_state, s):
+    """
+    Fill rows of key_seqs/doc_keys with per_doc n-grams for each of the
+    documents in docs, as in CorpusUtils.fast_seq_batch() (but without
+    subsampling), laid out as in fast_doc_pairs().
+    """
+    j = 0
+    for i in range(docs.shape[0]):
+        d_start = offsets[docs[i]]
+        doc_len = offsets[docs[i]+1] - d_start
+        for r in range(per_doc):
+            stop_idx = doc_len - 1
+            if (doc_len > 1):
+                stop_idx = (fast_rand(rng_state, s) % (doc_len - 1)) + 1
+            start_idx = stop_idx - gram_n + 1
+            for cur_pos in range(gram_n):
+                if ((start_idx + cur_pos) < 0):
+                    key_seqs[j,cur_pos] = pad_key
+                else:
+                    key_seqs[j,cur_pos] = tokens[d_start+start_idx+cur_pos]
+            doc_keys[j] = docs[i]
+            j += 1
+    return
+
+class ContextInferencer:
+    """
+    Infer context vectors for new documents with a frozen CAModel/PVModel.
+
+    Parameters:
+        model: a trained CAModel or PVModel (left unchanged)
+        var_param: for a CAModel using negative sampling, a NegSampler, and
+                   otherwise the dict of HSM codes from build_vocab()
+        max_window: skip-gram window for sampling pairs (CAModel only)
+        samples_per_doc: samples per training document, per step
+        block_docs: number of documents that a thread trains together
+        learn_rate: learning rate for the adagrad updates
+        min_steps/max_steps: bounds on the steps for each document
+        check_freq: steps between checks for convergence
+        tol: relative loss decrease between checks, below which a document
+             stops training
+        seed: seed for the block RNGs, which makes infer() reproducible
+              for any number of threads (None for a random seed)
+
+    Calls to infer() return a new CMLayer holding the vectors for the given
+    documents, as infer_context_vectors() does, plus some stats.
+    """
+    def __init__(self, model, var_param, max_window=5, samples_per_doc=16, \
+                 block_docs=256, learn_rate=1e-2, min_steps=50, \
+                 max_steps=1000, check_freq=25, tol=1e-3, seed=None):
+        assert (isinstance(model, nlm.CAModel) or \
+                isinstance(model, nlm.PVModel)), \
+                "ContextInferencer needs a CAModel or PVModel."
+        self.model = model
+        self.is_pv = isinstance(model, nlm.PVModel)
+        self.use_ns = (not self.is_pv) and model.use_ns
+        self.var_param = var_param
+        self.max_window = max_window
+        self.samples_per_doc = samples_per_doc
+        self.block_docs = block_docs
+        self.learn_rate = learn_rate
+        self.min_steps = min_steps
+        self.max_steps = max_steps
+        self.check_freq = check_freq
+        self.tol = tol
+        self.rng_seed = seed
+        self.ema_decay = 0.9 # for the running mean of each document's loss
+        # pending decay would otherwise be applied (i.e. written) while the
+        # word/class rows are read, and by many threads at once
+        self.model.flush_decay()
+        return
+
+    def new_context_layer(self, doc_count):
+        """Make a context layer with a row per document, set up for training.
+        The Wb rows are initialized per block, from each block's RNG."""
+        do_rescale = not self.is_pv
+        ctx_layer = nlml.CMLayer(max_key=(doc_count - 1), \
+                                 source_dim=self.model.wv_dim, \
+                                 bias_dim=self.model.cv_dim, \
+                                 do_rescale=do_rescale)
+        ctx_layer.reset_moms(1.0)
+        return ctx_layer
+
+    def infer(self, docs, verbose=False):
+        """
+        Train context vectors for each of the given documents.
+
+        docs can be a FlatCorpus or a list of uint32 word key arrays. Returns
+        [ctx_layer, stats], where row i of ctx_layer's params is for docs[i],
+        and stats holds the docs/sec and the per-document steps, first and
+        final losses, and convergence flags (empty documents are skipped).
+        """
+        t0 = time.time()
+        corpus = cu.flatten_phrases(docs)
+        doc_count = len(corpus)
+        ctx_layer = self.new_context_layer(doc_count)
+        results = {'steps': np.zeros((doc_count,), dtype=np.int64), \
+                   'first_loss': np.zeros((doc_count,), dtype=np.float64), \
+                   'loss': np.zeros((doc_count,), dtype=np.float64), \
+                   'converged': np.zeros((doc_count,), dtype=np.bool_)}
+        starts = list(range(0, doc_count, self.block_docs))
+        rs = npr if self.rng_seed is None else npr.RandomState(self.rng_seed)
+        block_seeds = rs.randint(0, high=(2**31), size=(len(starts),))
+        blocks = Queue()
+        for (start, block_seed) in zip(starts, block_seeds):
+            blocks.put((start, min((start + self.block_docs), doc_count), \
+                        int(block_seed)))
+        thread_num = max(1, min(get_thread_num(), blocks.qsize()))
+        sample_counts = [0 for s in range(thread_num)]
+        POOL.run(self._run_blocks, [(corpus, ctx_layer, blocks, results, s, \
+                 sample_counts) for s in range(thread_num)])
+        # rows were changed via views, so the layer's trackers didn't see it
+        ctx_layer._reset_clippers()
+        ctx_layer.unsaved_rows.mark_all()
+        secs = time.time() - t0
+        stats = {'doc_count': doc_count, 'secs': secs, \
+                 'docs_per_sec': (doc_count / max(secs, 1e-6)), \
+                 'sample_count': sum(sample_counts), \
+                 'thread_num': thread_num}
+        stats.update(results)
+        if verbose:
+            print("-- inferred {0:d} docs in {1:.2f}s ({2:.1f} docs/s), mean steps {3:.1f}, converged {4:.1%}".format( \
+                  doc_count, secs, stats['docs_per_sec'], \
+                  np.mean(results['steps']), np.mean(results['converged'])))
+        return [ctx_layer, stats]
+
+    def _run_blocks(self, corpus, ctx_layer, blocks, results, s, \
+                    sample_counts):
+        """Train blocks from the queue until it's empty (in one thread)."""
+        model = self.model
+        in_dim = model.class_layer.dim_input
+        worker = {'store': PackedGrads(model.class_layer.key_count, \
+                                       [('W', (in_dim,)), ('b', ())]), \
+                  'noise': nlml.NoiseLayer(drop_rate=model.drop_rate, \
+                                           fuzz_scale=model.fuzz_scale), \
+                  'tanh': nlml.TanhLayer()}
+        while True:
+            try:
+                start, stop, block_seed = blocks.get_nowait()
+            except Empty:
+                break
+            # (re)seed the RNGs for this block
+            worker['rng_state'] = cu.make_rng_state(1, seed=block_seed)
+            worker['rs'] = npr.RandomState(block_seed)
+            worker['noise'].rs = worker['rs']
+            sample_counts[s] += self._train_block(corpus, ctx_layer, start, \
+                                                  stop, results, worker)
+        return
+
+    def _block_layer(self, ctx_layer, start, stop):
+        """Make a CMLayer whose params and moms are rows start:stop of those
+        in ctx_layer (as views), so updates go straight to ctx_layer."""
+        layer = nlml.CMLayer(max_key=(stop - start - 1), \
+                             source_dim=ctx_layer.source_dim, \
+                             bias_dim=ctx_layer.bias_dim, \
+                             do_rescale=ctx_layer.do_rescale)
+        for name in ['Wm', 'Wb']:
+            layer.params[name] = ctx_layer.params[name][start:stop]
+            layer.moms[name] = ctx_layer.moms[name][start:stop]
+        return layer
+
+    def _train_block(self, corpus, ctx_layer, start, stop, results, worker):
+        """Train the documents in rows start:stop until each one converges
+        (or hits max_steps), and record their results. Returns the number
+        of samples used."""
+        model = self.model
+        layer = self._block_layer(ctx_layer, start, stop)
+        # init the vectors as CMLayer.init_params(0.02) would, but with the
+        # block's RNG
+        layer.params['Wb'][:] = 0.02 * worker['rs'].randn((stop - start), \
+                                                          layer.bias_dim)
+        offsets = corpus.offsets[start:(stop + 1)]
+        doc_lens = offsets[1:] - offsets[0:-1]
+        active = np.flatnonzero(doc_lens > 0).astype(np.uint32)
+        loss_ema = np.zeros((stop - start,), dtype=np.float64)
+        last_check = np.zeros((stop - start,), dtype=np.float64) + np.inf
+        steps = results['steps'][start:stop]
+        reg_rate = self.learn_rate * model.reg_freq
+        sample_count = 0
+        step = 0
+        while (active.size > 0) and (step < self.max_steps):
+            doc_keys, row_loss = self._train_step(layer, corpus.tokens, \
+                                                  offsets, active, worker)
+            sample_count += doc_keys.size
+            doc_loss = np.bincount(doc_keys, weights=row_loss, \
+                    minlength=(stop - start))[active] / self.samples_per_doc
+            if step == 0:
+                loss_ema[active] = doc_loss
+                results['first_loss'][start + active] = doc_loss
+            else:
+                loss_ema[active] = (self.ema_decay * loss_ema[active]) + \
+                        ((1.0 - self.ema_decay) * doc_loss)
+            step += 1
+            steps[active] = step
+            # apply l2 regularization, but not every step (to save flops)
+            if ((step % model.reg_freq) == 0):
+                layer.l2_regularize(lam_Wm=(reg_rate*model.lam_cv), \
+                                    lam_Wb=(reg_rate*model.lam_cv))
+            # drop documents whose loss has stopped going down
+            if (step >= self.min_steps) and ((step % self.check_freq) == 0):
+                prev = last_check[active]
+                done = (prev - loss_ema[active]) < (self.tol * prev)
+                last_check[active] = loss_ema[active]
+                results['converged'][start + active[done]] = True
+                active = active[~done]
+        layer.flush_decay()
+        results['loss'][start:stop] = loss_ema
+        return sample_count
+
+    def _train_step(self, layer, tokens, offsets, active, worker):
+        """Do one update of the context vectors for the active documents.
+
+        Returns [doc_keys, row_loss], i.e. the document and the loss for
+        each sample.
+        """
+        model = self.model
+        sample_count = active.size * self.samples_per_doc
+        doc_keys = np.zeros((sample_count,), dtype=np.uint32)
+        if self.is_pv:
+            key_seqs = np.zeros((sample_count, (model.pre_words + 1)), \
+                                dtype=np.uint32)
+            fast_doc_ngrams(tokens, offsets, active, self.samples_per_doc, \
+                            (model.pre_words + 1), model.max_wv_key, \
+                            key_seqs, doc_keys, worker['rng_state'], 0)
+            pre_keys = np.ascontiguousarray(key_seqs[:,0:-1])
+            pos_keys = np.ascontiguousarray(key_seqs[:,-1])
+            X = model.word_layer.params['W'].take(pre_keys.ravel(), axis=0)
+            X = X.reshape((sample_count, -1))
+        else:
+            anc_keys = np.zeros((sample_count,), dtype=np.uint32)
+            pos_keys = np.zeros((sample_count,), dtype=np.uint32)
+            fast_doc_pairs(tokens, offsets, active, self.samples_per_doc, \
+                           self.max_window, anc_keys, pos_keys, doc_keys, \
+                           worker['rng_state'], 0)
+            X = model.word_layer.params['W'].take(anc_keys, axis=0)
+        # Feedforward through the context, tanh and noise layers
+        Xc = layer.feedforward(X, doc_keys)
+        use_tanh = (not self.is_pv) and model.use_tanh
+        Xt = worker['tanh'].feedforward(Xc) if use_tanh else Xc
+        Xn = worker['noise'].feedforward(Xt)
+        # Turn the corner at the (frozen) class layer
+        dLdXn, row_loss = self._class_ff_bp(Xn, pos_keys, worker)
+        # Backprop to the context layer, and update it
+        dLdXt = worker['noise'].backprop(dLdXn)
+        dLdXc = worker['tanh'].backprop(dLdXt) if use_tanh else dLdXt
+        layer.backprop(dLdXc)
+        layer.apply_grad(learn_rate=self.learn_rate)
+        return [doc_keys, row_loss]
+
+    def _class_ff_bp(self, X, pos_keys, worker):
+        """Get dL/dX and the loss for each row of X, from the class layer.
+
+        The kernels write grads for the class params too, which go into
+        the worker's store and are then dropped, so the class layer is left
+        unchanged. Negative samples are drawn with the worker's RNG.
+        """
+        store = worker['store']
+        class_layer = self.model.class_layer
+        W = class_layer.params['W']
+        b = class_layer.params['b']
+        sample_count = X.shape[0]
+        dLdX = zeros(X.shape)
+        if self.use_ns:
+            neg_keys = self.var_param.sample(sample_count, rs=worker['rs'])
+            keys = np.hstack((pos_keys[:,np.newaxis], neg_keys))
+            signs = -1.0 * ones(keys.shape)
+            signs[:,0] = 1.0
+            L = zeros(keys.shape)
+            kernel_name = 'nsl_ff_bp'
+            kernel = nlml.NSL_FF_BP[class_layer.ff_bp_mode]
+            args = (keys, signs, X, W, b, dLdX, None, None, L, 1)
+        else:
+            code_offsets, keys, signs = \
+                    cu.fetch_hsm_codes(self.var_param, pos_keys)
+            L = zeros(keys.shape)
+            kernel_name, kernel = 'hsm_ff_bp', hsm_ff_bp
+            args = (X, code_offsets, keys, signs, W, b, dLdX, None, None, \
+                    L, 1)
+        run_packed_kernel(kernel_name, kernel, args, [store])
+        store.reset()
+        if self.use_ns:
+            row_loss = np.sum(L, axis=1)
+        else:
+            code_rows = np.repeat(np.arange(sample_count), \
+                                  (code_offsets[1:] - code_offsets[0:-1]))
+            row_loss = np.bincount(code_rows, weights=L, \
+                                   minlength=sample_count)
+        return [dLdX, row_loss]
+
+###########################
+# CHECKS AND BENCHMARKING #
+###########################
+
+def _random_docs(word_count, doc_count, min_len=10, max_len=60, seed=1):
+    """Make some random documents, as a list of uint32 key arrays."""
+    rs = npr.RandomState(seed)
+    return [rs.randint(0, word_count, size=(rs.randint(min_len, max_len),)).astype( \
+            np.uint32) for i in range(doc_count)]
+
+def _random_hs_tree(word_count, seed=1):
+    """Make HSM codes (in CSR form) for a random binary tree over the words,
+    as fetch_hsm_codes() expects."""
+    rs = npr.RandomState(seed)
+    w2v = {}
+    for k in range(word_count):
+        w2v[str(k)] = cu.Vocab(count=int(rs.randint(1, 1000)), index=k)
+    return cu._create_binary_tree(w2v)
+
+def _model_arrays(model):
+    """Get copies of the frozen (i.e. word and class) params of a model."""
+    arrays = {}
+    for (name, layer) in [('word', model.word_layer), \
+                          ('class', model.class_layer)]:
+        for (p_name, P) in layer.params.items():
+            arrays[name + '.' + p_name] = np.array(P)
+    return arrays
+
+def check_context_inference(word_count=2000, wv_dim=32, cv_dim=10, \
+                            doc_count=600, thread_num=4):
+    """Check ContextInferencer with a CAModel (with NS or HSM) and a PVModel.
+
+    Asserts that the word and class params are unchanged, that the losses
+    go down, that every document gets finite vectors, and that 1 thread and
+    thread_num threads give the same losses and vectors (with a fixed seed).
+    Returns the final mean losses.
+    """
+    import KernelPool as kp
+    docs = _random_docs(word_count, doc_count)
+    docs[3] = np.zeros((0,), dtype=np.uint32) # empty docs get skipped
+    hs_tree = _random_hs_tree(word_count)
+    neg_sampler = cu.NegSampler(neg_table=np.arange(word_count, \
+                                dtype=np.uint32), neg_count=10)
+    max_hs_key = hs_tree['max_code_key']
+    cam_ns = nlm.CAModel(wv_dim, cv_dim, (word_count - 1), 100, use_ns=True)
+    cam_hs = nlm.CAModel(wv_dim, cv_dim, (word_count - 1), 100, \
+                         use_ns=False, max_hs_key=max_hs_key)
+    pvm = nlm.PVModel(wv_dim, cv_dim, (word_count - 1), 100, max_hs_key)
+    old_thread_num = kp.get_thread_num()
+    final_losses = []
+    for (name, model, var_param) in [('CAModel/NS', cam_ns, neg_sampler), \
+                                     ('CAModel/HSM', cam_hs, hs_tree), \
+                                     ('PVModel', pvm, hs_tree)]:
+        model.init_params(0.05)
+        model.class_layer.init_params(0.5) # so there is something to learn
+        frozen = _model_arrays(model)
+        inferencer = ContextInferencer(model, var_param, max_steps=300, \
+                                       block_docs=64, seed=1)
+        runs = []
+        try:
+            for t_num in [1, thread_num]:
+                kp.set_thread_num(t_num)
+                ctx_layer, stats = inferencer.infer(docs)
+                for (key, A) in _model_arrays(model).items():
+                    assert np.array_equal(A, frozen[key]), \
+                            "{0:s} {1:s} changed".format(name, key)
+                for P in ctx_layer.params.values():
+                    assert np.all(np.isfinite(P))
+                assert (ctx_layer.params['Wb'].shape[0] == doc_count)
+                assert (stats['steps'][3] == 0), "empty doc was trained"
+                first_loss = np.mean(np.delete(stats['first_loss'], 3))
+                mean_loss = np.mean(np.delete(stats['loss'], 3))
+                assert (mean_loss < first_loss), "loss didn't go down"
+                print("{0:s}, {1:d} threads: mean steps {2:.1f}, converged {3:.1%}, loss {4:.4f} -> {5:.4f}, {6:.1f} docs/s".format( \
+                      name, t_num, np.mean(stats['steps']), \
+                      np.mean(stats['converged']), first_loss, mean_loss, \
+                      stats['docs_per_sec']))
+                runs.append((ctx_layer, stats))
+        finally:
+            kp.set_thread_num(old_thread_num)
+        # each block's draws come from its own seed, so thread count and
+        # block order shouldn't matter
+        for key in ['steps', 'first_loss', 'loss', 'converged']:
+            assert np.array_equal(runs[0][1][key], runs[1][1][key]), \
+                    "{0:s} {1:s} differs across thread counts".format(name, key)
+        for p_name in ['Wm', 'Wb']:
+            assert np.array_equal(runs[0][0].params[p_name], \
+                                  runs[1][0].params[p_name]), \
+                    "{0:s} vectors differ across thread counts".format(name)
+        final_losses.append(np.mean(np.delete(runs[0][1]['loss'], 3)))
+    print("context inference OK")
+    return final_losses
+
+def run_inference_bench(word_count=100000, wv_dim=100, cv_dim=10, \
+                        doc_count=4000, thread_nums=(1, 2, 4)):
+    """
+    Compare docs/sec for ContextInferencer (with various thread counts) and
+    for CAModel.infer_context_vectors(), given the same number of samples.
+    Uses random documents, and a CAModel with negative sampling.
+    """
+    import KernelPool as kp
+    docs = _random_docs(word_count, doc_count)
+    neg_sampler = cu.NegSampler(neg_table=np.arange(word_count, \
+                                dtype=np.uint32), neg_count=10)
+    cam = nlm.CAModel(wv_dim, cv_dim, (word_count - 1), doc_count, \
+                      use_ns=True)
+    cam.init_params(0.05)
+    cam.class_layer.init_params(0.5)
+    inferencer = ContextInferencer(cam, neg_sampler)
+    old_thread_num = kp.get_thread_num()
+    print("docs: {0:d}, words: {1:d}, wv_dim: {2:d}".format(doc_count, \
+          word_count, wv_dim))
+    try:
+        for t_num in thread_nums:
+            kp.set_thread_num(t_num)
+            stats = inferencer.infer(docs)[1]
+            print("-- ContextInferencer, {0:d} threads: {1:.1f} docs/s, {2:.0f} samples/s, mean steps {3:.1f}, converged {4:.1%}".format( \
+                  t_num, stats['docs_per_sec'], \
+                  (stats['sample_count'] / stats['secs']), \
+                  np.mean(stats['steps']), np.mean(stats['converged'])))
+        # the old way, with as many samples as the last run above
+        batch_size = 200
+        batch_count = stats['sample_count'] // batch_size
+        pos_sampler = cu.PhraseSampler(docs, 5, max_phrase_key=doc_count)
+        t0 = time.time()
+        cam.infer_context_vectors(pos_sampler, neg_sampler, batch_size, \
+                                  batch_count, learn_rate=1e-2)
+        secs = time.time() - t0
+        print("-- infer_context_vectors, {0:d} threads: {1:.1f} docs/s, {2:.0f} samples/s".format( \
+              t_num, (doc_count / secs), ((batch_size * batch_count) / secs)))
+    finally:
+        kp.set_thread_num(old_thread_num)
+    return
+
+if __name__ == '__main__':
+    check_context_inference()
+    run_inference_bench()
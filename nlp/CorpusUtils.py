@@ -11,14 +11,22 @@
 
 import os
 import sys
+import gzip
+import bz2
 import heapq
 import time
 import random
+import shutil
+import hashlib
+import tempfile
+import threading
 import itertools
+import multiprocessing
+from collections import Counter
 try:
-    from queue import Queue
+    from queue import Queue, Empty, Full
 except ImportError:
-    from Queue import Queue
+    from Queue import Queue, Empty, Full
 
 import numpy as np
 import numpy.random as npr
@@ -27,8 +35,112 @@ import numba
 from six import iteritems, itervalues
 from six.moves import xrange
 
+from KernelPool import POOL
+
 MAX_HSM_KEY = 12345678
 
+##########################
+# FAST TEXT FILE READING #
+##########################
+
+# bytes per read when scanning text files
+READ_BLOCK_SIZE = 1 << 22
+
+def open_text_file(f_name):
+    """
+    Open a text file for binary reading, decompressing it on the fly if its
+    name ends in .gz, .bz2 or .xz.
+    """
+    if f_name.endswith('.gz'):
+        return gzip.open(f_name, 'rb')
+    if f_name.endswith('.bz2'):
+        return bz2.BZ2File(f_name, 'rb')
+    if f_name.endswith('.xz'):
+        try:
+            import lzma
+        except ImportError:
+            from backports import lzma
+        return lzma.open(f_name, 'rb')
+    return open(f_name, 'rb')
+
+def iter_line_blocks(f_name, block_size=READ_BLOCK_SIZE):
+    """
+    Read a (maybe compressed) text file in large blocks, and yield each block
+    of complete lines as one bytes object, without its final '\n'.
+    """
+    with open_text_file(f_name) as f:
+        tail = b''
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            block = tail + block
+            cut = block.rfind(b'\n')
+            if cut < 0:
+                tail = block
+                continue
+            tail = block[(cut+1):]
+            yield block[:cut]
+        if tail:
+            yield tail
+    return
+
+def _decode_block(block):
+    # sentences are lists of native strs, as from line.split() on a text file
+    if sys.version_info[0] >= 3:
+        return block.decode('utf-8')
+    return block
+
+def _encode_block(block, word_keys, unk_key):
+    """
+    Convert a block of lines into LUT keys, returning the tokens and offsets
+    of its lines in CSR form (i.e. as for a FlatCorpus). Unknown words get
+    unk_key, or are dropped if unk_key is None.
+    """
+    lines = block.split(b'\n')
+    offsets = np.zeros((len(lines) + 1,), dtype=np.int64)
+    keys = []
+    for (i, line) in enumerate(lines):
+        if unk_key is None:
+            keys.extend([word_keys[w] for w in line.split() if w in word_keys])
+        else:
+            keys.extend([word_keys.get(w, unk_key) for w in line.split()])
+        offsets[i+1] = len(keys)
+    return [np.asarray(keys, dtype=np.uint32), offsets]
+
+def _byte_word_keys(words_to_keys):
+    """Re-key a words_to_keys dict by utf-8 bytes, for use on raw blocks."""
+    return dict(((w if isinstance(w, bytes) else w.encode('utf-8')), k) \
+                for (w, k) in iteritems(words_to_keys))
+
+def read_file_blocks(f_name, word_keys=None, unk_key=None, \
+                     block_size=READ_BLOCK_SIZE):
+    """
+    Yield the sentences in a text file one block at a time. Without word_keys
+    each block is a list of sentences (i.e. word lists). With word_keys (a
+    dict from utf-8 bytes words to LUT keys), each block is a list [tokens,
+    offsets] giving its sentences as LUT keys in CSR form.
+    """
+    for block in iter_line_blocks(f_name, block_size=block_size):
+        if word_keys is None:
+            yield [line.split() for line in _decode_block(block).split('\n')]
+        else:
+            yield _encode_block(block, word_keys, unk_key)
+    return
+
+# word keys for the reader processes, set once per process by _init_reader()
+_READER_KEYS = [None, None]
+
+def _init_reader(word_keys, unk_key):
+    _READER_KEYS[0] = word_keys
+    _READER_KEYS[1] = unk_key
+    return
+
+def _read_file(f_name):
+    """Read all blocks of a file. This is the unit of work for readers."""
+    return list(read_file_blocks(f_name, word_keys=_READER_KEYS[0], \
+                                 unk_key=_READER_KEYS[1]))
+
 class SentenceFileIterator(object):
     """
     Iterator over all files in some directory.
@@ -38,16 +150,65 @@ class SentenceFileIterator(object):
     '\n' characters as delimiters between sentences/phrases/paragraphs, or
     whatever, and then splitting each chunk of text on white space (i.e. by
     applying *.split().
+
+    Files are read in large blocks, and files ending in .gz, .bz2 or .xz are
+    decompressed on the fly. If words_to_keys is given, sentences are yielded
+    as np.uint32 arrays of LUT keys (with unknown words mapped to unk_word)
+    rather than as lists of words (with unk_word=None, unknown words are
+    dropped instead). With workers > 1, files are read by a pool
+    of that many processes (each file is read whole by one process, so memory
+    use scales with file size), and are still yielded in order.
     """
-    def __init__(self, dirname):
+    def __init__(self, dirname, words_to_keys=None, unk_word='*UNK*', \
+                 workers=1):
         self.dirname = dirname
+        self.words_to_keys = words_to_keys
+        self.unk_word = unk_word
+        self.workers = workers
+        return
+
+    def file_names(self):
+        """Get the (sorted) full paths of the text files to iterate over."""
+        f_names = [os.path.join(self.dirname, fname) for fname in \
+                   sorted(os.listdir(self.dirname)) if fname.find('.txt') > -1]
+        return f_names
+
+    def blocks(self):
+        """
+        Yield the sentences in all files, a block at a time, as described for
+        read_file_blocks().
+        """
+        word_keys, unk_key = None, None
+        if self.words_to_keys is not None:
+            word_keys = _byte_word_keys(self.words_to_keys)
+            if self.unk_word is not None:
+                unk_key = self.words_to_keys[self.unk_word]
+        if self.workers <= 1:
+            for f_name in self.file_names():
+                for block in read_file_blocks(f_name, word_keys=word_keys, \
+                                              unk_key=unk_key):
+                    yield block
+            return
+        pool = multiprocessing.Pool(processes=self.workers, \
+                initializer=_init_reader, initargs=(word_keys, unk_key))
+        try:
+            for f_blocks in pool.imap(_read_file, self.file_names()):
+                for block in f_blocks:
+                    yield block
+        finally:
+            pool.close()
+            pool.join()
         return
 
     def __iter__(self):
-        for fname in os.listdir(self.dirname):
-            if fname.find('.txt') > -1:
-                for line in open(os.path.join(self.dirname, fname)):
-                    yield line.split()
+        for block in self.blocks():
+            if self.words_to_keys is None:
+                for sentence in block:
+                    yield sentence
+            else:
+                tokens, offsets = block
+                for i in xrange(offsets.size - 1):
+                    yield tokens[offsets[i]:offsets[i+1]]
 
 class Vocab(object):
     """
@@ -69,61 +230,41 @@ class Vocab(object):
         return "<" + ', '.join(vals) + ">"
 
 def build_vocab(sentences, min_count=5, compute_hs_tree=True, \
-                compute_ns_table=True, down_sample=0.0):
+                compute_ns_table=True, down_sample=0.0, workers=1, \
+                cache_dir=None, dense_hs_codes=False):
     """
     Build vocabulary from a sequence of sentences (can be a once-only generator stream).
     Each sentence must be an iterable sequence of hashable objects.
-    """
-    # scan the given corpus of sentences and count the occurrences of each word
-    sentence_no = -1
-    raw_vocab = {}
-    total_words = 0
-    for sentence_no, sentence in enumerate(sentences):
-        if sentence_no % 10000 == 0:
-            print("PROGRESS: at sentence #%i, processed %i words and %i word types" % \
-                (sentence_no, total_words, len(raw_vocab)))
-        for word in sentence:
-            total_words += 1
-            if word in raw_vocab:
-                raw_vocab[word].count += 1
-            else:
-                raw_vocab[word] = Vocab(count=1)
-    print("collected %i word types from a corpus of %i words and %i sentences" % \
-        (len(raw_vocab), total_words, sentence_no + 1))
 
-    # assign a unique index to each sufficiently frequent word
-    #
-    # NOTE: If *UNK* is already present in the source files, we will carry it
-    # over into the training vocabulary whether or not it meets the frequency
-    # threshold. All other unique tokens/words that don't meet the frequency
-    # threshold will be treated as if "converted" to *UNK*. The total frequency
-    # for *UNK* will thus be the frequency of the "raw" token *UNK* in the
-    # source text plus the summed frequencies of all words in the source text
-    # that do not meet the frequency threshold on their own. If *UNK* was not
-    # present in the source text as a raw token, it will be added to the vocab
-    # and will collect the frequencies of all dropped words.
-    words_to_vocabs, words_to_keys, keys_to_words = {}, {}, {}
-    idx = 0
-    unk_count = 0
-    for word, v in iteritems(raw_vocab):
-        if ((v.count >= min_count) or (word == '*UNK*')):
-            # this word meets the frequency threshold or is *UNK*
-            v.index = idx
-            words_to_vocabs[word] = v
-            words_to_keys[word] = idx
-            keys_to_words[idx] = word
-            idx += 1
-        else:
-            # collect count for a word that will become *UNK*
-            unk_count += v.count
-    if '*UNK*' in raw_vocab:
-        # *UNK* must have been processed in the above loop
-        words_to_vocabs['*UNK*'].count += unk_count
+    When sentences is a SentenceFileIterator (or anything else with a
+    file_names() method), words are counted straight from the raw file
+    blocks, and setting workers > 1 splits the counting pass across a pool
+    of worker processes, one file per task. If cache_dir is also given,
+    the filtered vocabulary is saved there under a fingerprint of the corpus
+    files, and later calls on the same (unchanged) files skip counting.
+    """
+    file_names = None
+    if hasattr(sentences, 'file_names'):
+        file_names = sentences.file_names()
+    cache_file = None
+    if (cache_dir is not None) and (file_names is not None):
+        cache_file = os.path.join(cache_dir, "vocab-{0:s}-{1:d}.npz".format( \
+                corpus_fingerprint(file_names), min_count))
+    if (cache_file is not None) and os.path.exists(cache_file):
+        print("loading cached vocab from %s" % cache_file)
+        words_to_vocabs, words_to_keys, keys_to_words = \
+                load_vocab_cache(cache_file)
     else:
-        # *UNK* was not processed by the above loop, so add it now
-        words_to_vocabs['*UNK*'] = Vocab(count=unk_count, index=idx)
-        words_to_keys['*UNK*'] = idx
-        keys_to_words[idx] = '*UNK*'
+        # scan the corpus and count the occurrences of each word
+        if file_names is not None:
+            raw_counts = count_words_parallel(file_names, workers=workers)
+        else:
+            raw_counts = count_words(sentences)
+        # assign a unique index to each sufficiently frequent word
+        words_to_vocabs, words_to_keys, keys_to_words = \
+                _fold_vocab(raw_counts, min_count)
+        if cache_file is not None:
+            save_vocab_cache(cache_file, words_to_vocabs, keys_to_words)
     print("total %i word types after removing those with count<%s" % \
         (len(words_to_vocabs), min_count))
 
@@ -148,43 +289,236 @@ def build_vocab(sentences, min_count=5, compute_hs_tree=True, \
     #   unk_word: the textish representation that stands in for words that
     #             aren't included in the "trained" vocabulary
     #
-    #   ns_table: a large list of word LUT keys such that sampling keys
-    #             uniformly at random from the list samples the keys nearly in
-    #             proportion to the frequency of their corresponding words
+    #   keep_probs: float32 array giving the probability of keeping each
+    #               occurrence of each word LUT key under frequent-word
+    #               subsampling (all 1s when down_sample=0). Pass this to
+    #               PhraseSampler/PNSampler to apply subsampling in training.
+    #
+    #   ns_table: an AliasTable over the word LUT keys, such that drawing
+    #             from it samples keys in proportion to count**0.75 for their
+    #             corresponding words (i.e. the usual "noise distribution")
     #
-    #   hs_tree: dict containing containing three items: 'keys_to_code_keys',
-    #            'keys_to_code_signs', and 'max_code_key'.
-    #     keys_to_code_keys: this maps word LUT keys to their corresponding
-    #                        sequence of keys into a LUT containing HSM code
-    #                        vectors. 
-    #     keys_to_code_signs: like keys_to_code_keys, but maps to the target
-    #                         predictions (i.e. +/- 1) for each HSM code.
+    #   hs_tree: dict containing the HSM code for each word LUT key, stored in
+    #            CSR (i.e. "compressed sparse row") form, with four items:
+    #            'code_offsets', 'code_keys', 'code_signs' and 'max_code_key'.
+    #     code_offsets: int64 array with one more entry than there are word
+    #                   LUT keys. The code for word key k is stored in entries
+    #                   code_offsets[k]:code_offsets[k+1] of the two arrays
+    #                   code_keys and code_signs.
+    #     code_keys: flat uint32 array of keys into a LUT containing HSM code
+    #                vectors, for the codes of all words, back to back.
+    #     code_signs: like code_keys, but holds the target predictions (i.e.
+    #                 +/- 1) for each HSM code.
     #     max_code_key: the maximum key required by the HSM codes recorded in
-    #                   keys_to_code_keys.
+    #                   code_keys.
+    #
+    #     NOTE: HSM codes are variable length, and in CSR form the memory they
+    #           take scales with the total code length. If dense_hs_codes is
+    #           True, hs_tree will also hold the old "fixed-length" code
+    #           matrices 'keys_to_code_keys' and 'keys_to_code_signs', in
+    #           which each row is padded out to the max code length. Unused
+    #           entries in the key matrix are set to > MAX_HSM_KEY, and unused
+    #           entries in the sign matrix are set to 0. Use fetch_hsm_codes()
+    #           to gather codes for a batch of word keys from either form.
     #
-    #     NOTE: All HSM code keys/signs are stored in a key/sign matrix, so all
-    #           codes have the same length, in some sense. However, to be most
-    #           efficient, HSM codes should be variable length. So, each row in
-    #           the key/sign matrix is not entirely filled with valid values.
-    #           Unused entries in the key matrix are set to > MAX_HSM_KEY, and
-    #           unused entries in the sign matrix are set to 0. This lets us
-    #           use the "fixed-length" codes just like variable-length codes.
-    #                            
     result = {}
     result['words_to_vocabs'] = words_to_vocabs
     result['words_to_keys'] = words_to_keys
     result['keys_to_words'] = keys_to_words
     result['unk_word'] = '*UNK*'
+    result['keep_probs'] = _make_keep_probs(words_to_vocabs, keys_to_words)
     result['hs_tree'] = None
     result['ns_table'] = None
     if compute_hs_tree:
-        result['hs_tree'] = _create_binary_tree(words_to_vocabs)
+        result['hs_tree'] = _create_binary_tree(words_to_vocabs, \
+                dense_codes=dense_hs_codes)
     if compute_ns_table:
         # build the table for drawing random words (for negative sampling)
-        result['ns_table'] = _make_table(words_to_vocabs, keys_to_words, \
-                words_to_keys)
+        result['ns_table'] = _make_alias_table(words_to_vocabs, keys_to_words)
     return result
 
+def count_words(sentences):
+    """
+    Count the occurrences of each word in a sequence of sentences, in a
+    single pass on the calling thread.
+    """
+    sentence_no = -1
+    raw_counts = Counter()
+    total_words = 0
+    for sentence_no, sentence in enumerate(sentences):
+        if sentence_no % 10000 == 0:
+            print("PROGRESS: at sentence #%i, processed %i words and %i word types" % \
+                (sentence_no, total_words, len(raw_counts)))
+        raw_counts.update(sentence)
+        total_words += len(sentence)
+    print("collected %i word types from a corpus of %i words and %i sentences" % \
+        (len(raw_counts), total_words, sentence_no + 1))
+    return raw_counts
+
+def _count_file(f_name):
+    """
+    Count the words in a single text file, parsed like SentenceFileIterator
+    parses it. This is the unit of work for count_words_parallel().
+    """
+    counts = Counter()
+    sentence_count = 0
+    for block in iter_line_blocks(f_name):
+        counts.update(block.split())
+        sentence_count += block.count(b'\n') + 1
+    # count raw bytes words, and only decode the distinct ones
+    if sys.version_info[0] >= 3:
+        counts = Counter(dict((w.decode('utf-8'), c) for (w, c) in \
+                              iteritems(counts)))
+    return [counts, sentence_count]
+
+def count_words_parallel(file_names, workers=4):
+    """
+    Count the occurrences of each word in the given text files, by counting
+    each file in a pool of worker processes and merging the shard counts.
+    Shard counts are merged in file order, whatever the number of workers.
+    """
+    raw_counts = Counter()
+    sentence_count = 0
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(processes=workers)
+        # (merge in file order, so words get the same keys for any workers)
+        file_counts = pool.imap(_count_file, file_names)
+    else:
+        file_counts = (_count_file(f_name) for f_name in file_names)
+    try:
+        for (f_no, (counts, f_sentences)) in enumerate(file_counts):
+            raw_counts.update(counts)
+            sentence_count += f_sentences
+            print("PROGRESS: counted %i/%i files, %i word types so far" % \
+                (f_no + 1, len(file_names), len(raw_counts)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    total_words = sum(itervalues(raw_counts))
+    print("collected %i word types from a corpus of %i words and %i sentences" % \
+        (len(raw_counts), total_words, sentence_count))
+    return raw_counts
+
+def _fold_vocab(raw_counts, min_count):
+    """
+    Assign a unique index to each sufficiently frequent word in raw_counts,
+    and fold the counts for all other words into *UNK*.
+
+    Called from `build_vocab()`.
+    """
+    #
+    # NOTE: If *UNK* is already present in the source files, we will carry it
+    # over into the training vocabulary whether or not it meets the frequency
+    # threshold. All other unique tokens/words that don't meet the frequency
+    # threshold will be treated as if "converted" to *UNK*. The total frequency
+    # for *UNK* will thus be the frequency of the "raw" token *UNK* in the
+    # source text plus the summed frequencies of all words in the source text
+    # that do not meet the frequency threshold on their own. If *UNK* was not
+    # present in the source text as a raw token, it will be added to the vocab
+    # and will collect the frequencies of all dropped words.
+    words_to_vocabs, words_to_keys, keys_to_words = {}, {}, {}
+    idx = 0
+    unk_count = 0
+    for word, count in iteritems(raw_counts):
+        if ((count >= min_count) or (word == '*UNK*')):
+            # this word meets the frequency threshold or is *UNK*
+            words_to_vocabs[word] = Vocab(count=count, index=idx)
+            words_to_keys[word] = idx
+            keys_to_words[idx] = word
+            idx += 1
+        else:
+            # collect count for a word that will become *UNK*
+            unk_count += count
+    if '*UNK*' in raw_counts:
+        # *UNK* must have been processed in the above loop
+        words_to_vocabs['*UNK*'].count += unk_count
+    else:
+        # *UNK* was not processed by the above loop, so add it now
+        words_to_vocabs['*UNK*'] = Vocab(count=unk_count, index=idx)
+        words_to_keys['*UNK*'] = idx
+        keys_to_words[idx] = '*UNK*'
+    return [words_to_vocabs, words_to_keys, keys_to_words]
+
+def check_parallel_vocab(file_words=[1000000, 50], workers=2):
+    """
+    Check that build_vocab() assigns the same LUT keys to the same words
+    when counting the corpus files sequentially or in a pool of workers.
+    Files are written with distinct words, and the first file is the largest
+    (so it finishes counting last).
+    """
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for (f_no, word_count) in enumerate(file_words):
+            f_name = os.path.join(temp_dir, "part{0:d}.txt".format(f_no))
+            with open(f_name, 'w') as f:
+                for i in range(word_count // 10):
+                    f.write(' '.join(["f{0:d}w{1:d}".format(f_no, (i + j) % 97) \
+                                      for j in range(10)]) + '\n')
+        sentences = SentenceFileIterator(temp_dir)
+        vocabs = [build_vocab(sentences, min_count=1, compute_hs_tree=False, \
+                              compute_ns_table=False, workers=w) \
+                  for w in [1, workers]]
+        assert (vocabs[0]['words_to_keys'] == vocabs[1]['words_to_keys'])
+        assert (vocabs[0]['keys_to_words'] == vocabs[1]['keys_to_words'])
+    finally:
+        shutil.rmtree(temp_dir)
+    print("parallel vocab keys OK")
+    return
+
+def corpus_fingerprint(file_names):
+    """
+    Get a hex digest identifying the given corpus files by their absolute
+    paths, sizes, and modification times in ns (i.e. without reading their
+    contents), so same-named files in different directories differ.
+    """
+    h = hashlib.md5()
+    for f_name in sorted(os.path.abspath(f) for f in file_names):
+        f_stat = os.stat(f_name)
+        # (st_mtime_ns is missing in python 2)
+        mtime_ns = getattr(f_stat, 'st_mtime_ns', int(f_stat.st_mtime * 1e9))
+        f_info = "{0:s}|{1:d}|{2:d}\n".format(f_name, int(f_stat.st_size), \
+                int(mtime_ns))
+        h.update(f_info.encode('utf-8'))
+    return h.hexdigest()
+
+def save_vocab_cache(f_name, w2v, k2w):
+    """
+    Save the words and counts for a built vocabulary in a compact binary
+    file. Words are stored in key order, as one '\n'-joined utf-8 blob.
+    """
+    key_count = len(k2w)
+    words = [k2w[k] for k in xrange(key_count)]
+    words = [(w if isinstance(w, bytes) else w.encode('utf-8')) for w in words]
+    word_blob = np.frombuffer(b'\n'.join(words), dtype=np.uint8)
+    counts = np.asarray([w2v[k2w[k]].count for k in xrange(key_count)], \
+                        dtype=np.uint64)
+    # write to a temp file first, so that an interrupted save (or a parallel
+    # run) never leaves a truncated cache behind
+    tmp_name = "{0:s}.{1:d}.tmp".format(f_name, os.getpid())
+    with open(tmp_name, 'wb') as f:
+        np.savez(f, word_blob=word_blob, counts=counts)
+    os.rename(tmp_name, f_name)
+    return
+
+def load_vocab_cache(f_name):
+    """
+    Load a vocabulary saved by save_vocab_cache(), returning the same
+    words_to_vocabs, words_to_keys and keys_to_words as _fold_vocab().
+    """
+    cache = np.load(f_name)
+    words = cache['word_blob'].tobytes().split(b'\n')
+    if sys.version_info[0] >= 3:
+        words = [w.decode('utf-8') for w in words]
+    counts = cache['counts']
+    words_to_vocabs, words_to_keys, keys_to_words = {}, {}, {}
+    for (idx, word) in enumerate(words):
+        words_to_vocabs[word] = Vocab(count=int(counts[idx]), index=idx)
+        words_to_keys[word] = idx
+        keys_to_words[idx] = word
+    return [words_to_vocabs, words_to_keys, keys_to_words]
+
 def _precalc_downsampling(w2v, down_sample=0.0):
     """
     Precalculate each vocabulary item's retention probability.
@@ -197,156 +531,698 @@ def _precalc_downsampling(w2v, down_sample=0.0):
     for v in itervalues(w2v):
         prob = 1.0
         if sample:
-            prob = np.sqrt(down_sample / (v.count / total_words))
+            prob = np.sqrt(down_sample / (float(v.count) / total_words))
         v.sample_prob = min(prob, 1.0)
     return
 
-def _make_table(w2v, k2w, w2k, table_size=20000000, power=0.75):
+def _make_keep_probs(w2v, k2w):
+    """
+    Gather the retention probabilities set by `_precalc_downsampling()` into
+    an array indexed by word LUT key. Called from `build_vocab()`.
+    """
+    keep_probs = np.ones((len(k2w),), dtype=np.float32)
+    for (key, word) in iteritems(k2w):
+        keep_probs[key] = w2v[word].sample_prob
+    return keep_probs
+
+def _make_alias_table(w2v, k2w, power=0.75):
     """
-    Create a table using stored vocabulary word counts for drawing random words
-    in parts of training based on 'negative sampling'.
+    Create an alias table using stored vocabulary word counts for drawing
+    random words in parts of training based on 'negative sampling'.
+
+    The table has one entry per word LUT key, so it takes O(V) time/memory to
+    build, and draws keys with probability exactly proportional to count**power.
 
     Called from `build_vocab()`.
     """
-    # table (= list of words) of noise distribution for negative sampling
     vocab_size = len(k2w)
-    table = np.zeros((table_size,), dtype=np.uint32)
-
-    # compute sum of all power (Z in paper)
-    power_sum = float(sum([w2v[word].count**power for word in w2v]))
-    # go through the whole table and fill it up with the word indexes proportional to a word's count**power
-    widx = 0
-    # normalize count^0.75 by Z
-    d1 = w2v[k2w[widx]].count**power / power_sum
-    for tidx in xrange(table_size):
-        table[tidx] = widx
-        if ((float(tidx) / table_size) > d1):
-            widx += 1
-            d1 += w2v[k2w[widx]].count**power / power_sum
-        if widx >= vocab_size:
-            widx = vocab_size - 1
-    return table.astype(np.uint32)
-
-
-def _create_binary_tree(w2v):
+    counts = np.asarray([w2v[k2w[k]].count for k in xrange(vocab_size)], \
+                        dtype=np.float64)
+    return AliasTable(counts**power)
+
+@numba.jit("void(f8[:], u4[:])", nopython=True, cache=True)
+def fast_alias_fill(probs, aliases):
+    """
+    Fill in an alias table using Vose's method.
+
+    On entry probs holds the weights rescaled to sum to probs.size. On exit,
+    probs[i] is the chance of keeping i when drawing slot i, and aliases[i] is
+    the key to return otherwise.
+    """
+    n = probs.size
+    small = np.zeros(n, dtype=np.int64)
+    large = np.zeros(n, dtype=np.int64)
+    s_count = 0
+    l_count = 0
+    for i in range(n):
+        aliases[i] = i
+        if probs[i] < 1.0:
+            small[s_count] = i
+            s_count += 1
+        else:
+            large[l_count] = i
+            l_count += 1
+    while ((s_count > 0) and (l_count > 0)):
+        s_count -= 1
+        s = small[s_count]
+        l = large[l_count-1]
+        aliases[s] = l
+        probs[l] = (probs[l] + probs[s]) - 1.0
+        if probs[l] < 1.0:
+            l_count -= 1
+            small[s_count] = l
+            s_count += 1
+    # anything left over is "full" up to rounding error
+    for i in range(s_count):
+        probs[small[i]] = 1.0
+    for i in range(l_count):
+        probs[large[i]] = 1.0
+    return
+
+class AliasTable:
+    """
+    Alias table for drawing keys from a fixed discrete distribution.
+
+    Each draw costs one uniform key and one uniform float, independent of the
+    number of keys, and the whole table is just two length-V arrays.
+    """
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64).ravel()
+        assert((weights.size > 0) and (np.min(weights) >= 0.0))
+        self.size = weights.size
+        self.probs = weights * (self.size / np.sum(weights))
+        self.aliases = np.zeros((self.size,), dtype=np.uint32)
+        fast_alias_fill(self.probs, self.aliases)
+        return
+
+    def sample(self, shape, rs=None):
+        """Draw an array of keys with the given shape, using the RandomState
+        rs (or numpy.random if rs is None)."""
+        rs = npr if rs is None else rs
+        slots = rs.randint(0, high=self.size, size=shape)
+        keep = rs.random_sample(shape) < self.probs[slots]
+        keys = np.where(keep, slots, self.aliases[slots])
+        return keys.astype(np.uint32)
+
+    def key_probs(self):
+        """Recover the (normalized) probability of drawing each key."""
+        p = self.probs.copy()
+        np.add.at(p, self.aliases, 1.0 - self.probs)
+        return p / self.size
+
+@numba.jit("void(i8[:], i8[:], i8[:], u1[:])", nopython=True, cache=True)
+def fast_huffman_merge(sorted_keys, node_counts, parent, branch):
+    """
+    Build a Huffman tree over the leaves 0...(V-1), using the O(V) two-queue
+    merge over the leaves sorted by count (given in sorted_keys).
+
+    Internal node i (for i in 0...(V-2)) is stored at V+i, so the root is at
+    2V-2. On exit, parent[n] holds the parent of node n and branch[n] is 1 if
+    n is the right child of its parent (and 0 if it's the left child).
+    """
+    leaf_count = sorted_keys.size
+    l_next = 0 # next unmerged leaf, in sorted_keys
+    n_next = leaf_count # next unmerged internal node
+    for i in range(leaf_count - 1):
+        new_node = leaf_count + i
+        for side in range(2):
+            # take the smaller front of the leaf queue and internal node queue
+            if ((l_next < leaf_count) and ((n_next >= new_node) or \
+                    (node_counts[sorted_keys[l_next]] <= node_counts[n_next]))):
+                node = sorted_keys[l_next]
+                l_next += 1
+            else:
+                node = n_next
+                n_next += 1
+            parent[node] = new_node
+            branch[node] = side
+            node_counts[new_node] += node_counts[node]
+    return
+
+@numba.jit("void(i8[:], u1[:], i8[:], u4[:], f4[:])", nopython=True, cache=True)
+def fast_huffman_codes(parent, branch, code_offsets, code_keys, code_signs):
+    """
+    Write the code for each leaf in a tree from fast_huffman_merge() into its
+    CSR slot. Codes run from the root down to the leaf, so we walk up from
+    each leaf and fill its slot from the back.
+    """
+    leaf_count = code_offsets.size - 1
+    root = (2 * leaf_count) - 2
+    for k in range(leaf_count):
+        pos = code_offsets[k+1] - 1
+        node = k
+        while (node != root):
+            code_keys[pos] = parent[node] - leaf_count
+            code_signs[pos] = 1.0 if (branch[node] == 1) else -1.0
+            pos -= 1
+            node = parent[node]
+    return
+
+def _create_binary_tree(w2v, dense_codes=False):
     """
     Create a binary Huffman tree using stored vocabulary word counts. Frequent words
     will have shorter binary codes. Called internally from `build_vocab()`.
 
-    The codes (presumably for use in a Hierarchical Softmax Layer) are stored
-    directly into the Vocab ojects that are the values in the dict param 'w2v'.
-    """
-    # build the huffman tree
-    heap = list(itervalues(w2v))
-    heapq.heapify(heap)
-    for i in xrange(len(w2v) - 1):
-        min1, min2 = heapq.heappop(heap), heapq.heappop(heap)
-        heapq.heappush(heap, Vocab(count=(min1.count + min2.count), \
-                index=(i + len(w2v)), left=min1, right=min2))
-    # recurse over the tree, assigning a binary code to each vocabulary word
-    key_dict = {} # map from word LUT keys to HSM code keys
-    sign_dict = {} # map from word LUT keys to HSM code signs
-    if heap:
-        stack = [(heap[0], [], [])]
-        while stack:
-            node, signs, keys = stack.pop()
-            if node.index < len(w2v):
-                # leaf node => store its path from the root
-                key_dict[node.index] = keys
-                sign_dict[node.index] = signs
-            else:
-                # inner node => continue recursion
-                keys = np.array(list(keys) + [node.index - len(w2v)], dtype=np.uint32)
-                stack.append((node.left, np.array(list(signs) + [-1.0], dtype=np.float32), keys))
-                stack.append((node.right, np.array(list(signs) + [1.0], dtype=np.float32), keys))
-    # get the max code length and maximum word LUT key
-    max_code_len = np.max(np.array([v.size for v in key_dict.values()]))
-    max_word_key = np.max(np.array([k for k in key_dict.keys()]))
-    # extend all v.codes/v.points to the same size
-    max_code_key =0
-    code_keys = np.zeros((max_word_key+1, max_code_len), dtype=np.uint32)
-    code_signs = np.zeros((max_word_key+1, max_code_len), dtype=np.float32)
-    for k in key_dict.keys():
-        c_len = key_dict[k].size
-        for j in range(max_code_len):
-            if (j >= c_len):
-                code_keys[k,j] = MAX_HSM_KEY + 1
-            else:
-                code_keys[k,j] = key_dict[k][j]
-                code_signs[k,j] = sign_dict[k][j]
-                if (code_keys[k,j] > max_code_key):
-                    max_code_key = code_keys[k,j]
+    The tree is built directly on arrays of counts, and the codes (presumably
+    for use in a Hierarchical Softmax Layer) are returned in CSR form. See the
+    notes in `build_vocab()` for a description of the returned dict.
+    """
+    leaf_count = len(w2v)
+    node_counts = np.zeros((max(2*leaf_count - 1, 1),), dtype=np.int64)
+    for v in itervalues(w2v):
+        node_counts[v.index] = v.count
+    # build the huffman tree, recording each node's parent and branch
+    sorted_keys = np.argsort(node_counts[0:leaf_count], kind='mergesort')
+    parent = np.zeros(node_counts.shape, dtype=np.int64)
+    branch = np.zeros(node_counts.shape, dtype=np.uint8)
+    fast_huffman_merge(sorted_keys.astype(np.int64), node_counts, parent, branch)
+    # get each node's depth (i.e. code length), working down from the root.
+    # parents always come after their children, so one reverse pass suffices.
+    depth = np.zeros(node_counts.shape, dtype=np.int64)
+    for n in xrange(node_counts.size - 2, -1, -1):
+        depth[n] = depth[parent[n]] + 1
+    if leaf_count == 1:
+        depth[0] = 0
+    code_offsets = np.zeros((leaf_count + 1,), dtype=np.int64)
+    np.cumsum(depth[0:leaf_count], out=code_offsets[1:])
+    code_keys = np.zeros((code_offsets[-1],), dtype=np.uint32)
+    code_signs = np.zeros((code_offsets[-1],), dtype=np.float32)
+    fast_huffman_codes(parent, branch, code_offsets, code_keys, code_signs)
     # record hsm code keys and signs for returnage
     hsm_tree = {}
-    hsm_tree['keys_to_code_keys'] = code_keys.astype(np.uint32)
-    hsm_tree['keys_to_code_signs'] = code_signs.astype(np.float32)
-    hsm_tree['max_code_key'] = max_code_key
+    hsm_tree['code_offsets'] = code_offsets
+    hsm_tree['code_keys'] = code_keys
+    hsm_tree['code_signs'] = code_signs
+    hsm_tree['max_code_key'] = max(leaf_count - 2, 0)
+    if dense_codes:
+        # also build the old padded code matrices, for code that uses them
+        code_lens = np.diff(code_offsets)
+        max_code_len = max(np.max(code_lens), 1)
+        code_cols = np.arange(code_keys.size) - \
+                np.repeat(code_offsets[0:-1], code_lens)
+        code_rows = np.repeat(np.arange(leaf_count), code_lens)
+        dense_keys = np.zeros((leaf_count, max_code_len), dtype=np.uint32)
+        dense_keys[:,:] = MAX_HSM_KEY + 1
+        dense_keys[code_rows, code_cols] = code_keys
+        dense_signs = np.zeros((leaf_count, max_code_len), dtype=np.float32)
+        dense_signs[code_rows, code_cols] = code_signs
+        hsm_tree['keys_to_code_keys'] = dense_keys
+        hsm_tree['keys_to_code_signs'] = dense_signs
     return hsm_tree
 
+def fetch_hsm_codes(hs_tree, word_keys):
+    """
+    Gather the HSM codes for the given word LUT keys, as used by the HSMLayer.
+
+    This returns [code_offsets, code_keys, code_signs]. If hs_tree holds codes
+    in CSR form, then the codes for word_keys[i] are in entries
+    code_offsets[i]:code_offsets[i+1] of code_keys/code_signs. If hs_tree only
+    holds the old padded code matrices, then code_offsets is None and the
+    padded rows for word_keys are returned.
+    """
+    if not ('code_offsets' in hs_tree):
+        code_keys = hs_tree['keys_to_code_keys'].take(word_keys, axis=0)
+        code_signs = hs_tree['keys_to_code_signs'].take(word_keys, axis=0)
+        return [None, code_keys, code_signs]
+    word_keys = np.asarray(word_keys, dtype=np.int64)
+    all_offsets = hs_tree['code_offsets']
+    starts = all_offsets[word_keys]
+    code_lens = all_offsets[word_keys + 1] - starts
+    code_offsets = np.zeros((word_keys.size + 1,), dtype=np.int64)
+    np.cumsum(code_lens, out=code_offsets[1:])
+    code_idx = np.arange(code_offsets[-1]) + \
+            np.repeat(starts - code_offsets[0:-1], code_lens)
+    code_keys = hs_tree['code_keys'].take(code_idx)
+    code_signs = hs_tree['code_signs'].take(code_idx)
+    return [code_offsets, code_keys, code_signs]
+
+#######################
+# FLAT CORPUS STORAGE #
+#######################
+
+class FlatCorpus(object):
+    """
+    A collection of phrases stored in CSR form, i.e. as one flat uint32 array
+    of word LUT keys (tokens) and an int64 array of phrase offsets, such that
+    phrase i is tokens[offsets[i]:offsets[i+1]].
+
+    This indexes and iterates like a list of np.uint32 phrase arrays (each
+    phrase is a view into tokens), so it can stand in for the lists returned
+    by sample_phrases(), Load1BWords() and LoadSTB() in older code.
+
+    A FlatCorpus written with save() can be reopened with load_flat_corpus(),
+    which maps the files with np.memmap rather than reading them. Pickling a
+    file-backed FlatCorpus only pickles its file name, so worker processes
+    reopen the same files and share their pages with zero copies.
+    """
+    def __init__(self, tokens, offsets, f_name=None, first_phrase=0):
+        assert (tokens.dtype == np.uint32)
+        assert (offsets.dtype == np.int64)
+        assert (offsets.size >= 1)
+        self.tokens = tokens
+        self.offsets = offsets
+        # f_name and first_phrase locate this corpus (or slice) on disk
+        self.f_name = f_name
+        self.first_phrase = first_phrase
+        return
+
+    def __len__(self):
+        return self.offsets.size - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            assert (step == 1)
+            stop = max(start, stop)
+            return FlatCorpus(self.tokens, self.offsets[start:(stop+1)], \
+                    f_name=self.f_name, first_phrase=(self.first_phrase+start))
+        if (idx < 0):
+            idx += len(self)
+        return self.tokens[self.offsets[idx]:self.offsets[idx+1]]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __getstate__(self):
+        if self.f_name is None:
+            return self.__dict__
+        # only the file name and phrase range are sent to worker processes,
+        # which reopen the memmapped files themselves
+        return {'f_name': self.f_name, 'first_phrase': self.first_phrase, \
+                'phrase_count': len(self)}
+
+    def __setstate__(self, state):
+        if 'phrase_count' in state:
+            fc = load_flat_corpus(state['f_name'])
+            start = state['first_phrase']
+            stop = start + state['phrase_count']
+            state = fc[start:stop].__dict__
+        self.__dict__.update(state)
+        return
+
+    def extend(self, phrase_list):
+        """
+        Append phrases (a FlatCorpus or a list of phrase arrays) in place.
+
+        Storage grows geometrically, so appends cost amortized O(#tokens
+        added). The first append copies the corpus into private in-memory
+        buffers, so a memmapped corpus (or a slice) stops being file-backed,
+        and views taken before an append keep pointing at the old arrays.
+        """
+        new_phrases = flatten_phrases(phrase_list)
+        new_tokens = new_phrases.tokens[new_phrases.offsets[0]:new_phrases.offsets[-1]]
+        new_offsets = new_phrases.offsets[1:] - new_phrases.offsets[0]
+        if not hasattr(self, '_tok_buf'):
+            self._tok_buf = self.tokens[self.offsets[0]:self.offsets[-1]].copy()
+            self._off_buf = self.offsets - self.offsets[0]
+            self.f_name = None
+            self.first_phrase = 0
+        tok_count = int(self.offsets[-1] - self.offsets[0])
+        off_count = self.offsets.size
+        tok_need = tok_count + new_tokens.size
+        off_need = off_count + new_offsets.size
+        if tok_need > self._tok_buf.size:
+            buf = np.zeros((max(tok_need, 2*self._tok_buf.size),), dtype=np.uint32)
+            buf[:tok_count] = self._tok_buf[:tok_count]
+            self._tok_buf = buf
+        if off_need > self._off_buf.size:
+            buf = np.zeros((max(off_need, 2*self._off_buf.size),), dtype=np.int64)
+            buf[:off_count] = self._off_buf[:off_count]
+            self._off_buf = buf
+        self._tok_buf[tok_count:tok_need] = new_tokens
+        self._off_buf[off_count:off_need] = new_offsets + tok_count
+        self.tokens = self._tok_buf[:tok_need]
+        self.offsets = self._off_buf[:off_need]
+        return
+
+    def phrase_lens(self):
+        """Get the length of each phrase, as an int64 array."""
+        return np.diff(self.offsets)
+
+    def token_count(self):
+        """Get the total number of tokens in all phrases."""
+        return int(self.offsets[-1] - self.offsets[0])
+
+    def save(self, f_name):
+        """
+        Write this corpus to the files f_name.tok (raw uint32 tokens) and
+        f_name.off (raw int64 offsets), and return it reopened from disk.
+        """
+        writer = FlatCorpusWriter(f_name)
+        tokens = self.tokens[self.offsets[0]:self.offsets[-1]]
+        writer.add_flat(tokens, self.offsets - self.offsets[0])
+        return writer.close()
+
+class FlatCorpusWriter(object):
+    """
+    Write phrases to the on-disk FlatCorpus format one at a time, without
+    holding the full corpus in memory. close() returns the memmapped corpus.
+    """
+    def __init__(self, f_name):
+        self.f_name = f_name
+        self.tok_file = open(_flat_file_name(f_name, 'tok') + '.tmp', 'wb')
+        self.off_file = open(_flat_file_name(f_name, 'off') + '.tmp', 'wb')
+        self.token_count = 0
+        np.zeros((1,), dtype=np.int64).tofile(self.off_file)
+        return
+
+    def add(self, phrase):
+        """Append a single phrase (a sequence of word LUT keys)."""
+        phrase = np.asarray(phrase, dtype=np.uint32)
+        phrase.tofile(self.tok_file)
+        self.token_count += phrase.size
+        np.asarray([self.token_count], dtype=np.int64).tofile(self.off_file)
+        return
+
+    def add_flat(self, tokens, offsets):
+        """Append a block of phrases given in CSR form, with offsets[0]=0."""
+        assert (offsets[0] == 0)
+        np.asarray(tokens, dtype=np.uint32).tofile(self.tok_file)
+        (offsets[1:].astype(np.int64) + self.token_count).tofile(self.off_file)
+        self.token_count += int(offsets[-1])
+        return
+
+    def close(self):
+        """Finish writing, and reopen the written corpus with np.memmap."""
+        self.tok_file.close()
+        self.off_file.close()
+        for ext in ['tok', 'off']:
+            f_name = _flat_file_name(self.f_name, ext)
+            os.rename(f_name + '.tmp', f_name)
+        return load_flat_corpus(self.f_name)
+
+def _flat_file_name(f_name, ext):
+    return "{0:s}.{1:s}".format(f_name, ext)
+
+def _open_flat_array(f_name, ext, dtype):
+    # The arrays are mapped copy-on-write, rather than read-only, because
+    # the numba kernels are compiled for writeable arrays. Pages are still
+    # shared with the page cache (and across processes) as nothing writes.
+    f_name = _flat_file_name(f_name, ext)
+    if os.path.getsize(f_name) == 0:
+        return np.zeros((0,), dtype=dtype)
+    return np.asarray(np.memmap(f_name, dtype=dtype, mode='c'))
+
+def load_flat_corpus(f_name):
+    """Open a FlatCorpus written by FlatCorpus.save()/FlatCorpusWriter."""
+    tokens = _open_flat_array(f_name, 'tok', np.uint32)
+    offsets = _open_flat_array(f_name, 'off', np.int64)
+    return FlatCorpus(tokens, offsets, f_name=f_name)
+
+def flatten_phrases(phrase_list):
+    """
+    Convert a list of phrases (i.e. sequences of word LUT keys) into an
+    in-memory FlatCorpus. A FlatCorpus is returned as is.
+    """
+    if isinstance(phrase_list, FlatCorpus):
+        return phrase_list
+    phrase_lens = np.asarray([len(p) for p in phrase_list], dtype=np.int64)
+    offsets = np.zeros((phrase_lens.size + 1,), dtype=np.int64)
+    np.cumsum(phrase_lens, out=offsets[1:])
+    tokens = np.zeros((offsets[-1],), dtype=np.uint32)
+    for (i, p) in enumerate(phrase_list):
+        tokens[offsets[i]:offsets[i+1]] = p
+    return FlatCorpus(tokens, offsets)
+
+def _sample_encoded_phrases(text_stream, max_phrases, out_file):
+    """Gather blocks of pre-encoded phrases, as for sample_phrases()."""
+    writer = None if out_file is None else FlatCorpusWriter(out_file)
+    all_tokens, all_offsets = [], [np.zeros((1,), dtype=np.int64)]
+    tok_count, phrase_count = 0, 0
+    for (tokens, offsets) in text_stream.blocks():
+        take = min(offsets.size - 1, max_phrases - phrase_count)
+        offsets = offsets[:(take+1)]
+        tokens = tokens[:offsets[-1]]
+        if writer is None:
+            all_tokens.append(tokens)
+            all_offsets.append(offsets[1:] + tok_count)
+        else:
+            writer.add_flat(tokens, offsets)
+        tok_count += tokens.size
+        phrase_count += take
+        if phrase_count >= max_phrases:
+            break
+    if writer is not None:
+        return writer.close()
+    all_tokens.append(np.zeros((0,), dtype=np.uint32))
+    return FlatCorpus(np.concatenate(all_tokens).astype(np.uint32), \
+                      np.concatenate(all_offsets).astype(np.int64))
+
 def sample_phrases(text_stream, words_to_keys, unk_word='*UNK*', \
-                    max_phrases=100000):
-    phrases = []
+                    max_phrases=100000, out_file=None):
+    """
+    Convert the first max_phrases phrases in text_stream into sequences of
+    word LUT keys, returned as a FlatCorpus. If out_file is given, phrases
+    are streamed to the on-disk format as they are converted, and the result
+    is memmapped from there.
+
+    If text_stream is a SentenceFileIterator that already encodes with
+    words_to_keys, its pre-encoded blocks are copied over whole.
+    """
+    unk_key = words_to_keys[unk_word]
+    if hasattr(text_stream, 'blocks') and \
+            (text_stream.words_to_keys is words_to_keys):
+        return _sample_encoded_phrases(text_stream, max_phrases, out_file)
+    if out_file is None:
+        tokens = []
+        phrase_lens = []
+    else:
+        writer = FlatCorpusWriter(out_file)
+    phrase_count = 0
     for text_blob in text_stream:
-        p_keys = np.zeros((len(text_blob),), dtype=np.uint32)
-        for (i, word) in enumerate(text_blob):
-            if word in words_to_keys:
-                p_keys[i] = words_to_keys[word]
-            else:
-                p_keys[i] = words_to_keys[unk_word]
-        phrases.append(p_keys.astype(np.uint32))
-        if len(phrases) >= max_phrases:
+        if phrase_count >= max_phrases:
             break
-    return phrases
+        p_keys = [words_to_keys.get(word, unk_key) for word in text_blob]
+        if out_file is None:
+            tokens.extend(p_keys)
+            phrase_lens.append(len(p_keys))
+        else:
+            writer.add(p_keys)
+        phrase_count += 1
+    if out_file is not None:
+        return writer.close()
+    offsets = np.zeros((len(phrase_lens) + 1,), dtype=np.int64)
+    np.cumsum(np.asarray(phrase_lens, dtype=np.int64), out=offsets[1:])
+    return FlatCorpus(np.asarray(tokens, dtype=np.uint32), offsets)
 
 ###################################
 # TRAINING EXAMPLE SAMPLING UTILS #
 ###################################
 
-@numba.jit("void(u4[:], i8, i8, i8, u4[:], u4[:], u4[:], u4[:])")
-def fast_pair_sample(phrase, max_window, i, repeats, anc_keys, pos_keys, rand_pool, ri):
-    phrase_len = phrase.size
-    for r in range(repeats):
-        j = i + r
-        a_idx = rand_pool[ri[0]] % phrase_len
-        ri[0] += 1
-        red_win = (rand_pool[ri[0]] % max_window) + 1
-        ri[0] += 1
-        c_min = a_idx - red_win
-        if (c_min < 0):
-            c_min = 0
-        c_max = a_idx + red_win
-        if (c_max >= phrase_len):
-            c_max = phrase_len - 1
-        c_span = c_max - c_min + 1
-        c_idx = a_idx
-        while (c_idx == a_idx):
-            c_idx = c_min + (rand_pool[ri[0]] % c_span)
-            ri[0] += 1
-        anc_keys[j] = phrase[a_idx]
-        pos_keys[j] = phrase[c_idx]
+@numba.jit("i8(u8[:], i8)", nopython=True, nogil=True, cache=True)
+def fast_rand(rng_state, s):
+    """
+    Advance the xorshift64* generator in slot s of rng_state, and return a
+    non-negative 63-bit random int.
+    """
+    x = rng_state[s]
+    x ^= x >> np.uint64(12)
+    x ^= x << np.uint64(25)
+    x ^= x >> np.uint64(27)
+    rng_state[s] = x
+    return np.int64((x * np.uint64(2685821657736338717)) >> np.uint64(1))
+
+def make_rng_state(slot_count, seed=None):
+    """
+    Make an array of (nonzero) xorshift64* states, one per thread slot, for
+    use with fast_rand(). This is seeded from numpy.random if seed is None.
+    """
+    rs = npr if seed is None else npr.RandomState(seed)
+    rng_state = rs.randint(1, high=(2**62), size=(slot_count,))
+    return rng_state.astype(np.uint64)
+
+@numba.jit("i8(i8[:], b1, u8[:], i8)", nopython=True, nogil=True, cache=True)
+def fast_pick_phrase(offsets, by_length, rng_state, s):
+    """
+    Pick a phrase with probability proportional to its length, by drawing a
+    token position uniformly and binary searching the (cumulative) offsets.
+    If by_length is False, pick a phrase uniformly instead.
+    """
+    if not by_length:
+        return fast_rand(rng_state, s) % (offsets.size - 1)
+    tok_count = offsets[offsets.size-1] - offsets[0]
+    tok_idx = offsets[0] + (fast_rand(rng_state, s) % tok_count)
+    return np.searchsorted(offsets, tok_idx, side='right') - 1
+
+@numba.jit("b1(f4[:], u4, u8[:], i8)", nopython=True, nogil=True, cache=True)
+def fast_keep(keep_probs, key, rng_state, s):
+    """
+    Decide whether to keep an occurrence of the word with LUT key key, under
+    frequent-word subsampling. An empty keep_probs array keeps everything.
+    """
+    if (keep_probs.size == 0):
+        return True
+    kp = keep_probs[key]
+    if (kp >= 1.0):
+        return True
+    # turn the top 52 of the 63 random bits into a uniform draw from [0, 1)
+    return ((fast_rand(rng_state, s) >> 11) * 2.220446049250313e-16) < kp
+
+# Max number of draws when rejecting subsampled context words inside the
+# sampling kernels, after which the last draw is kept (so windows made up of
+# very frequent words can't stall a batch).
+MAX_KEEP_TRIES = 16
+
+@numba.jit("void(u4[:], i8[:], b1, i8, i8, f4[:], u4[:], u4[:], u4[:], i8[:,:], u8[:], i8, i8, i8)", \
+           nopython=True, nogil=True, cache=True)
+def fast_pair_batch(tokens, offsets, by_length, max_window, repeats, \
+                    keep_probs, anc_keys, pos_keys, phrase_keys, keep_stats, \
+                    rng_state, s, start, stop):
+    """
+    Fill entries start:stop of anc_keys/pos_keys/phrase_keys with skip-gram
+    pairs. Phrases are picked by fast_pick_phrase(), and each phrase supplies
+    repeats consecutive pairs. Random ints come from slot s of rng_state.
+
+    Draws whose anchor is rejected by fast_keep() are skipped, so anchors
+    follow the subsampled corpus exactly. Rejected context words are redrawn
+    from the window (up to MAX_KEEP_TRIES times). Row s of keep_stats counts
+    anchor draws and kept anchors. Empty phrases (which can be picked when
+    by_length is False) are skipped.
+    """
+    j = start
+    while (j < stop):
+        p_idx = fast_pick_phrase(offsets, by_length, rng_state, s)
+        p_start = offsets[p_idx]
+        phrase_len = offsets[p_idx+1] - p_start
+        if (phrase_len == 0):
+            continue
+        for r in range(repeats):
+            if (j >= stop):
+                break
+            # skip this draw if the anchor is subsampled away
+            a_idx = fast_rand(rng_state, s) % phrase_len
+            keep_stats[s,0] += 1
+            if not fast_keep(keep_probs, tokens[p_start+a_idx], rng_state, s):
+                continue
+            keep_stats[s,1] += 1
+            red_win = (fast_rand(rng_state, s) % max_window) + 1
+            c_min = a_idx - red_win
+            if (c_min < 0):
+                c_min = 0
+            c_max = a_idx + red_win
+            if (c_max >= phrase_len):
+                c_max = phrase_len - 1
+            # draw uniformly from the (reduced) window, skipping the anchor
+            c_span = c_max - c_min + 1
+            c_idx = a_idx
+            if (c_span > 1):
+                for t in range(MAX_KEEP_TRIES):
+                    c_idx = c_min + (fast_rand(rng_state, s) % (c_span - 1))
+                    if (c_idx >= a_idx):
+                        c_idx += 1
+                    if fast_keep(keep_probs, tokens[p_start+c_idx], rng_state, s):
+                        break
+            anc_keys[j] = tokens[p_start+a_idx]
+            pos_keys[j] = tokens[p_start+c_idx]
+            phrase_keys[j] = p_idx
+            j += 1
     return
 
-@numba.jit("void(u4[:], i8, i8, u4[:], i8, u4[:,:], u4[:], u4[:])")
-def fast_seq_sample(phrase, gram_n, pad_key, i, repeats, key_seqs, rand_pool, ri):
-    phrase_len = phrase.size
-    for r in range(repeats):
-        j = i + r
-        # Get a random stopping point for the n-gram. For now, assume that
-        # n-grams containing fewer than 2 valid words, i.e. a context word and
-        # a predicted word, are not desired.
-        stop_idx = (rand_pool[ri[0]] % (phrase_len - 1)) + 1
-        ri[0] += 1
-        # Get the start index of the n-gram (maybe negative)
-        start_idx = stop_idx - gram_n + 1
-        cur_pos = 0
-        while (cur_pos < gram_n):
-            # Record the word LUT keys for this n-gram, substituting the
-            # "padding key" as required due to phrase length
-            if ((start_idx + cur_pos) < 0):
-                key_seqs[j,cur_pos] = pad_key[0]
-            else:
-                key_seqs[j,cur_pos] = phrase[start_idx+cur_pos]
-            cur_pos += 1
+@numba.jit("void(u4[:], i8[:], b1, i8, i8, i8, f4[:], u4[:,:], u4[:], i8[:,:], u8[:], i8, i8, i8)", \
+           nopython=True, nogil=True, cache=True)
+def fast_seq_batch(tokens, offsets, by_length, gram_n, pad_key, repeats, \
+                   keep_probs, key_seqs, phrase_keys, keep_stats, rng_state, \
+                   s, start, stop):
+    """
+    Fill rows start:stop of key_seqs/phrase_keys with n-grams, padded with
+    pad_key where they run off the front of their phrase. Phrases are picked
+    by fast_pick_phrase(), and each phrase supplies repeats consecutive
+    n-grams. Random ints come from slot s of rng_state.
+
+    Draws whose final (i.e. predicted) word is rejected by fast_keep() are
+    skipped. Row s of keep_stats counts draws and kept words. Empty phrases
+    are skipped, as in fast_pair_batch().
+    """
+    j = start
+    while (j < stop):
+        p_idx = fast_pick_phrase(offsets, by_length, rng_state, s)
+        p_start = offsets[p_idx]
+        phrase_len = offsets[p_idx+1] - p_start
+        if (phrase_len == 0):
+            continue
+        for r in range(repeats):
+            if (j >= stop):
+                break
+            # Get a random stopping point for the n-gram. For now, assume that
+            # n-grams containing fewer than 2 valid words, i.e. a context word
+            # and a predicted word, are not desired.
+            stop_idx = phrase_len - 1
+            if (phrase_len > 1):
+                stop_idx = (fast_rand(rng_state, s) % (phrase_len - 1)) + 1
+            # skip this draw if the predicted word is subsampled away
+            keep_stats[s,0] += 1
+            if not fast_keep(keep_probs, tokens[p_start+stop_idx], rng_state, s):
+                continue
+            keep_stats[s,1] += 1
+            # Get the start index of the n-gram (maybe negative)
+            start_idx = stop_idx - gram_n + 1
+            for cur_pos in range(gram_n):
+                if ((start_idx + cur_pos) < 0):
+                    key_seqs[j,cur_pos] = pad_key
+                else:
+                    key_seqs[j,cur_pos] = tokens[p_start+start_idx+cur_pos]
+            phrase_keys[j] = p_idx
+            j += 1
+    return
+
+@numba.jit("i8(u4[:], i8[:], f4[:], u4[:], i8[:], u8[:], i8)", \
+           nopython=True, nogil=True, cache=True)
+def fast_subsample_corpus(tokens, offsets, keep_probs, new_tokens, \
+                          new_offsets, rng_state, s):
+    """
+    Copy the tokens that fast_keep() accepts into new_tokens, and write the
+    matching phrase offsets into new_offsets. Phrases keep their positions
+    (and hence their keys), even if all their tokens are dropped. Returns
+    the number of tokens kept.
+    """
+    kept = 0
+    new_offsets[0] = 0
+    for p_idx in range(offsets.size - 1):
+        for t_idx in range(offsets[p_idx], offsets[p_idx+1]):
+            if fast_keep(keep_probs, tokens[t_idx], rng_state, s):
+                new_tokens[kept] = tokens[t_idx]
+                kept += 1
+        new_offsets[p_idx+1] = kept
+    return kept
+
+def subsample_corpus(corpus, keep_probs, rng_state):
+    """
+    Draw a subsampled copy of the FlatCorpus corpus, in which each token is
+    kept with the probability given for its LUT key in keep_probs. Uses the
+    first slot of rng_state.
+    """
+    new_tokens = np.zeros((corpus.token_count(),), dtype=np.uint32)
+    new_offsets = np.zeros(corpus.offsets.shape, dtype=np.int64)
+    kept = fast_subsample_corpus(corpus.tokens, corpus.offsets, keep_probs, \
+                                 new_tokens, new_offsets, rng_state, 0)
+    return FlatCorpus(new_tokens[:kept], new_offsets)
+
+def _subsample_report(stats, sample_count, elapsed):
+    # stats holds [# tokens considered, # tokens kept] by subsampling
+    keep_rate = 1.0
+    if stats[0] > 0:
+        keep_rate = float(stats[1]) / float(stats[0])
+    report = {'keep_rate': keep_rate, 'effective_speedup': 1.0 / keep_rate}
+    if (sample_count is not None) and (elapsed is not None):
+        report['samples_per_sec'] = sample_count / elapsed
+        report['effective_tokens_per_sec'] = \
+                report['samples_per_sec'] * report['effective_speedup']
+    return report
+
+def run_batch_kernel(kernel, args, sample_count, repeats, rng_state):
+    """
+    Run a batch sampling kernel over sample_count samples, split into one
+    chunk per slot in rng_state, with the chunks run on the KernelPool
+    (which re-raises any error from a worker chunk). Chunks are cut on
+    multiples of repeats, so each chunk starts on a fresh phrase.
+    """
+    thread_num = rng_state.size
+    group_count = (sample_count + (repeats - 1)) // repeats
+    chunk_len = ((group_count + (thread_num - 1)) // thread_num) * repeats
+    chunk_args = [args + (rng_state, s, min(s*chunk_len, sample_count), \
+                  min((s+1)*chunk_len, sample_count)) for s in range(thread_num)]
+    POOL.run(kernel, chunk_args)
     return
 
 class PhraseSampler:
@@ -354,58 +1230,147 @@ class PhraseSampler:
     This samples positive example pairs each comprising an anchor word and a
     near-by context word from its "skip-gram window". This can also samples
     n_gram sequences from the managed collection of phrases.
+
+    Each batch is drawn by a single call into a compiled kernel, which takes
+    its random ints from a per-sampler xorshift64* state that persists across
+    calls. With thread_num > 1 the batch is split across that many threads,
+    each with its own RNG state (so results depend on thread_num, but are
+    reproducible for a given seed and thread_num).
+
+    Frequent-word subsampling is applied when keep_probs (e.g. the array
+    returned by build_vocab() in result['keep_probs']) is given:
+      subsample_mode='fused': draws of subsampled words are skipped inside
+        the sampling kernels. Anchors (or predicted words) follow the
+        subsampled distribution exactly, while context words are redrawn from
+        the window of the full phrase, rather than from a window over the
+        subsampled phrase.
+      subsample_mode='presample': a subsampled copy of the corpus is drawn
+        once per pass (i.e. once per this many samples as it has tokens) and
+        sampled from directly, as in the original word2vec.
+    Phrase keys are the same in both modes. Use subsample_report() to see the
+    effective speedup.
     """
-    def __init__(self, phrase_list, max_window, max_phrase_key=50000):
-        # phrase_list contains the phrases to sample from
+    def __init__(self, phrase_list, max_window, max_phrase_key=50000, \
+                 thread_num=1, seed=None, keep_probs=None, \
+                 subsample_mode='fused', by_length=True):
+        # phrase_list contains the phrases to sample from, either as a
+        # FlatCorpus or as a list of phrase arrays (which gets flattened).
+        # Phrases are picked in proportion to their length by binary search
+        # on the corpus offsets, so there is no separate table to build.
+        assert (subsample_mode in ['fused', 'presample'])
         self.max_window = max_window
-        self.phrase_list = phrase_list
-        self.phrase_table = self._make_table(self.phrase_list)
-        self.max_phrase_key = min(len(self.phrase_list), max_phrase_key)
-        self.pt_size = self.phrase_table.size
+        self.full_phrase_list = flatten_phrases(phrase_list)
+        assert (self.full_phrase_list.token_count() > 0)
+        # a FlatCorpus passed in is shared with the caller (until appended to)
+        self.shared_phrases = isinstance(phrase_list, FlatCorpus)
+        self.phrase_key_limit = max_phrase_key
+        self.max_phrase_key = min(len(self.full_phrase_list), max_phrase_key)
+        self.by_length = by_length
+        # each phrase drawn supplies this many consecutive samples
+        self.repeats = 5
+        self.rng_state = make_rng_state(thread_num, seed=seed)
+        # setup for frequent-word subsampling
+        self.subsample_mode = subsample_mode
+        self.keep_probs = np.zeros((0,), dtype=np.float32)
+        if keep_probs is not None:
+            self.keep_probs = np.asarray(keep_probs, dtype=np.float32)
+        self.keep_stats = np.zeros((thread_num, 2), dtype=np.int64)
+        self.presample_stats = np.zeros((2,), dtype=np.int64)
+        self.pass_samples = 0
+        self.phrase_list = self.full_phrase_list
+        if self.presampled():
+            self.resample()
+        return
+
+    def presampled(self):
+        """Check whether we sample from a pre-subsampled corpus."""
+        return (self.keep_probs.size > 0) and \
+                (self.subsample_mode == 'presample')
+
+    def kernel_keep_probs(self):
+        """Get the keep_probs to apply inside the sampling kernels."""
+        if self.presampled():
+            return np.zeros((0,), dtype=np.float32)
+        return self.keep_probs
+
+    def resample(self):
+        """Draw a fresh subsampled corpus, for a new pass (presample mode)."""
+        assert self.presampled()
+        self.phrase_list = subsample_corpus(self.full_phrase_list, \
+                                            self.keep_probs, self.rng_state)
+        assert (self.phrase_list.token_count() > 0)
+        self.presample_stats[0] += self.full_phrase_list.token_count()
+        self.presample_stats[1] += self.phrase_list.token_count()
+        self.pass_samples = 0
         return
 
-    def _make_table(self, p_list, table_size=20000000):
+    def _start_batch(self, sample_count):
+        # in presample mode, move to a new subsampled corpus after each pass
+        if self.presampled():
+            if self.pass_samples >= self.phrase_list.token_count():
+                self.resample()
+            self.pass_samples += sample_count
+        return
+
+    def reset_stats(self):
+        """Reset the counts used by subsample_report()."""
+        self.keep_stats[:,:] = 0
+        self.presample_stats[:] = 0
+        if self.presampled():
+            self.presample_stats[0] = self.full_phrase_list.token_count()
+            self.presample_stats[1] = self.phrase_list.token_count()
+        return
+
+    def subsample_report(self, sample_count=None, elapsed=None):
+        """
+        Get the fraction of corpus tokens kept by subsampling (since the last
+        reset_stats()), and the resulting effective speedup, i.e. how many
+        corpus tokens each sample stands in for. If sample_count samples were
+        drawn and used in elapsed seconds, also get the raw and effective
+        (i.e. corpus) tokens per second.
         """
-        Create a table for quickly drawing phrase indices in proportion to
-        the length of each phrase.
+        if self.presampled():
+            stats = self.presample_stats
+        else:
+            stats = np.sum(self.keep_stats, axis=0)
+        return _subsample_report(stats, sample_count, elapsed)
+
+    def add_phrases(self, phrase_list):
+        """
+        Append phrases to the set being sampled from, without rebuilding any
+        sampling structures. Returns the key of the first appended phrase.
+        A FlatCorpus given to __init__() is left unchanged.
         """
-        phrase_count = len(p_list)
-        phrase_lens = np.asarray([p.size for p in p_list]).astype(np.float64)
-        len_sum = np.sum(phrase_lens)
-        table = np.zeros((table_size,), dtype=np.uint32)
-        widx = 0
-        d1 = phrase_lens[0] / len_sum
-        for tidx in xrange(table_size):
-            table[tidx] = widx
-            if ((float(tidx) / table_size) > d1):
-                widx += 1
-                d1 += phrase_lens[widx] / len_sum
-            if widx >= phrase_count:
-                widx = phrase_count - 1
-        return table.astype(np.uint32)
+        if self.shared_phrases:
+            # switch to a new FlatCorpus over the same arrays, which extend()
+            # copies into private buffers on the first append
+            private_list = self.full_phrase_list[0:len(self.full_phrase_list)]
+            if self.phrase_list is self.full_phrase_list:
+                self.phrase_list = private_list
+            self.full_phrase_list = private_list
+            self.shared_phrases = False
+        new_phrases = flatten_phrases(phrase_list)
+        first_key = len(self.full_phrase_list)
+        self.full_phrase_list.extend(new_phrases)
+        if self.presampled():
+            self.phrase_list.extend(subsample_corpus(new_phrases, \
+                    self.keep_probs, self.rng_state))
+        self.max_phrase_key = min(len(self.full_phrase_list), \
+                                  self.phrase_key_limit)
+        return first_key
 
     def sample_pairs(self, sample_count):
         """Draw a sample."""
         anc_keys = np.zeros((sample_count,), dtype=np.uint32)
         pos_keys = np.zeros((sample_count,), dtype=np.uint32)
         phrase_keys = np.zeros((sample_count,), dtype=np.uint32)
-        # we will use a "precomputed" table of random ints, to save overhead
-        # on calls through numpy.random. the location of the next fresh random
-        # int in rand_pool is given by ri[0]
-        rand_pool = npr.randint(0, high=self.pt_size, \
-                size=(10*sample_count,)).astype(np.uint32)
-        ri = np.asarray([0]).astype(np.uint32) # index into rand_pool
-        repeats = 5
-        while not ((sample_count % repeats) == 0):
-            repeats -= 1
-        for i in range(0, sample_count, repeats):
-            pt_idx = rand_pool[ri[0]]
-            ri[0] = ri[0] + 1
-            phrase_keys[i:(i+repeats)] = self.phrase_table[pt_idx]
-            fast_pair_sample(self.phrase_list[phrase_keys[i]], self.max_window, \
-                             i, repeats, anc_keys, pos_keys, rand_pool, ri)
-        anc_keys = anc_keys.astype(np.uint32)
-        pos_keys = pos_keys.astype(np.uint32)
+        self._start_batch(sample_count)
+        args = (self.phrase_list.tokens, self.phrase_list.offsets, \
+                self.by_length, self.max_window, self.repeats, \
+                self.kernel_keep_probs(), anc_keys, pos_keys, phrase_keys, \
+                self.keep_stats)
+        run_batch_kernel(fast_pair_batch, args, sample_count, self.repeats, \
+                         self.rng_state)
         phrase_keys = np.minimum(self.max_phrase_key, phrase_keys).astype(np.uint32)
         return [anc_keys, pos_keys, phrase_keys]
 
@@ -413,49 +1378,352 @@ class PhraseSampler:
         """Draw a sample."""
         key_seqs = np.zeros((sample_count, gram_n), dtype=np.uint32)
         phrase_keys = np.zeros((sample_count,), dtype=np.uint32)
-        pad_key = np.asarray([pad_key]).astype(np.uint32)
-        # we will use a "precomputed" table of random ints, to save overhead
-        # on calls through numpy.random. the location of the next fresh random
-        # int in rand_pool is given by ri[0]
-        rand_pool = npr.randint(0, high=self.pt_size, \
-                size=(10*sample_count,)).astype(np.uint32)
-        ri = np.asarray([0]).astype(np.uint32) # index into rand_pool
-        repeats = 5
-        while not ((sample_count % repeats) == 0):
-            repeats -= 1
-        for i in range(0, sample_count, repeats):
-            pt_idx = rand_pool[ri[0]]
-            ri[0] = ri[0] + 1
-            phrase_keys[i:(i+repeats)] = self.phrase_table[pt_idx]
-            fast_seq_sample(self.phrase_list[phrase_keys[i]], gram_n, pad_key, \
-                    i, repeats, key_seqs, rand_pool, ri)
-        key_seqs = key_seqs.astype(np.uint32)
+        self._start_batch(sample_count)
+        args = (self.phrase_list.tokens, self.phrase_list.offsets, \
+                self.by_length, gram_n, int(pad_key), self.repeats, \
+                self.kernel_keep_probs(), key_seqs, phrase_keys, \
+                self.keep_stats)
+        run_batch_kernel(fast_seq_batch, args, sample_count, self.repeats, \
+                         self.rng_state)
         phrase_keys = np.minimum(self.max_phrase_key, phrase_keys).astype(np.uint32)
         return [key_seqs, phrase_keys]
 
+def check_shared_phrases(word_count=50):
+    """
+    Check that add_phrases() leaves a FlatCorpus given to PhraseSampler (and
+    any other samplers built on it) unchanged, in both subsample modes.
+    """
+    rs = npr.RandomState(1)
+    corpus = flatten_phrases([rs.randint(0, word_count, size=(8,)).astype( \
+                              np.uint32) for i in range(2)])
+    tokens = corpus.tokens.copy()
+    new_phrase = np.arange(word_count, (word_count + 8), dtype=np.uint32)
+    for mode in ['fused', 'presample']:
+        keep_probs = np.ones(((word_count + 8),), dtype=np.float32)
+        s1 = PhraseSampler(corpus, 3, keep_probs=keep_probs, \
+                           subsample_mode=mode, seed=1)
+        s2 = PhraseSampler(corpus, 3, keep_probs=keep_probs, \
+                           subsample_mode=mode, seed=2)
+        assert (s1.add_phrases([new_phrase]) == 2)
+        assert (len(s1.full_phrase_list) == 3) and (len(s1.phrase_list) == 3)
+        assert (len(corpus) == 2) and np.array_equal(corpus.tokens, tokens)
+        assert (len(s2.full_phrase_list) == 2)
+        # s2 never draws from the phrase added to s1
+        assert (np.max(s2.sample_pairs(500)[0]) < word_count)
+        assert (np.max(s1.sample_pairs(500)[0]) >= word_count)
+    print("shared phrase lists OK")
+    return
+
+def check_empty_phrases(word_count=50, batch_count=20, batch_size=500):
+    """
+    Check that PhraseSampler never draws from empty phrases, in both
+    subsample modes, with phrases picked by length or uniformly. The corpus
+    holds an empty phrase, and a short phrase of a word with keep prob 0.01
+    (which presampling usually drops).
+    """
+    rs = npr.RandomState(1)
+    phrases = [rs.randint(0, word_count, size=(rs.randint(2, 10),)).astype( \
+               np.uint32) for i in range(20)]
+    phrases[3] = np.zeros((0,), dtype=np.uint32)
+    phrases[7] = np.asarray([word_count, word_count], dtype=np.uint32)
+    keep_probs = np.ones((word_count + 1,), dtype=np.float32)
+    keep_probs[word_count] = 0.01
+    for mode in ['fused', 'presample']:
+        for by_length in [True, False]:
+            sampler = PhraseSampler(phrases, 3, keep_probs=keep_probs, \
+                                    subsample_mode=mode, by_length=by_length, \
+                                    seed=1)
+            for b in range(batch_count):
+                # (check against the corpus each batch was drawn from)
+                p_keys = sampler.sample_pairs(batch_size)[2]
+                assert np.all(sampler.phrase_list.phrase_lens()[p_keys] > 0)
+                seq_keys, p_keys = sampler.sample_ngrams(batch_size, \
+                        gram_n=3, pad_key=(word_count + 1))
+                assert np.all(sampler.phrase_list.phrase_lens()[p_keys] > 0)
+                assert (np.max(seq_keys) <= (word_count + 1))
+    print("empty phrase sampling OK")
+    return
+
+@numba.jit("i8(u4[:], i8[:], i8[:], i8[:], i8, f4[:], u4[:], u4[:], u4[:], i8[:], i8[:,:], u8[:])", \
+           nopython=True, nogil=True, cache=True)
+def fast_sweep_pairs(tokens, offsets, chunk_starts, chunk_order, max_window, \
+                     keep_probs, anc_keys, pos_keys, phrase_keys, state, \
+                     keep_stats, rng_state):
+    """
+    Fill anc_keys/pos_keys/phrase_keys with every (anchor, context) pair
+    from the (reduced) windows around successive tokens of the corpus,
+    walking its chunks in the order given by chunk_order. The window
+    reduction is as in fast_pair_batch(). The walk resumes from, and is
+    saved back into, state:
+      state[0]: position in chunk_order, state[1]: current phrase,
+      state[2]: anchor position in phrase, state[3]: next context position,
+      state[4]: last context position, state[5]: epoch count,
+      state[6]: 1 if the anchor's window is still being emitted.
+    chunk_order is reshuffled (using rng_state) at the end of each epoch.
+    Returns the number of epochs completed during this call.
+    """
+    chunk_count = chunk_starts.size - 1
+    chunk_pos = state[0]
+    p_idx = state[1]
+    a_idx = state[2]
+    c_idx = state[3]
+    c_max = state[4]
+    in_window = state[6]
+    epochs = 0
+    p_start = offsets[p_idx]
+    phrase_len = offsets[p_idx+1] - p_start
+    j = 0
+    while (j < anc_keys.size):
+        if (in_window == 1):
+            # emit the next pair from the current anchor's window
+            if (c_idx > c_max):
+                in_window = 0
+                a_idx += 1
+                continue
+            if (c_idx != a_idx):
+                if fast_keep(keep_probs, tokens[p_start+c_idx], rng_state, 0):
+                    anc_keys[j] = tokens[p_start+a_idx]
+                    pos_keys[j] = tokens[p_start+c_idx]
+                    phrase_keys[j] = p_idx
+                    j += 1
+            c_idx += 1
+            continue
+        if (a_idx >= phrase_len):
+            # move to the next phrase, the next chunk, or the next epoch
+            p_idx += 1
+            a_idx = 0
+            if (p_idx >= chunk_starts[chunk_order[chunk_pos]+1]):
+                chunk_pos += 1
+                if (chunk_pos >= chunk_count):
+                    chunk_pos = 0
+                    epochs += 1
+                    for i in range(chunk_count-1, 0, -1):
+                        k = fast_rand(rng_state, 0) % (i + 1)
+                        tmp = chunk_order[i]
+                        chunk_order[i] = chunk_order[k]
+                        chunk_order[k] = tmp
+                p_idx = chunk_starts[chunk_order[chunk_pos]]
+            p_start = offsets[p_idx]
+            phrase_len = offsets[p_idx+1] - p_start
+            continue
+        # open the window around a new anchor, unless it's subsampled away
+        keep_stats[0,0] += 1
+        if not fast_keep(keep_probs, tokens[p_start+a_idx], rng_state, 0):
+            a_idx += 1
+            continue
+        keep_stats[0,1] += 1
+        red_win = (fast_rand(rng_state, 0) % max_window) + 1
+        c_idx = a_idx - red_win
+        if (c_idx < 0):
+            c_idx = 0
+        c_max = a_idx + red_win
+        if (c_max >= phrase_len):
+            c_max = phrase_len - 1
+        in_window = 1
+    state[0] = chunk_pos
+    state[1] = p_idx
+    state[2] = a_idx
+    state[3] = c_idx
+    state[4] = c_max
+    state[5] += epochs
+    state[6] = in_window
+    return epochs
+
+class SweepSampler:
+    """
+    This samples positive example pairs like PhraseSampler.sample_pairs(),
+    but by sweeping through the corpus rather than drawing at random. The
+    corpus is cut into chunks of about chunk_tokens tokens (on phrase
+    boundaries), the chunks are visited in a shuffled order, and every
+    (anchor, context) pair from each anchor's reduced window is emitted in
+    turn. So, consecutive pairs share anchors and nearby words, batches touch
+    far fewer distinct LUT rows, and each epoch covers every window once.
+
+    keep_probs applies frequent-word subsampling to both anchors and context
+    words, and subsample_report() works as for PhraseSampler.
+    """
+    def __init__(self, phrase_list, max_window, max_phrase_key=50000, \
+                 chunk_tokens=10000, seed=None, keep_probs=None):
+        self.max_window = max_window
+        self.phrase_list = flatten_phrases(phrase_list)
+        self.max_phrase_key = min(len(self.phrase_list), max_phrase_key)
+        assert (np.max(self.phrase_list.phrase_lens()) > 1)
+        # cut the corpus into chunks on phrase boundaries
+        offsets = self.phrase_list.offsets
+        chunk_ids = (offsets[:-1] - offsets[0]) // chunk_tokens
+        self.chunk_starts = np.concatenate(([0], \
+                np.flatnonzero(np.diff(chunk_ids)) + 1, \
+                [len(self.phrase_list)])).astype(np.int64)
+        self.rng_state = make_rng_state(1, seed=seed)
+        self.keep_probs = np.zeros((0,), dtype=np.float32)
+        if keep_probs is not None:
+            self.keep_probs = np.asarray(keep_probs, dtype=np.float32)
+        self.keep_stats = np.zeros((1, 2), dtype=np.int64)
+        rs = npr if seed is None else npr.RandomState(seed)
+        self.chunk_order = rs.permutation(self.chunk_starts.size - 1)
+        self.chunk_order = self.chunk_order.astype(np.int64)
+        self.state = np.zeros((7,), dtype=np.int64)
+        self.state[1] = self.chunk_starts[self.chunk_order[0]]
+        return
+
+    def epoch(self):
+        """Get the number of full passes made through the corpus."""
+        return int(self.state[5])
+
+    def reset_stats(self):
+        """Reset the counts used by subsample_report()."""
+        self.keep_stats[:,:] = 0
+        return
+
+    def subsample_report(self, sample_count=None, elapsed=None):
+        """See PhraseSampler.subsample_report()."""
+        return _subsample_report(self.keep_stats[0], sample_count, elapsed)
+
+    def sample_pairs(self, sample_count):
+        """Draw the next sample_count pairs from the sweep."""
+        anc_keys = np.zeros((sample_count,), dtype=np.uint32)
+        pos_keys = np.zeros((sample_count,), dtype=np.uint32)
+        phrase_keys = np.zeros((sample_count,), dtype=np.uint32)
+        fast_sweep_pairs(self.phrase_list.tokens, self.phrase_list.offsets, \
+                self.chunk_starts, self.chunk_order, self.max_window, \
+                self.keep_probs, anc_keys, pos_keys, phrase_keys, \
+                self.state, self.keep_stats, self.rng_state)
+        phrase_keys = np.minimum(self.max_phrase_key, phrase_keys).astype(np.uint32)
+        return [anc_keys, pos_keys, phrase_keys]
+
 class NegSampler:
     """
     This samples "contrastive words" for training via negative sampling.
+
+    The noise distribution can be given either as an AliasTable (as returned
+    by build_vocab() in result['ns_table']) or as an old-style flat table of
+    word LUT keys, which is sampled uniformly.
     """
     def __init__(self, neg_table=None, neg_count=10):
-        # phrase_list contains the phrases to sample from 
         self.neg_table = neg_table
-        self.neg_table_size = self.neg_table.size
         self.neg_count = neg_count
         return
 
-    def sample(self, sample_count, neg_count=0):
+    def sample(self, sample_count, neg_count=0, rs=None):
+        # draws come from the RandomState rs, or numpy.random if rs is None
         if (neg_count == 0):
             neg_count = self.neg_count
-        neg_keys = np.zeros((sample_count, neg_count), dtype=np.uint32)
-        neg_idx = npr.randint(0, high=self.neg_table_size, size=neg_keys.shape)
-        for i in range(neg_keys.shape[1]):
-            neg_keys[:,i] = self.neg_table[neg_idx[:,i]]
-        neg_keys = neg_keys.astype(np.uint32)
-        return neg_keys
+        shape = (sample_count, neg_count)
+        if isinstance(self.neg_table, AliasTable):
+            neg_keys = self.neg_table.sample(shape, rs=rs)
+        else:
+            rs = npr if rs is None else rs
+            neg_idx = rs.randint(0, high=self.neg_table.size, size=shape)
+            neg_keys = self.neg_table[neg_idx]
+        return neg_keys.astype(np.uint32)
+
+################################
+# BACKGROUND BATCH PREFETCHING #
+################################
+
+class BatchPrefetcher(object):
+    """
+    Keep a bounded queue of ready training batches, filled by background
+    worker threads, so that sampling overlaps with the trainer's compute.
+
+    batch_func is called with no arguments and should return one complete
+    batch (e.g. a list of key arrays). The sampling kernels release the GIL,
+    so even a single worker thread runs alongside the trainer. Calls into
+    batch_func are serialized by a lock unless thread_safe is True, as the
+    samplers keep RNG state that a concurrent call would clobber. Use more
+    than one worker only with a thread_safe batch_func.
+
+    The models' train() methods accept a BatchPrefetcher (see the models'
+    prefetch_batches()) in place of their usual sampler. batch_size and
+    sampler record the size of the batches made by batch_func and the
+    sampler they are drawn from (if known), which train() uses to check its
+    batch_size and to report subsampling stats. Use stats() to see how long
+    the consumer spent waiting on data, and close() to stop the workers.
+    """
+    def __init__(self, batch_func, queue_size=8, workers=1, thread_safe=False, \
+                 batch_size=None, sampler=None):
+        self.batch_func = batch_func
+        self.batch_size = batch_size
+        self.sampler = sampler
+        self.queue = Queue(maxsize=queue_size)
+        self.func_lock = None if thread_safe else threading.Lock()
+        self.stopped = threading.Event()
+        self.batch_count = 0
+        self.wait_secs = 0.0
+        self.start_time = time.time()
+        self.workers = [threading.Thread(target=self._work) \
+                        for i in range(workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+        return
+
+    def _work(self):
+        while not self.stopped.is_set():
+            try:
+                if self.func_lock is None:
+                    batch = self.batch_func()
+                else:
+                    with self.func_lock:
+                        batch = self.batch_func()
+            except Exception as e:
+                # hand the error to the consumer, who re-raises it
+                batch = e
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(batch, timeout=0.1)
+                    break
+                except Full:
+                    continue
+            if isinstance(batch, Exception):
+                break
+        return
+
+    def next_batch(self):
+        """Get the next ready batch, waiting for one if none is ready."""
+        t0 = time.time()
+        batch = self.queue.get()
+        self.wait_secs += time.time() - t0
+        if isinstance(batch, Exception):
+            raise batch
+        self.batch_count += 1
+        return batch
+
+    def reset_stats(self):
+        """Reset the counts used by stats()."""
+        self.batch_count = 0
+        self.wait_secs = 0.0
+        self.start_time = time.time()
+        return
+
+    def stats(self):
+        """
+        Get the number of batches served and the time the consumer spent
+        waiting for them (in seconds, and as a fraction of the time since
+        the last reset_stats()), along with the current queue fill.
+        """
+        elapsed = max(time.time() - self.start_time, 1e-8)
+        return {'batches': self.batch_count, 'wait_secs': self.wait_secs, \
+                'wait_frac': self.wait_secs / elapsed, \
+                'queued': self.queue.qsize()}
+
+    def close(self):
+        """Stop the worker threads, and drop any queued batches."""
+        self.stopped.set()
+        for worker in self.workers:
+            while worker.is_alive():
+                try:
+                    self.queue.get_nowait()
+                except Empty:
+                    pass
+                worker.join(0.01)
+        return
 
 
 if __name__=="__main__":
+    check_empty_phrases()
+    check_shared_phrases()
+    check_parallel_vocab()
     sentences = SentenceFileIterator('./training_text')
     result = build_vocab(sentences, min_count=3, down_sample=0.0)
 
@@ -7,58 +7,35 @@ import pyximport
 models_dir = os.path.dirname(__file__) or os.getcwd()
 pyximport.install(setup_args={"include_dirs": [models_dir, get_include()]})
 from CythonFuncsPyx import w2v_ff_bp_pyx, ag_update_2d_pyx, ag_update_1d_pyx, \
-                           lut_bp_pyx, nsl_ff_bp_pyx, acl_ff_bp_pyx, DO_INIT
+                           lut_bp_pyx, nsl_ff_bp_pyx, hsm_ff_bp_pyx, \
+                           acl_ff_bp_pyx, set_logistic_table_pyx, DO_INIT
 
 import numpy as np
 import numpy.random as npr
-import threading
-from ctypes import pythonapi, c_void_p
+from KernelPool import make_multithread, set_thread_num, get_thread_num, \
+                       set_scatter_mode, get_scatter_mode
+from LogisticTables import add_table_listener
 
-########################################
-# MULTITHREADING HELPER-FUNC AND DEFNS #
-########################################
-
-THREAD_NUM = 4
-
-def make_multithread(inner_func, numthreads):
-    def func_mt(*args):
-        length = len(args[0])
-        sp_idx = np.arange(0,length).astype(np.uint32)
-        chunklen = (length + (numthreads-1)) // numthreads
-        chunkargs = [(sp_idx[i*chunklen:(i+1)*chunklen],)+args for i in range(numthreads)]
-        # Start a thread for all but the last chunk of work
-        threads = [threading.Thread(target=inner_func, args=cargs)
-                   for cargs in chunkargs[:-1]]
-        for thread in threads:
-            thread.start()
-        # Give the last chunk of work to the main thread
-        inner_func(*chunkargs[-1])
-        for thread in threads:
-            thread.join()
-        return 1
-    def func_st(*args):
-        length = len(args[0])
-        sp_idx = np.arange(0,length).astype(np.uint32)
-        sp_args = (sp_idx,) + args
-        inner_fun(*sp_args)
-    func = None
-    if numthreads == 1:
-        func = func_st
-    else:
-        func = func_mt
-    return func_mt
+# keep the table pointer in the cython kernels in sync with LogisticTables
+add_table_listener(set_logistic_table_pyx)
 
 ##############################
 # NUMBA FUNCTION DEFINITIONS #
 ##############################
 
-w2v_ff_bp = make_multithread(w2v_ff_bp_pyx, THREAD_NUM)
-hsm_ff_bp = make_multithread(nsl_ff_bp_pyx, THREAD_NUM)
-nsl_ff_bp = make_multithread(nsl_ff_bp_pyx, THREAD_NUM)
-lut_bp = make_multithread(lut_bp_pyx, THREAD_NUM)
-
-ag_update_2d = make_multithread(ag_update_2d_pyx, THREAD_NUM)
-ag_update_1d = make_multithread(ag_update_1d_pyx, 1)
+# scatter gives (key arg, param args, grad args) for the shared rows that a
+# kernel adds grads into, see KernelPool.make_multithread
+w2v_ff_bp = make_multithread(w2v_ff_bp_pyx, idx_dtype=np.uint32, \
+        scatter=((0, (3,), (6,)), (1, (4, 5), (7, 8))), sums=(9,))
+hsm_ff_bp = make_multithread(hsm_ff_bp_pyx, idx_dtype=np.uint32, \
+        scatter=((2, (4, 5), (7, 8)),))
+nsl_ff_bp = make_multithread(nsl_ff_bp_pyx, idx_dtype=np.uint32, \
+        scatter=((0, (3, 4), (6, 7)),))
+lut_bp = make_multithread(lut_bp_pyx, idx_dtype=np.uint32, \
+        scatter=((0, (), (2,)),), sort_rows=True)
+
+ag_update_2d = make_multithread(ag_update_2d_pyx, idx_dtype=np.uint32)
+ag_update_1d = make_multithread(ag_update_1d_pyx, 1, idx_dtype=np.uint32)
 
 
 ##############
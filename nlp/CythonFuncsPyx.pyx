@@ -26,6 +26,7 @@ from scipy.linalg import blas
 ctypedef np.float32_t REAL_t
 ctypedef np.uint32_t UI32_t
 ctypedef np.int32_t I32_t
+ctypedef np.int64_t I64_t
 
 DEF MAX_SENTENCE_LEN = 10000
 
@@ -50,6 +51,13 @@ ctypedef void (*cy_nsl_ff_bp_ptr) (
     REAL_t *dX, REAL_t *dW, REAL_t *db,
     REAL_t *L, const int do_grad, const int vec_dim) nogil
 
+ctypedef void (*cy_hsm_ff_bp_ptr) (
+    const int sp_size, const UI32_t *sp_idx, const I64_t *code_offsets,
+    const UI32_t *code_keys, REAL_t *code_signs,
+    REAL_t *X, REAL_t *W, REAL_t *b,
+    REAL_t *dX, REAL_t *dW, REAL_t *db,
+    REAL_t *L, const int do_grad, const int vec_dim) nogil
+
 ctypedef void (*cy_acl_ff_bp_ptr) (
     const int sp_size, const UI32_t *sp_idx,
     const int pn_size, const UI32_t *pn_keys, REAL_t *pn_sign,
@@ -66,6 +74,7 @@ cdef sscal_ptr sscal=<sscal_ptr>PyCObject_AsVoidPtr(blas.sscal._cpointer) # x =
 
 cdef cy_w2v_ff_bp_ptr cy_w2v_ff_bp
 cdef cy_nsl_ff_bp_ptr cy_nsl_ff_bp
+cdef cy_hsm_ff_bp_ptr cy_hsm_ff_bp
 cdef cy_acl_ff_bp_ptr cy_acl_ff_bp
 
 # define some useful constants
@@ -75,6 +84,46 @@ cdef REAL_t ONEF = <REAL_t>1.0
 cdef REAL_t ADA_EPS = <REAL_t>0.001
 cdef REAL_t ADA_RHO = <REAL_t>0.98
 
+# the shared softplus/sigmoid table (see LogisticTables), which the
+# w2v/nsl/hsm kernels use in place of exp/log when USE_TABLE is 1
+cdef REAL_t *LOGISTIC_TABLE = NULL
+cdef int USE_TABLE = 0
+cdef int TABLE_LAST_BIN = 0
+cdef REAL_t TABLE_Z_MAX = <REAL_t>0.0
+cdef REAL_t TABLE_INV_STEP = <REAL_t>0.0
+_table_ref = [None] # keeps the current table array alive
+
+def set_logistic_table_pyx(table_p, z_max_p, inv_step_p):
+    """Point the kernels at a table from LogisticTables (or none, if empty)."""
+    global LOGISTIC_TABLE, USE_TABLE, TABLE_LAST_BIN, TABLE_Z_MAX, TABLE_INV_STEP
+    table_p = np.ascontiguousarray(table_p, dtype=np.float32)
+    _table_ref[0] = table_p
+    LOGISTIC_TABLE = <REAL_t *>(np.PyArray_DATA(table_p))
+    USE_TABLE = 1 if (table_p.size > 0) else 0
+    TABLE_LAST_BIN = (table_p.size // 2) - 2
+    TABLE_Z_MAX = <REAL_t>z_max_p
+    TABLE_INV_STEP = <REAL_t>inv_step_p
+    return
+
+cdef inline double table_logistic(const REAL_t z, double *sig) nogil:
+    # look up softplus(z) (returned) and sigmoid(z) (put in sig)
+    cdef REAL_t t, f
+    cdef int i
+    if (z >= TABLE_Z_MAX):
+        sig[0] = 1.0
+        return z
+    if (z <= -TABLE_Z_MAX):
+        sig[0] = 0.0
+        return 0.0
+    t = (z + TABLE_Z_MAX) * TABLE_INV_STEP
+    i = <int>t
+    if (i > TABLE_LAST_BIN):
+        i = TABLE_LAST_BIN
+    f = t - i
+    i = 2 * i
+    sig[0] = LOGISTIC_TABLE[i+1] + f * (LOGISTIC_TABLE[i+3] - LOGISTIC_TABLE[i+1])
+    return LOGISTIC_TABLE[i] + f * (LOGISTIC_TABLE[i+2] - LOGISTIC_TABLE[i])
+
 #############
 # W2V_FF_BP #
 #############
@@ -88,6 +137,7 @@ cdef void cy_w2v_ff_bp0(
     # declarations
     cdef long long row1, row2
     cdef REAL_t label, y, exp_pns_y, g
+    cdef double L_pn, sig
     cdef UI32_t a_key, c_key
     cdef int sp_i, i, j
 
@@ -102,11 +152,16 @@ cdef void cy_w2v_ff_bp0(
             neg_label = -1.0 * pn_sign[i*pn_size + j]
             # compute prediction y as np.dot(a_vec, c_vec.T) + b[c_key]
             y = <REAL_t>dsdot(&vec_dim, &Wa[row1], &ONE, &Wc[row2], &ONE) + b[c_key]
-            exp_pns_y = <REAL_t>exp(neg_label * y)
-            L[0] = L[0] + log(1.0 + exp_pns_y) # add the loss on this a/c pair
+            if (USE_TABLE == 1):
+                L_pn = table_logistic(<REAL_t>(neg_label * y), &sig)
+            else:
+                exp_pns_y = <REAL_t>exp(neg_label * y)
+                L_pn = log(1.0 + exp_pns_y)
+                sig = exp_pns_y / (1.0 + exp_pns_y)
+            L[0] = L[0] + L_pn # add the loss on this a/c pair
             if (do_grad == 1):
                 # Compute gradient and update parameter gradient accumulators
-                g = neg_label * (exp_pns_y / (1.0 + exp_pns_y))
+                g = neg_label * sig
                 saxpy(&vec_dim, &g, &Wa[row1], &ONE, &dWc[row2], &ONE)
                 saxpy(&vec_dim, &g, &Wc[row2], &ONE, &dWa[row1], &ONE)
                 db[c_key] = db[c_key] + g
@@ -121,6 +176,7 @@ cdef void cy_w2v_ff_bp1(
     # declarations
     cdef long long row1, row2
     cdef REAL_t label, y, exp_pns_y, g
+    cdef double L_pn, sig
     cdef UI32_t a_key, c_key
     cdef int sp_i, i, j
 
@@ -135,11 +191,16 @@ cdef void cy_w2v_ff_bp1(
             neg_label = -1.0 * pn_sign[i*pn_size + j]
             # compute prediction y as np.dot(a_vec, c_vec.T) + b[c_key]
             y = <REAL_t>sdot(&vec_dim, &Wa[row1], &ONE, &Wc[row2], &ONE) + b[c_key]
-            exp_pns_y = <REAL_t>exp(neg_label * y)
-            L[0] = L[0] + log(1.0 + exp_pns_y) # add the loss on this a/c pair
+            if (USE_TABLE == 1):
+                L_pn = table_logistic(<REAL_t>(neg_label * y), &sig)
+            else:
+                exp_pns_y = <REAL_t>exp(neg_label * y)
+                L_pn = log(1.0 + exp_pns_y)
+                sig = exp_pns_y / (1.0 + exp_pns_y)
+            L[0] = L[0] + L_pn # add the loss on this a/c pair
             if (do_grad == 1):
                 # Compute gradient and update parameter gradient accumulators
-                g = neg_label * (exp_pns_y / (1.0 + exp_pns_y))
+                g = neg_label * sig
                 saxpy(&vec_dim, &g, &Wa[row1], &ONE, &dWc[row2], &ONE)
                 saxpy(&vec_dim, &g, &Wc[row2], &ONE, &dWa[row1], &ONE)
                 db[c_key] = db[c_key] + g
@@ -231,6 +292,7 @@ cdef void cy_nsl_ff_bp0(
     # declarations
     cdef long long row1, row2
     cdef REAL_t label, y, exp_pns_y, g
+    cdef double L_pn, sig
     cdef UI32_t X_key, W_key
     cdef int sp_i, i, j
 
@@ -245,11 +307,16 @@ cdef void cy_nsl_ff_bp0(
                 neg_label = -1.0 * pn_sign[X_key*pn_size + j] # minus the label
                 # compute prediction y as np.dot(X[X_key], W[W_key].T) + b[W_key]
                 y = <REAL_t>dsdot(&vec_dim, &X[row1], &ONE, &W[row2], &ONE) + b[W_key]
-                exp_pns_y = <REAL_t>exp(neg_label * y) # this is used for loss/grad
-                L[X_key*pn_size + j] = log(1.0 + exp_pns_y) # record the loss
+                if (USE_TABLE == 1):
+                    L_pn = table_logistic(<REAL_t>(neg_label * y), &sig)
+                else:
+                    exp_pns_y = <REAL_t>exp(neg_label * y) # this is used for loss/grad
+                    L_pn = log(1.0 + exp_pns_y)
+                    sig = exp_pns_y / (1.0 + exp_pns_y)
+                L[X_key*pn_size + j] = L_pn # record the loss
                 if (do_grad == 1):
                     # Compute gradient and update gradient accumulators
-                    g = neg_label * (exp_pns_y / (1.0 + exp_pns_y))
+                    g = neg_label * sig
                     saxpy(&vec_dim, &g, &X[row1], &ONE, &dW[row2], &ONE)
                     saxpy(&vec_dim, &g, &W[row2], &ONE, &dX[row1], &ONE)
                     db[W_key] = db[W_key] + g
@@ -266,6 +333,7 @@ cdef void cy_nsl_ff_bp1(
     # declarations
     cdef long long row1, row2
     cdef REAL_t label, y, exp_pns_y, g
+    cdef double L_pn, sig
     cdef UI32_t X_key, W_key
     cdef int sp_i, i, j
 
@@ -280,11 +348,16 @@ cdef void cy_nsl_ff_bp1(
                 neg_label = -1.0 * pn_sign[X_key*pn_size + j] # minus the label
                 # compute prediction y as np.dot(X[X_key], W[W_key].T) + b[W_key]
                 y = <REAL_t>sdot(&vec_dim, &X[row1], &ONE, &W[row2], &ONE) + b[W_key]
-                exp_pns_y = <REAL_t>exp(neg_label * y) # this is used for loss/grad
-                L[X_key*pn_size + j] = log(1.0 + exp_pns_y) # record the loss
+                if (USE_TABLE == 1):
+                    L_pn = table_logistic(<REAL_t>(neg_label * y), &sig)
+                else:
+                    exp_pns_y = <REAL_t>exp(neg_label * y) # this is used for loss/grad
+                    L_pn = log(1.0 + exp_pns_y)
+                    sig = exp_pns_y / (1.0 + exp_pns_y)
+                L[X_key*pn_size + j] = L_pn # record the loss
                 if (do_grad == 1):
                     # Compute gradient and update gradient accumulators
-                    g = neg_label * (exp_pns_y / (1.0 + exp_pns_y))
+                    g = neg_label * sig
                     saxpy(&vec_dim, &g, &X[row1], &ONE, &dW[row2], &ONE)
                     saxpy(&vec_dim, &g, &W[row2], &ONE, &dX[row1], &ONE)
                     db[W_key] = db[W_key] + g
@@ -314,6 +387,120 @@ def nsl_ff_bp_pyx(sp_idx_p, pn_keys_p, pn_sign_p, X_p, W_p, b_p,
     return
 
 
+#############
+# HSM_FF_BP #
+################################################################################
+# NOTE: This is like nsl_ff_bp, but for hierarchical softmax codes stored in   #
+#       CSR form, i.e. as one flat array of code keys (and signs) for the      #
+#       whole minibatch, plus an array of offsets into the flat arrays. The    #
+#       codes for row i of X_p are in entries code_offsets[i]:code_offsets[i+1]#
+#       of code_keys_p/code_signs_p, so each anchor/target pair only touches   #
+#       its own code vectors and no "huge key" padding check is needed. The   #
+#       loss for each code is written into the matching entry of (flat) L_p.  #
+################################################################################
+
+cdef void cy_hsm_ff_bp0(
+    const int sp_size, const UI32_t *sp_idx, const I64_t *code_offsets,
+    const UI32_t *code_keys, REAL_t *code_signs,
+    REAL_t *X, REAL_t *W, REAL_t *b,
+    REAL_t *dX, REAL_t *dW, REAL_t *db,
+    REAL_t *L, const int do_grad, const int vec_dim) nogil:
+
+    # declarations
+    cdef long long row1, row2, c_i
+    cdef REAL_t y, exp_pns_y, g, neg_label
+    cdef double L_pn, sig
+    cdef UI32_t X_key, W_key
+    cdef int sp_i
+
+    # update loop
+    for sp_i in range(sp_size):
+        X_key = sp_idx[sp_i]
+        row1 = X_key * vec_dim # get the starting index of input row (in X)
+        for c_i in range(code_offsets[X_key], code_offsets[X_key+1]):
+            W_key = code_keys[c_i]
+            row2 = W_key * vec_dim # get the starting index of code row (in W)
+            neg_label = -1.0 * code_signs[c_i] # minus the label
+            # compute prediction y as np.dot(X[X_key], W[W_key].T) + b[W_key]
+            y = <REAL_t>dsdot(&vec_dim, &X[row1], &ONE, &W[row2], &ONE) + b[W_key]
+            if (USE_TABLE == 1):
+                L_pn = table_logistic(<REAL_t>(neg_label * y), &sig)
+            else:
+                exp_pns_y = <REAL_t>exp(neg_label * y) # this is used for loss/grad
+                L_pn = log(1.0 + exp_pns_y)
+                sig = exp_pns_y / (1.0 + exp_pns_y)
+            L[c_i] = L_pn # record the loss
+            if (do_grad == 1):
+                # Compute gradient and update gradient accumulators
+                g = neg_label * sig
+                saxpy(&vec_dim, &g, &X[row1], &ONE, &dW[row2], &ONE)
+                saxpy(&vec_dim, &g, &W[row2], &ONE, &dX[row1], &ONE)
+                db[W_key] = db[W_key] + g
+    return
+
+cdef void cy_hsm_ff_bp1(
+    const int sp_size, const UI32_t *sp_idx, const I64_t *code_offsets,
+    const UI32_t *code_keys, REAL_t *code_signs,
+    REAL_t *X, REAL_t *W, REAL_t *b,
+    REAL_t *dX, REAL_t *dW, REAL_t *db,
+    REAL_t *L, const int do_grad, const int vec_dim) nogil:
+
+    # declarations
+    cdef long long row1, row2, c_i
+    cdef REAL_t y, exp_pns_y, g, neg_label
+    cdef double L_pn, sig
+    cdef UI32_t X_key, W_key
+    cdef int sp_i
+
+    # update loop
+    for sp_i in range(sp_size):
+        X_key = sp_idx[sp_i]
+        row1 = X_key * vec_dim # get the starting index of input row (in X)
+        for c_i in range(code_offsets[X_key], code_offsets[X_key+1]):
+            W_key = code_keys[c_i]
+            row2 = W_key * vec_dim # get the starting index of code row (in W)
+            neg_label = -1.0 * code_signs[c_i] # minus the label
+            # compute prediction y as np.dot(X[X_key], W[W_key].T) + b[W_key]
+            y = <REAL_t>sdot(&vec_dim, &X[row1], &ONE, &W[row2], &ONE) + b[W_key]
+            if (USE_TABLE == 1):
+                L_pn = table_logistic(<REAL_t>(neg_label * y), &sig)
+            else:
+                exp_pns_y = <REAL_t>exp(neg_label * y) # this is used for loss/grad
+                L_pn = log(1.0 + exp_pns_y)
+                sig = exp_pns_y / (1.0 + exp_pns_y)
+            L[c_i] = L_pn # record the loss
+            if (do_grad == 1):
+                # Compute gradient and update gradient accumulators
+                g = neg_label * sig
+                saxpy(&vec_dim, &g, &X[row1], &ONE, &dW[row2], &ONE)
+                saxpy(&vec_dim, &g, &W[row2], &ONE, &dX[row1], &ONE)
+                db[W_key] = db[W_key] + g
+    return
+
+def hsm_ff_bp_pyx(sp_idx_p, X_p, code_offsets_p, code_keys_p, code_signs_p,
+                  W_p, b_p, dX_p, dW_p, db_p, L_p, do_grad_p):
+    # Define and cast minibatch problem parameters
+    cdef int sp_size = <int>sp_idx_p.shape[0]
+    cdef int do_grad = <int>do_grad_p
+    cdef int vec_dim = <int>W_p.shape[1]
+    cdef UI32_t *sp_idx = <UI32_t *>(np.PyArray_DATA(sp_idx_p))
+    cdef I64_t *code_offsets = <I64_t *>(np.PyArray_DATA(code_offsets_p))
+    cdef UI32_t *code_keys = <UI32_t *>(np.PyArray_DATA(code_keys_p))
+    cdef REAL_t *code_signs = <REAL_t *>(np.PyArray_DATA(code_signs_p))
+    cdef REAL_t *X = <REAL_t *>(np.PyArray_DATA(X_p))
+    cdef REAL_t *W = <REAL_t *>(np.PyArray_DATA(W_p))
+    cdef REAL_t *b = <REAL_t *>(np.PyArray_DATA(b_p))
+    cdef REAL_t *dX = <REAL_t *>(np.PyArray_DATA(dX_p))
+    cdef REAL_t *dW = <REAL_t *>(np.PyArray_DATA(dW_p))
+    cdef REAL_t *db = <REAL_t *>(np.PyArray_DATA(db_p))
+    cdef REAL_t *L = <REAL_t *>(np.PyArray_DATA(L_p))
+
+    with nogil:
+        cy_hsm_ff_bp(sp_size, sp_idx, code_offsets, code_keys, code_signs,
+                     X, W, b, dX, dW, db, L, do_grad, vec_dim)
+    return
+
+
 ################################
 # AUTO-CONTRASTIVE LAYER FF/BP #
 ################################
@@ -603,6 +790,7 @@ def init():
     """
     global cy_w2v_ff_bp
     global cy_nsl_ff_bp
+    global cy_hsm_ff_bp
     global cy_acl_ff_bp
 
     cdef float *x = [<float>10.0]
@@ -618,11 +806,13 @@ def init():
     if (abs(d_res - expected) < 0.0001):
         cy_w2v_ff_bp = cy_w2v_ff_bp0
         cy_nsl_ff_bp = cy_nsl_ff_bp0
+        cy_hsm_ff_bp = cy_hsm_ff_bp0
         cy_acl_ff_bp = cy_acl_ff_bp0
         return 0  # double
     elif (abs(p_res[0] - expected) < 0.0001):
         cy_w2v_ff_bp = cy_w2v_ff_bp1
         cy_nsl_ff_bp = cy_nsl_ff_bp1
+        cy_hsm_ff_bp = cy_hsm_ff_bp1
         cy_acl_ff_bp = cy_acl_ff_bp1
         return 1  # float
     else:
@@ -1,24 +1,19 @@
+import itertools
+from collections import Counter
+
 import numpy as np
 import numpy.random as npr
 
+from CorpusUtils import flatten_phrases, FlatCorpusWriter
+
 
 def make_key_dicts(word_list, min_freq=2, unk_word='*UNK*'):
     """Make word-to-key and key-to words dicts from word_list."""
+    # count in bulk with a Counter, rather than one dict lookup per word
     if type(word_list[0]) == type([]):
-        word_hist = {}
-        for phrase in word_list:
-            for w in phrase:
-                if not w in word_hist:
-                    word_hist[w] = 1
-                else:
-                    word_hist[w] += 1
+        word_hist = Counter(itertools.chain.from_iterable(word_list))
     else:
-        word_hist = {}
-        for w in word_list:
-            if not w in word_hist:
-                word_hist[w] = 1
-            else:
-                word_hist[w] += 1
+        word_hist = Counter(word_list)
     kept_words = [w for w in word_hist if (word_hist[w] >= min_freq)]
     w2k = {}
     k2w = {}
@@ -227,6 +222,9 @@ def LoadSTB(tree_dir, min_freq=2, use_all_words=False):
     assigned to words which appear at least min_freq times in full phrases from
     the training set. All other words will be assigned a LUT key associated
     with the word/token '*UNK*'.
+
+    The phrase collections are returned as FlatCorpus objects (see
+    CorpusUtils), which index like lists of np.uint32 arrays.
     """
     # Parse the tree text files
     stbp = STBParser(tree_dir, min_freq=min_freq, use_all_words=use_all_words)
@@ -267,12 +265,12 @@ def LoadSTB(tree_dir, min_freq=2, use_all_words=False):
         dataset['test_full_labels'].append(lutis_and_labels[1][-1])
         dataset['test_phrases'].extend(lutis_and_labels[0])
         dataset['test_labels'].extend(lutis_and_labels[1])
-    # Convert to np.uint32 (which we always use for LUT keys)
+    # Convert to flat np.uint32 storage (we always use np.uint32 LUT keys)
     for set_str in ['train', 'dev', 'test']:
         s = '{0:s}_full_phrases'.format(set_str)
-        dataset[s] = [np.array(p).astype(np.uint32) for p in dataset[s]]
+        dataset[s] = flatten_phrases(dataset[s])
         s = '{0:s}_phrases'.format(set_str)
-        dataset[s] = [np.array(p).astype(np.uint32) for p in dataset[s]]
+        dataset[s] = flatten_phrases(dataset[s])
     return dataset
 
 def parse_1bwords_file(f_name):
@@ -281,7 +279,16 @@ def parse_1bwords_file(f_name):
     txt_phrases = [p for p in txt_phrases if len(p) > 2]
     return txt_phrases
 
-def Load1BWords(data_dir='./training_text', file_count=100, min_freq=5):
+def Load1BWords(data_dir='./training_text', file_count=100, min_freq=5, \
+                corpus_file=None):
+    """
+    Load (part of) the "1 Billion Words..." corpus, with its phrases converted
+    to LUT keys and split 80/20 into training and validation parts, which are
+    returned as FlatCorpus objects (see CorpusUtils).
+
+    If corpus_file is given, the converted phrases are written to the on-disk
+    FlatCorpus format under that name, and the returned parts are memmapped.
+    """
     import os
     # Get the list of relevant files in the given directory
     txt_files = [f for f in os.listdir(data_dir) if (f.find('news.en-') > -1)]
@@ -293,9 +300,16 @@ def Load1BWords(data_dir='./training_text', file_count=100, min_freq=5):
        txt_phrases.extend(parse_1bwords_file("{0:s}/{1:s}".format(data_dir, txt_files[i])))
     # Make dicts for words -> LUT keys and LUT keys -> words
     w2k, k2w = make_key_dicts(txt_phrases, min_freq=min_freq, unk_word='*UNK*')
-    # Create LUT key representations of each phrase
-    lk_phrases = [[(w2k[w] if (w in w2k) else w2k['*UNK*']) for w in p] for p in txt_phrases]
-    lk_phrases = [np.asarray(p).astype(np.uint32) for p in lk_phrases]
+    # Create LUT key representations of each phrase, in flat storage
+    unk_key = w2k['*UNK*']
+    if corpus_file is None:
+        lk_phrases = flatten_phrases([[w2k.get(w, unk_key) for w in p] \
+                                      for p in txt_phrases])
+    else:
+        writer = FlatCorpusWriter(corpus_file)
+        for p in txt_phrases:
+            writer.add([w2k.get(w, unk_key) for w in p])
+        lk_phrases = writer.close()
     # Partition the dataset into training and validation parts
     split_idx = (4 * len(lk_phrases)) // 5
     dataset = {}
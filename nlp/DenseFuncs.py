@@ -0,0 +1,104 @@
+from __future__ import absolute_import
+
+import numpy as np
+
+from KernelBackends import lut_bp
+from LogisticTables import get_logistic_table, table_logistic
+
+MAX_HSM_KEY = 12345678
+DENSE_BLOCK_BYTES = 2**22 # max bytes of gathered target rows per block
+
+###############################################
+# BATCHED DENSE VERSIONS OF THE FF/BP KERNELS #
+###############################################
+
+# These have the same interface as nsl_ff_bp/w2v_ff_bp in the kernel
+# backends, but work on blocks of examples at once. The target rows for a
+# block are gathered once into a (block, targets, dim) array, the scores and
+# input gradients come from batched matrix-vector products, and the row
+# gradients are scatter-added into the grad tables by the backend's lut_bp
+# (which handles repeated rows). Blocks hold as many examples as fit in
+# DENSE_BLOCK_BYTES of gathered rows, which bounds the temp memory and keeps
+# the gathered rows in cache. The params can be plain float32 arrays or
+# HalfTables (see HalfStorage).
+#
+# Whether this beats the scalar kernels depends on the backend, the vector
+# dim and the targets per example; see KernelBench.run_dense_crossover().
+
+def _logistic_ff_bp(y, sign):
+    """Get the loss and the gradient w.r.t. y of log(1 + exp(-sign * y)).
+
+    This uses the current logistic table, if one is set.
+    """
+    table, z_max, inv_step = get_logistic_table()
+    if (table.size > 0):
+        L, sig = table_logistic((-sign * y), table, z_max, inv_step)
+        return [L, (-sign * sig).astype(np.float32)]
+    sy = sign * y
+    L = np.logaddexp(0.0, -sy).astype(np.float32)
+    g = (-sign / (1.0 + np.exp(np.minimum(sy, 80.0)))).astype(np.float32)
+    return [L, g]
+
+def _scatter_rows(keys, rows, dW):
+    """Add rows[i] into dW[keys[i]], for 1d or 2d dW."""
+    keys = np.ascontiguousarray(keys, dtype=np.uint32).ravel()
+    rows = np.ascontiguousarray(rows, dtype=np.float32)
+    rows = rows.reshape((keys.size, -1))
+    lut_bp(keys, rows, dW.reshape((dW.shape[0], -1)))
+    return
+
+def _blocks(pn_keys, vec_dim):
+    """Get (start, end) for the blocks of examples to process together."""
+    ex_bytes = 4 * pn_keys.shape[1] * vec_dim
+    block_size = max(1, (DENSE_BLOCK_BYTES // ex_bytes))
+    ex_count = pn_keys.shape[0]
+    return [(s, min(ex_count, s+block_size)) for s in \
+            range(0, ex_count, block_size)]
+
+def w2v_ff_bp(anc_keys, pn_keys, pn_sign, Wa, Wc, b, dWa, dWc, db, L, do_grad):
+    """Batched feedforward and backprop for unified word-2-vec layer."""
+    for (s, e) in _blocks(pn_keys, Wa.shape[1]):
+        _w2v_block(anc_keys[s:e], pn_keys[s:e], pn_sign[s:e], Wa, Wc, b, \
+                   dWa, dWc, db, L, do_grad)
+    return 1
+
+def _w2v_block(anc_keys, pn_keys, pn_sign, Wa, Wc, b, dWa, dWc, db, L, \
+               do_grad):
+    A = Wa[anc_keys]
+    C = Wc[pn_keys]
+    y = np.matmul(C, A[:,:,np.newaxis])[:,:,0] + b[pn_keys]
+    L_pn, g = _logistic_ff_bp(y, pn_sign)
+    L[0] += np.sum(L_pn)
+    if (do_grad == 1):
+        _scatter_rows(pn_keys, g, db)
+        _scatter_rows(anc_keys, np.matmul(g[:,np.newaxis,:], C)[:,0,:], dWa)
+        _scatter_rows(pn_keys, (g[:,:,np.newaxis] * A[:,np.newaxis,:]), dWc)
+    return 1
+
+def nsl_ff_bp(pn_keys, pn_sign, X, W, b, dX, dW, db, L, do_grad):
+    """Batched feedforward and backprop for NSLayer.
+
+    Keys >= MAX_HSM_KEY mark padding, and are skipped.
+    """
+    for (s, e) in _blocks(pn_keys, X.shape[1]):
+        _nsl_block(pn_keys[s:e], pn_sign[s:e], X[s:e], W, b, dX[s:e], \
+                   dW, db, L[s:e], do_grad)
+    return 1
+
+def _nsl_block(pn_keys, pn_sign, X, W, b, dX, dW, db, L, do_grad):
+    is_pad = (pn_keys >= MAX_HSM_KEY)
+    has_pad = np.any(is_pad)
+    if has_pad:
+        pn_keys = np.where(is_pad, 0, pn_keys).astype(np.uint32)
+    C = W[pn_keys]
+    y = np.matmul(C, X[:,:,np.newaxis])[:,:,0] + b[pn_keys]
+    L_pn, g = _logistic_ff_bp(y, pn_sign)
+    if has_pad:
+        L_pn[is_pad] = 0.0
+        g[is_pad] = 0.0
+    L[:,:] = L_pn
+    if (do_grad == 1):
+        dX += np.matmul(g[:,np.newaxis,:], C)[:,0,:]
+        _scatter_rows(pn_keys, g, db)
+        _scatter_rows(pn_keys, (g[:,:,np.newaxis] * X[:,np.newaxis,:]), dW)
+    return 1
@@ -0,0 +1,346 @@
+from __future__ import absolute_import
+
+import time
+import math
+import numpy as np
+import numpy.random as npr
+import numba
+
+from CorpusUtils import fast_rand, make_rng_state
+
+####################################
+# HALF-PRECISION PARAMETER STORAGE #
+####################################
+
+# Embedding tables can be stored as 'float16' or 'bfloat16' instead of
+# 'float32', which halves the memory for each stored table. All compute stays
+# in float32: the kernel forwarders in KernelBackends gather the rows touched
+# by a call into compact float32 tables, run the usual float32 kernel on them,
+# and then round the updated rows back into storage.
+#
+# float16 keeps 10 mantissa bits, but only covers magnitudes in [6e-8, 65504]
+# (values beyond 65504 are saturated, and tiny values flush to 0). bfloat16
+# keeps the float32 exponent range, with 7 mantissa bits, and is stored here
+# as the top 16 bits of the float32 bit pattern (in a uint16 array).
+#
+# With stochastic rounding, a value rounds up or down with probability given
+# by its distance to the two neighbouring representable values. The rounding
+# is then unbiased, so small updates that would always be lost by rounding to
+# nearest still apply on average.
+
+HALF_DTYPES = {'float16': np.float16, 'bfloat16': np.uint16}
+STORAGE_TYPES = ('float32', 'float16', 'bfloat16')
+FP16_MAX = 65504.0
+FP16_MIN_NORMAL = 2.0**-14
+FP16_MIN_ULP = 2.0**-24
+CHUNK_ROWS = 4096 # rows per chunk for whole-table ops, to bound temp memory
+
+@numba.jit("void(f4[:], f4[:], u8[:])", nopython=True, nogil=True, cache=True)
+def fast_sround_fp16(X, Y, rng_state):
+    """Stochastically round the values in X to float16 values, stored in Y.
+
+    Each value is rounded to one of the two multiples of its float16 ulp
+    around it, so Y converts exactly to float16. X should be in range.
+    """
+    for i in range(X.shape[0]):
+        a = abs(X[i])
+        if a < FP16_MIN_NORMAL:
+            ulp = FP16_MIN_ULP
+        else:
+            ulp = math.ldexp(1.0, (math.frexp(a)[1] - 11))
+        u = fast_rand(rng_state, 0) * (1.0 / 2.0**63)
+        y = math.floor((a / ulp) + u) * ulp
+        Y[i] = -y if (X[i] < 0.0) else y
+    return
+
+@numba.jit("void(u4[:], u2[:], u8[:])", nopython=True, nogil=True, cache=True)
+def fast_sround_bf16(bits, B, rng_state):
+    """Stochastically round the float32 bit patterns in bits to bfloat16."""
+    for i in range(bits.shape[0]):
+        r = np.uint32(fast_rand(rng_state, 0) & 0xFFFF)
+        B[i] = np.uint16((bits[i] + r) >> np.uint32(16))
+    return
+
+def _pack_fp16(X, rng_state=None):
+    """Round float32 X to float16 (stochastically if rng_state is given)."""
+    X = np.clip(X, -FP16_MAX, FP16_MAX)
+    if rng_state is not None:
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        Y = np.zeros(X.shape, dtype=np.float32)
+        fast_sround_fp16(X.ravel(), Y.ravel(), rng_state)
+        X = Y
+    return X.astype(np.float16)
+
+def _pack_bf16(X, rng_state=None):
+    """Round float32 X to bfloat16 bits (stochastically if rng_state given)."""
+    bits = np.ascontiguousarray(X, dtype=np.float32).view(np.uint32)
+    if rng_state is not None:
+        B = np.zeros(bits.shape, dtype=np.uint16)
+        fast_sround_bf16(bits.ravel(), B.ravel(), rng_state)
+        return B
+    # round to nearest, with ties to even
+    bits = bits + (np.uint32(0x7FFF) + ((bits >> 16) & np.uint32(1)))
+    return (bits >> 16).astype(np.uint16)
+
+def _unpack_bf16(B):
+    """Expand bfloat16 bits in uint16 array B to float32."""
+    return (B.astype(np.uint32) << 16).view(np.float32)
+
+class HalfTable:
+    """A float32 table (1d or 2d) stored as float16 or bfloat16.
+
+    Indexing (e.g. T[rows] or T.take(rows, axis=0)) returns float32 copies of
+    the selected entries, and assignment (e.g. T[rows] = X) rounds X into
+    storage. np.asarray(T) gives the full table as float32.
+    """
+    def __init__(self, X, storage='float16', stochastic=False, seed=None):
+        assert (storage in HALF_DTYPES), \
+                "unknown half storage type: {0:s}".format(storage)
+        X = np.asarray(X, dtype=np.float32)
+        self.storage = storage
+        self.stochastic = stochastic
+        self.rng_state = make_rng_state(1, seed) if stochastic else None
+        self.data = np.zeros(X.shape, dtype=HALF_DTYPES[storage])
+        self.shape = X.shape
+        self.ndim = X.ndim
+        self.dtype = np.dtype(np.float32)
+        for s_idx in range(0, self.shape[0], CHUNK_ROWS):
+            e_idx = s_idx + CHUNK_ROWS
+            self[s_idx:e_idx] = X[s_idx:e_idx]
+        return
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def pack(self, X):
+        """Round float32 values X into this table's storage type."""
+        if self.storage == 'float16':
+            return _pack_fp16(X, self.rng_state)
+        return _pack_bf16(X, self.rng_state)
+
+    def unpack(self, H):
+        """Expand stored values H to float32."""
+        if self.storage == 'float16':
+            return H.astype(np.float32)
+        return _unpack_bf16(H)
+
+    def __getitem__(self, idx):
+        return self.unpack(self.data[idx])
+
+    def take(self, idx, axis=0):
+        assert (axis == 0)
+        return self.unpack(self.data.take(idx, axis=0))
+
+    def __setitem__(self, idx, X):
+        self.data[idx] = self.pack(np.asarray(X, dtype=np.float32))
+        return
+
+    def __array__(self, dtype=None, copy=None):
+        X = self.unpack(self.data)
+        return X if dtype is None else X.astype(dtype)
+
+    def __imul__(self, scale):
+        """Scale the table in place, a chunk of rows at a time."""
+        for s_idx in range(0, self.shape[0], CHUNK_ROWS):
+            e_idx = s_idx + CHUNK_ROWS
+            self[s_idx:e_idx] = self[s_idx:e_idx] * scale
+        return self
+
+    def fill(self, value):
+        """Set every entry to value (rounded to nearest)."""
+        value = np.asarray([value], dtype=np.float32)
+        if self.storage == 'float16':
+            self.data.fill(_pack_fp16(value)[0])
+        else:
+            self.data.fill(_pack_bf16(value)[0])
+        return
+
+def wrap_half_data(H, storage, stochastic=False):
+    """Make a HalfTable that uses H (e.g. a memmap) as its stored values.
+
+    H should hold values already in storage form, e.g. the data of another
+    HalfTable. Nothing is copied or rounded.
+    """
+    assert (H.dtype == HALF_DTYPES[storage])
+    T = HalfTable.__new__(HalfTable)
+    T.storage = storage
+    T.stochastic = stochastic
+    T.rng_state = make_rng_state(1, None) if stochastic else None
+    T.data = H
+    T.shape = H.shape
+    T.ndim = H.ndim
+    T.dtype = np.dtype(np.float32)
+    return T
+
+def as_storage(X, storage='float32', stochastic=False):
+    """Get X as a table with the given storage type.
+
+    For 'float32' this is a plain float32 array, and otherwise a HalfTable.
+    X is returned as is if it already has the requested storage.
+    """
+    assert (storage in STORAGE_TYPES), \
+            "unknown storage type: {0:s}".format(storage)
+    if storage == 'float32':
+        if isinstance(X, HalfTable):
+            return np.asarray(X)
+        return X
+    if isinstance(X, HalfTable) and (X.storage == storage) and \
+            (X.stochastic == stochastic):
+        return X
+    return HalfTable(X, storage=storage, stochastic=stochastic)
+
+def store_tables(tables, storage='float32', stochastic=False):
+    """Convert each table in the dict tables to the given storage type."""
+    for name in tables:
+        tables[name] = as_storage(tables[name], storage, stochastic)
+    return
+
+def layer_bytes(layer):
+    """Get the bytes held by a layer's params, grads and moms."""
+    info = {}
+    for group in ('params', 'grads', 'moms'):
+        tables = getattr(layer, group)
+        info[group] = sum(tables[name].nbytes for name in tables)
+    # packed grads (see PackedGrads) are kept apart from the grads dict
+    stores = getattr(layer, 'grad_stores', {})
+    info['grads'] += sum(stores[name].nbytes for name in stores)
+    info['total'] = info['params'] + info['grads'] + info['moms']
+    return info
+
+##################################
+# RUNNING KERNELS ON HALF TABLES #
+##################################
+
+# For each ff/bp kernel: (key_arg, param_args, grad_args) for each set of keys
+# into the tables, i.e. the rows of args[param_args] and args[grad_args] used
+# by a call are given by the keys in args[key_arg]. These match the scatter
+# specs in CythonFuncs.
+HALF_SPECS = { \
+    'w2v_ff_bp': ((0, (3,), (6,)), (1, (4, 5), (7, 8))), \
+    'nsl_ff_bp': ((0, (3, 4), (6, 7)),), \
+    'hsm_ff_bp': ((2, (4, 5), (7, 8)),)}
+UPDATE_KERNELS = ('ag_update_2d', 'ag_update_1d')
+
+def has_half_tables(args):
+    """Check if any of args is a HalfTable."""
+    for arg in args:
+        if isinstance(arg, HalfTable):
+            return True
+    return False
+
+def _half_ff_bp(kernel, args, spec):
+    """Run an ff/bp kernel on float32 copies of the rows it touches.
+
+    Keys are remapped to slots in compact tables holding just the touched
+    rows, and the compact grads are then added into the full grads. Keys
+    beyond the end of the tables (e.g. padding keys) pass through unchanged.
+    """
+    args = list(args)
+    grad_sums = []
+    for (key_arg, param_args, grad_args) in spec:
+        keys = args[key_arg]
+        row_count = args[grad_args[0]].shape[0]
+        flat_keys = keys.ravel()
+        in_table = (flat_keys < row_count)
+        rows, slots = np.unique(flat_keys[in_table], return_inverse=True)
+        slot_keys = flat_keys.copy()
+        slot_keys[in_table] = slots
+        args[key_arg] = slot_keys.reshape(keys.shape)
+        for p_arg in param_args:
+            args[p_arg] = np.ascontiguousarray(args[p_arg][rows])
+        for g_arg in grad_args:
+            G = args[g_arg]
+            args[g_arg] = np.zeros(((rows.size,) + G.shape[1:]), dtype=G.dtype)
+            grad_sums.append((G, rows, args[g_arg]))
+    result = kernel(*args)
+    for (G, rows, G_rows) in grad_sums:
+        G[rows] += G_rows
+    return result
+
+def _half_ag_update(kernel, args):
+    """Run an ag_update kernel on float32 copies of the rows it updates."""
+    row_idx, W, dW, mW, learn_rate = args
+    if row_idx.size == 0:
+        return 1
+    W_rows = np.ascontiguousarray(W[row_idx])
+    dW_rows = np.ascontiguousarray(dW[row_idx])
+    mW_rows = np.ascontiguousarray(mW[row_idx])
+    slot_idx = np.arange(row_idx.size, dtype=np.uint32)
+    result = kernel(slot_idx, W_rows, dW_rows, mW_rows, learn_rate)
+    W[row_idx] = W_rows
+    mW[row_idx] = mW_rows
+    dW[row_idx] = 0.0
+    return result
+
+def run_half_kernel(kernel_name, kernel, args):
+    """Run a kernel from KernelBackends on args that include HalfTables."""
+    if kernel_name in UPDATE_KERNELS:
+        return _half_ag_update(kernel, args)
+    assert (kernel_name in HALF_SPECS), \
+            "{0:s} does not support half storage".format(kernel_name)
+    return _half_ff_bp(kernel, args, HALF_SPECS[kernel_name])
+
+#######################################
+# MEMORY AND ACCURACY OF HALF STORAGE #
+#######################################
+
+def _train_w2v(storage, stochastic, batches, test_batches, word_count, \
+               word_dim, learn_rate, seed):
+    """Train a W2VLayer with the given storage, and get its held-out loss."""
+    from NLMLayers import W2VLayer
+    npr.seed(seed)
+    layer = W2VLayer(max_word_key=(word_count - 1), word_dim=word_dim)
+    layer.init_params(0.05)
+    layer.set_storage(storage, stochastic)
+    t1 = time.time()
+    for (anc_keys, pos_keys, neg_keys) in batches:
+        layer.batch_train(anc_keys, pos_keys, neg_keys, learn_rate=learn_rate)
+    t2 = time.time()
+    L = 0.0
+    for (anc_keys, pos_keys, neg_keys) in test_batches:
+        L += layer.batch_test(anc_keys, pos_keys, neg_keys)
+    L = L / sum(b[0].size for b in test_batches)
+    return [layer_bytes(layer), L, (t2 - t1)]
+
+def storage_report(word_count=20000, word_dim=100, batch_count=300, \
+                   batch_size=500, neg_count=8, learn_rate=0.02, seed=1):
+    """Compare memory use and held-out loss for each storage type.
+
+    This trains a W2VLayer on a synthetic skip-gram task (words in the same
+    cluster of 50 co-occur) from the same initialization and batches, for
+    each storage type, and prints bytes held by the layer and its loss per
+    example on held-out batches.
+    """
+    rs = npr.RandomState(seed)
+    def draw_batch():
+        anc_keys = rs.randint(0, word_count, size=(batch_size,))
+        pos_keys = ((anc_keys // 50) * 50) + \
+                   rs.randint(0, 50, size=(batch_size,))
+        pos_keys = np.minimum(pos_keys, (word_count - 1))
+        neg_keys = rs.randint(0, word_count, size=(batch_size, neg_count))
+        return [k.astype(np.uint32) for k in (anc_keys, pos_keys, neg_keys)]
+    batches = [draw_batch() for i in range(batch_count)]
+    test_batches = [draw_batch() for i in range(20)]
+    configs = [('float32', False), ('float16', False), ('float16', True), \
+               ('bfloat16', False), ('bfloat16', True)]
+    results = []
+    for (storage, stochastic) in configs:
+        info, L, secs = _train_w2v(storage, stochastic, batches, test_batches, \
+                                   word_count, word_dim, learn_rate, seed)
+        results.append((storage, stochastic, info, L, secs))
+    base_bytes = results[0][2]['total']
+    base_L = results[0][3]
+    print("storage   stoch  total MB  saved MB  test loss    change  train s")
+    for (storage, stochastic, info, L, secs) in results:
+        print(("{0:9s} {1:5s} {2:9.1f} {3:9.1f} {4:10.5f} {5:+9.5f} " + \
+               "{6:8.2f}").format(storage, str(stochastic), \
+              (info['total'] / 1e6), ((base_bytes - info['total']) / 1e6), \
+              L, (L - base_L), secs))
+    return results
+
+if __name__ == '__main__':
+    storage_report()
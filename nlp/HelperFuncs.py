@@ -4,6 +4,8 @@ import numpy as np
 import numpy.random as npr
 import numba
 
+from CorpusUtils import flatten_phrases, PhraseSampler
+
 ###########################
 # GENERATE TYPED MATRICES #
 ###########################
@@ -17,6 +19,277 @@ def ones(shape, dtype=np.float32):
 def zeros(shape, dtype=np.float32):
     return np.zeros(shape, dtype=dtype)
 
+###########################
+# TOUCHED-ROW BOOKKEEPING #
+###########################
+
+@numba.jit("i8(u4[:], u1[:], u4[:], i8)", nopython=True, nogil=True, cache=True)
+def fast_mark_rows(keys, flags, row_list, row_count):
+    """Flag the rows in keys, appending newly flagged rows to row_list.
+
+    Keys >= flags.size (e.g. padding keys) are ignored. Returns the new
+    number of rows in row_list.
+    """
+    max_key = flags.shape[0]
+    for i in range(keys.shape[0]):
+        key = keys[i]
+        if (key < max_key) and (flags[key] == 0):
+            flags[key] = 1
+            row_list[row_count] = key
+            row_count += 1
+    return row_count
+
+@numba.jit("void(u4[:], u1[:])", nopython=True, nogil=True, cache=True)
+def fast_clear_rows(row_list, flags):
+    """Unflag the rows in row_list."""
+    for i in range(row_list.shape[0]):
+        flags[row_list[i]] = 0
+    return
+
+class RowTracker:
+    """Track which rows of a parameter table have pending gradients.
+
+    Keeps a flag per row plus a compact list of the flagged rows, in the
+    order they were first touched. Marking a batch of keys costs one pass
+    over the keys, and clearing only touches the listed rows, so there is
+    no sorting or set-building per batch. The list from rows() can go
+    straight to ag_update_2d/ag_update_1d, which handle rows in any order.
+    """
+    def __init__(self, row_count):
+        self.flags = np.zeros((row_count,), dtype=np.uint8)
+        self.row_list = np.zeros((row_count,), dtype=np.uint32)
+        self.row_count = 0
+        return
+
+    def __len__(self):
+        return self.row_count
+
+    def mark(self, keys):
+        """Flag the rows given by keys (any shape) as touched."""
+        keys = np.ascontiguousarray(keys, dtype=np.uint32).ravel()
+        self.row_count = fast_mark_rows(keys, self.flags, self.row_list, \
+                                        self.row_count)
+        return
+
+    def mark_all(self):
+        """Flag every row as touched."""
+        self.flags.fill(1)
+        self.row_list[:] = np.arange(self.flags.size, dtype=np.uint32)
+        self.row_count = self.flags.size
+        return
+
+    def rows(self):
+        """Get the touched rows, as a uint32 array (a view, not a copy)."""
+        return self.row_list[0:self.row_count]
+
+    def clear(self):
+        """Unflag all touched rows."""
+        fast_clear_rows(self.rows(), self.flags)
+        self.row_count = 0
+        return
+
+def fill_rows(tables, rows, value):
+    """Set the given rows of each table to value, in place.
+
+    If rows is None, this fills the whole of each table. Tables can be
+    float32 arrays or HalfTables.
+    """
+    for W in tables:
+        if rows is None:
+            W.fill(value)
+        elif isinstance(W, np.ndarray):
+            W[rows] = value
+        else:
+            W[rows] = np.full(((len(rows),) + W.shape[1:]), value, \
+                              dtype=np.float32)
+    return
+
+#################
+# LAZY L2 DECAY #
+#################
+
+@numba.jit("i8(u4[:], f8[:], f8, u4[:], f4[:])", nopython=True, nogil=True, \
+           cache=True)
+def fast_stale_rows(keys, row_logs, log_scale, stale_rows, stale_scales):
+    """Find the rows in keys with decay pending, and mark them up to date.
+
+    Each stale row goes into stale_rows once, with its pending scale in
+    stale_scales. Keys >= row_logs.size (e.g. padding keys) are ignored.
+    Returns the number of stale rows.
+    """
+    max_key = row_logs.shape[0]
+    stale_count = 0
+    for i in range(keys.shape[0]):
+        key = keys[i]
+        if (key < max_key) and (row_logs[key] != log_scale):
+            stale_rows[stale_count] = key
+            stale_scales[stale_count] = np.exp(log_scale - row_logs[key])
+            row_logs[key] = log_scale
+            stale_count += 1
+    return stale_count
+
+class LazyDecay:
+    """Apply l2 regularization (i.e. weight decay) to table rows lazily.
+
+    Rather than scaling a whole table by (1 - lam) for each decay, this adds
+    log(1 - lam) to a running total, and each row records the total as of
+    its last update. A row's pending decay is applied when sync() is called
+    with its key (i.e. just before the row is next read), or for all rows by
+    flush(). So, the cost of a decay is O(1), and the cost of bringing rows
+    up to date is O(touched rows). The rows end up as they would with eager
+    decay, up to float32 rounding (one multiply per row instead of one per
+    decay). The same decays apply to all tables passed to sync()/flush(),
+    which should all have one row per key (e.g. a layer's W and b). If a
+    RowTracker is given as watcher, rows get marked in it when scaled.
+    """
+    def __init__(self, row_count, watcher=None):
+        self.log_scale = 0.0
+        self.row_logs = np.zeros((row_count,), dtype=np.float64)
+        self.stale_rows = np.zeros((row_count,), dtype=np.uint32)
+        self.stale_scales = np.zeros((row_count,), dtype=np.float32)
+        self.watcher = watcher
+        return
+
+    def decay(self, lam):
+        """Scale all rows by (1 - lam), lazily."""
+        assert ((lam >= 0.0) and (lam < 1.0))
+        self.log_scale += np.log1p(-lam)
+        return
+
+    def row_scales(self):
+        """Get the pending scale for each row, as a float32 vector."""
+        return np.exp(self.log_scale - self.row_logs).astype(np.float32)
+
+    def sync(self, keys, tables):
+        """Apply the pending decay to the rows given by keys (any shape)."""
+        keys = np.ascontiguousarray(keys, dtype=np.uint32).ravel()
+        stale_count = fast_stale_rows(keys, self.row_logs, self.log_scale, \
+                                      self.stale_rows, self.stale_scales)
+        if stale_count > 0:
+            rows = self.stale_rows[0:stale_count]
+            scales = self.stale_scales[0:stale_count]
+            for W in tables:
+                if W.ndim == 1:
+                    W[rows] = W[rows] * scales
+                else:
+                    W[rows] = W[rows] * scales[:,np.newaxis]
+            if self.watcher is not None:
+                self.watcher.mark(rows)
+        return
+
+    def flush(self, tables):
+        """Apply the pending decay to all rows."""
+        scales = self.row_scales()
+        if np.any(scales != 1.0):
+            for W in tables:
+                if W.ndim == 1:
+                    W[:] = np.asarray(W) * scales
+                else:
+                    W[:] = np.asarray(W) * scales[:,np.newaxis]
+            if self.watcher is not None:
+                self.watcher.mark(np.flatnonzero(scales != 1.0))
+        self.row_logs.fill(self.log_scale)
+        return
+
+    def reset(self):
+        """Forget any pending decay (e.g. after re-initializing the tables)."""
+        self.log_scale = 0.0
+        self.row_logs.fill(0.0)
+        return
+
+#####################
+# ROW NORM CLIPPING #
+#####################
+
+@numba.jit("i8(u4[:], f4[:,::1], f4, u4[:])", nopython=True, nogil=True, \
+           cache=True)
+def fast_clip_rows(rows, W, max_norm, clipped):
+    """Scale the given rows of W that have L2 norm > max_norm, in place.
+
+    A row with norm n > max_norm is scaled by max_norm / sqrt(n^2 + 1e-5).
+    The positions (in rows) of the scaled rows go into clipped. Returns the
+    number of scaled rows.
+    """
+    max_sq = max_norm * max_norm
+    clip_count = 0
+    for i in range(rows.shape[0]):
+        r = rows[i]
+        sq = 0.0
+        for k in range(W.shape[1]):
+            sq += W[r,k] * W[r,k]
+        if sq > max_sq:
+            scale = max_norm / np.sqrt(sq + 1e-5)
+            for k in range(W.shape[1]):
+                W[r,k] = W[r,k] * scale
+            clipped[clip_count] = i
+            clip_count += 1
+    return clip_count
+
+def clip_row_norms(W, rows, max_norm):
+    """Bound the L2 norms of the given rows of W by max_norm, in place.
+
+    W can be a float32 array or a HalfTable. For a HalfTable, the rows are
+    gathered and only the ones that get scaled are written back. Returns
+    the scaled rows.
+    """
+    rows = np.ascontiguousarray(rows, dtype=np.uint32)
+    clipped = np.zeros(rows.shape, dtype=np.uint32)
+    if isinstance(W, np.ndarray):
+        clip_count = fast_clip_rows(rows, W, np.float32(max_norm), clipped)
+        clipped = clipped[0:clip_count]
+    else:
+        R = np.ascontiguousarray(W[rows], dtype=np.float32)
+        R_idx = np.arange(rows.size, dtype=np.uint32)
+        clip_count = fast_clip_rows(R_idx, R, np.float32(max_norm), clipped)
+        clipped = clipped[0:clip_count]
+        W[rows[clipped]] = R[clipped]
+    return rows[clipped]
+
+class RowClipper:
+    """Track which rows of a table need checking by the next norm clip.
+
+    After a clip, every row has norm <= max_norm, and a row can only go over
+    the bound again if it changes (decay only shrinks rows). So, checking
+    just the rows changed since the last clip with the same max_norm gives
+    the same result as checking all rows. Rows get marked as changed by
+    mark(), and dirty_rows() gives all rows if there was no clip yet, if
+    max_norm has changed, or after reset(). If a RowTracker is given as
+    watcher, rows passed to mark() or scaled by clip() get marked in it.
+    """
+    def __init__(self, row_count, watcher=None):
+        self.row_count = row_count
+        self.changed = RowTracker(row_count)
+        self.max_norm = None
+        self.watcher = watcher
+        return
+
+    def mark(self, keys):
+        """Mark the rows given by keys (any shape) as changed."""
+        self.changed.mark(keys)
+        if self.watcher is not None:
+            self.watcher.mark(keys)
+        return
+
+    def reset(self):
+        """Make the next clip check all rows (e.g. after re-initializing)."""
+        self.max_norm = None
+        return
+
+    def dirty_rows(self, max_norm):
+        """Get the rows that a clip with the given max_norm has to check."""
+        if self.max_norm != max_norm:
+            return np.arange(self.row_count, dtype=np.uint32)
+        return self.changed.rows()
+
+    def clip(self, W, rows, max_norm):
+        """Clip rows of W (from dirty_rows()), and start tracking anew."""
+        clipped = clip_row_norms(W, rows, max_norm)
+        if self.watcher is not None:
+            self.watcher.mark(clipped)
+        self.changed.clear()
+        self.max_norm = max_norm
+        return
+
 
 ################################
 # TRAINING DATA SAMPLING STUFF #
@@ -135,43 +408,27 @@ def rand_pos_neg(phrase_list, all_words, samp_count, context_size, neg_count):
     return [anchor_keys, pos_keys, neg_keys, phrase_keys]
 
 
-@numba.jit("void(i4[:], i8, i8, i8, i4[:], i4[:], i4[:], i4[:])")
-def fast_pair_sample(phrase, max_window, i, repeats, anc_keys, pos_keys, rand_pool, ri):
-    phrase_len = phrase.size
-    max_key_idx = anc_keys.shape[0]
-    for r in range(repeats):
-        j = i + r
-        a_idx = rand_pool[ri[0]] % phrase_len
-        ri[0] += 1
-        red_win = (rand_pool[ri[0]] % max_window) + 1
-        ri[0] += 1
-        c_min = a_idx - red_win
-        if (c_min < 0):
-            c_min = 0
-        c_max = a_idx + red_win
-        if (c_max >= phrase_len):
-            c_max = phrase_len - 1
-        c_span = c_max - c_min + 1
-        c_idx = a_idx
-        while (c_idx == a_idx):
-            c_idx = c_min + (rand_pool[ri[0]] % c_span)
-            ri[0] += 1
-        anc_keys[j] = phrase[a_idx]
-        pos_keys[j] = phrase[c_idx]
-    return
-
 class PNSampler:
     """This samples words from a corpus for training via negative sampling.
+
+    Positive pairs are drawn by a PhraseSampler that picks phrases uniformly
+    (rather than in proportion to their length). keep_probs/subsample_mode
+    set up frequent-word subsampling, as described for PhraseSampler.
     """
-    def __init__(self, phrase_list, all_words, max_window, neg_count):
-        # phrase_list contains the phrases to sample from 
-        self.phrase_list = phrase_list
-        self.phrase_lens = np.asarray([p.size for p in phrase_list])
+    def __init__(self, phrase_list, all_words, max_window, neg_count, \
+                 keep_probs=None, subsample_mode='fused'):
+        # phrase_list contains the phrases to sample from, either as a
+        # FlatCorpus or as a list of phrase arrays (which gets flattened)
+        self.phrase_list = flatten_phrases(phrase_list)
+        self.phrase_lens = self.phrase_list.phrase_lens()
         max_len = np.max(self.phrase_lens)
-        self.phrase_probs = np.asarray([pl/max_len for pl in self.phrase_lens])
+        self.phrase_probs = self.phrase_lens / float(max_len)
         self.phrase_count = len(self.phrase_list)
         #
         self.max_window = max_window
+        self.pair_sampler = PhraseSampler(self.phrase_list, max_window, \
+                max_phrase_key=self.phrase_count, keep_probs=keep_probs, \
+                subsample_mode=subsample_mode, by_length=False)
         # neg_table contains the words to sample as negative examples
         self.neg_table = all_words
         self.neg_table.reshape((self.neg_table.size,))
@@ -179,6 +436,16 @@ class PNSampler:
         self.neg_count = neg_count
         return
 
+    def reset_stats(self):
+        """Reset the counts used by subsample_report()."""
+        self.pair_sampler.reset_stats()
+        return
+
+    def subsample_report(self, sample_count=None, elapsed=None):
+        """See PhraseSampler.subsample_report()."""
+        return self.pair_sampler.subsample_report(sample_count=sample_count, \
+                                                  elapsed=elapsed)
+
     def sample_negatives(self, sample_count):
         neg_keys = np.zeros((sample_count,self.neg_count), dtype=np.uint32)
         neg_idx = npr.randint(0, high=self.neg_table_size, size=neg_keys.shape)
@@ -189,23 +456,10 @@ class PNSampler:
 
     def sample(self, sample_count):
         """Draw a sample."""
-        anc_keys = np.zeros((sample_count,), dtype=np.uint32)
-        pos_keys = np.zeros((sample_count,), dtype=np.uint32)
-        phrase_keys = np.zeros((sample_count,), dtype=np.uint32)
-        rand_pool = npr.randint(0, high=1e6, size=(10*sample_count,)).astype(np.uint32)
-        ri = np.asarray([0]).astype(np.uint32)
-        repeats = 5
-        if not ((sample_count % repeats) == 0):
-            repeats = 1
-        for i in range(0, sample_count, repeats):
-            phrase_keys[i] = npr.randint(0, high=self.phrase_count)
-            fast_pair_sample(self.phrase_list[phrase_keys[i]], self.max_window, \
-                             i, repeats, anc_keys, pos_keys, rand_pool, ri)
+        anc_keys, pos_keys, phrase_keys = \
+                self.pair_sampler.sample_pairs(sample_count)
         # Sample negative examples from self.neg_table
-        anc_keys = anc_keys.astype(np.uint32)
-        pos_keys = pos_keys.astype(np.uint32)
         neg_keys = self.sample_negatives(sample_count)
-        phrase_keys = phrase_keys.astype(np.uint32)
         return [anc_keys, pos_keys, neg_keys, phrase_keys]
 
 
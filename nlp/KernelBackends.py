@@ -0,0 +1,88 @@
+from __future__ import absolute_import
+
+import os
+import importlib
+
+from HalfStorage import has_half_tables, run_half_kernel
+
+########################################
+# RUNTIME SELECTION OF KERNEL BACKENDS #
+########################################
+
+# The layers in NLMLayers call the kernels below, which forward each call to
+# one of three backend modules with the same interface:
+#   'cython' -- CythonFuncs, compiled (once, then cached) by pyximport
+#   'numba'  -- NumbaFuncs, compiled by Numba and cached in __pycache__
+#   'numpy'  -- NumpyFuncs, slow, but needs no compiler
+# No backend is imported (and so nothing is compiled) until the first kernel
+# call. The backend is set via the environment variable NLP_KERNEL_BACKEND or
+# via set_backend(). The default, 'auto', uses the first backend in
+# AUTO_ORDER that loads. Calls with tables kept in half precision (see
+# HalfStorage) run the backend's float32 kernel on float32 copies of the
+# rows they touch.
+
+BACKEND_MODULES = {'cython': 'CythonFuncs', 'numba': 'NumbaFuncs', \
+                   'numpy': 'NumpyFuncs'}
+AUTO_ORDER = ('cython', 'numba', 'numpy')
+KERNEL_NAMES = ('w2v_ff_bp', 'nsl_ff_bp', 'hsm_ff_bp', 'lut_bp', \
+                'ag_update_2d', 'ag_update_1d')
+
+_BACKEND = {'requested': os.environ.get('NLP_KERNEL_BACKEND', 'auto'), \
+            'name': None, 'kernels': None}
+
+def set_backend(name='auto'):
+    """Set the kernel backend, to 'cython', 'numba', 'numpy' or 'auto'.
+
+    The backend is loaded on the next kernel call. Returns the previously
+    requested backend.
+    """
+    assert ((name == 'auto') or (name in BACKEND_MODULES)), \
+            "unknown kernel backend: {0:s}".format(name)
+    old_name = _BACKEND['requested']
+    _BACKEND['requested'] = name
+    _BACKEND['name'] = None
+    _BACKEND['kernels'] = None
+    return old_name
+
+def get_backend():
+    """Get the name of the kernel backend, loading it if needed."""
+    _load_backend()
+    return _BACKEND['name']
+
+def _load_backend():
+    """Import the requested backend module and grab its kernels."""
+    if _BACKEND['kernels'] is not None:
+        return _BACKEND['kernels']
+    requested = _BACKEND['requested']
+    names = AUTO_ORDER if (requested == 'auto') else (requested,)
+    for name in names:
+        try:
+            module = importlib.import_module(BACKEND_MODULES[name])
+        except Exception as e:
+            if (requested != 'auto'):
+                raise
+            print("kernel backend {0:s} unavailable ({1:s}: {2:s})".format( \
+                  name, type(e).__name__, str(e).split('\n')[0]))
+            continue
+        _BACKEND['name'] = name
+        _BACKEND['kernels'] = dict((k, getattr(module, k)) for k in KERNEL_NAMES)
+        return _BACKEND['kernels']
+    assert False, "no kernel backend could be loaded."
+    return None
+
+def _make_kernel(kernel_name):
+    """Make a function that forwards its call to the backend's kernel."""
+    def kernel(*args):
+        kernels = _BACKEND['kernels'] or _load_backend()
+        if has_half_tables(args):
+            return run_half_kernel(kernel_name, kernels[kernel_name], args)
+        return kernels[kernel_name](*args)
+    kernel.__name__ = kernel_name
+    return kernel
+
+w2v_ff_bp = _make_kernel('w2v_ff_bp')
+nsl_ff_bp = _make_kernel('nsl_ff_bp')
+hsm_ff_bp = _make_kernel('hsm_ff_bp')
+lut_bp = _make_kernel('lut_bp')
+ag_update_2d = _make_kernel('ag_update_2d')
+ag_update_1d = _make_kernel('ag_update_1d')
@@ -0,0 +1,394 @@
+from __future__ import absolute_import
+
+import sys
+import json
+import time
+import platform
+import importlib
+
+import numpy as np
+import numpy.random as npr
+
+import KernelPool
+import KernelBackends
+import DenseFuncs
+import LogisticTables
+from KernelPool import _time_calls
+from KernelBackends import BACKEND_MODULES
+
+############################
+# SPARSE KERNEL BENCHMARKS #
+############################
+
+# Each benchmark config sets the values below. A sweep varies one of them at
+# a time, keeping the others at their BENCH_DEFAULTS values. pn_size is the
+# number of targets per example (i.e. 1 + negatives for nsl/w2v, or the code
+# length for hsm), and skew says whether keys are drawn uniformly or from a
+# Zipf distribution over the vocab (as real word keys are).
+BENCH_DEFAULTS = {'batch_size': 2000, 'vec_dim': 128, 'pn_size': 10, \
+                  'vocab_size': 100000, 'skew': 'zipf', 'threads': 1}
+BENCH_SWEEPS = {'batch_size': [250, 1000, 4000, 16000], \
+                'vec_dim': [32, 128, 512], \
+                'pn_size': [5, 10, 20], \
+                'vocab_size': [10000, 100000, 500000], \
+                'skew': ['uniform', 'zipf'], \
+                'threads': [1, 2, 4]}
+CONFIG_KEYS = ['batch_size', 'vec_dim', 'pn_size', 'vocab_size', 'skew', 'threads']
+
+# kernels with the shared backend interface, plus the Numba-only split
+# feedforward/backprop kernels for NSLayer
+BACKEND_KERNELS = ['w2v_ff_bp', 'nsl_ff_bp', 'hsm_ff_bp', 'lut_bp', \
+                   'ag_update_2d', 'ag_update_1d']
+NUMBA_KERNELS = ['nsl_ff', 'nsl_bp']
+
+def draw_keys(shape, vocab_size, skew, rs):
+    """Draw uint32 keys in [0, vocab_size), uniformly or Zipf-distributed."""
+    if skew == 'uniform':
+        return rs.randint(0, vocab_size, shape).astype(np.uint32)
+    cdf = np.cumsum(1.0 / np.arange(1, vocab_size+1))
+    keys = np.searchsorted(cdf, rs.rand(*shape) * cdf[-1])
+    return np.minimum(keys, vocab_size-1).astype(np.uint32)
+
+def make_problem(cfg, seed=1):
+    """Make the inputs for all kernels, for the given benchmark config."""
+    rs = npr.RandomState(seed)
+    N, D, K, V = cfg['batch_size'], cfg['vec_dim'], cfg['pn_size'], cfg['vocab_size']
+    p = {}
+    p['X'] = (0.1 * rs.randn(N, D)).astype(np.float32)
+    p['dX'] = np.zeros((N, D), dtype=np.float32)
+    p['W'] = (0.1 * rs.randn(V, D)).astype(np.float32)
+    p['Wc'] = (0.1 * rs.randn(V, D)).astype(np.float32)
+    p['dW'] = np.zeros((V, D), dtype=np.float32)
+    p['dWc'] = np.zeros((V, D), dtype=np.float32)
+    p['mW'] = np.ones((V, D), dtype=np.float32)
+    p['b'] = np.zeros((V,), dtype=np.float32)
+    p['db'] = np.zeros((V,), dtype=np.float32)
+    p['mb'] = np.ones((V,), dtype=np.float32)
+    p['anc_keys'] = draw_keys((N,), V, cfg['skew'], rs)
+    p['pn_keys'] = draw_keys((N, K), V, cfg['skew'], rs)
+    p['pn_sign'] = -1.0 * np.ones((N, K), dtype=np.float32)
+    p['pn_sign'][:,0] = 1.0
+    p['L_pn'] = np.zeros((N, K), dtype=np.float32)
+    p['L_1'] = np.zeros((1,), dtype=np.float32)
+    p['code_offsets'] = (K * np.arange(N+1)).astype(np.int64)
+    p['code_keys'] = p['pn_keys'].ravel()
+    p['code_signs'] = np.sign(rs.randn(N*K)).astype(np.float32)
+    p['L_code'] = np.zeros((N*K,), dtype=np.float32)
+    p['dLdY'] = (0.1 * rs.randn(N, D)).astype(np.float32)
+    p['dLdY_pn'] = (0.1 * rs.randn(N, K)).astype(np.float32)
+    p['Y_pn'] = np.zeros((N, K), dtype=np.float32)
+    p['update_rows'] = np.unique(p['pn_keys'])
+    return p
+
+def kernel_call(kf, name, p):
+    """Get a no-arg function that runs kernel name from module kf on p."""
+    if name == 'w2v_ff_bp':
+        return lambda: kf.w2v_ff_bp(p['anc_keys'], p['pn_keys'], p['pn_sign'], \
+                p['W'], p['Wc'], p['b'], p['dW'], p['dWc'], p['db'], p['L_1'], 1)
+    if name == 'nsl_ff_bp':
+        return lambda: kf.nsl_ff_bp(p['pn_keys'], p['pn_sign'], p['X'], p['W'], \
+                p['b'], p['dX'], p['dW'], p['db'], p['L_pn'], 1)
+    if name == 'hsm_ff_bp':
+        return lambda: kf.hsm_ff_bp(p['X'], p['code_offsets'], p['code_keys'], \
+                p['code_signs'], p['W'], p['b'], p['dX'], p['dW'], p['db'], \
+                p['L_code'], 1)
+    if name == 'lut_bp':
+        return lambda: kf.lut_bp(p['anc_keys'], p['dLdY'], p['dW'])
+    if name == 'ag_update_2d':
+        return lambda: kf.ag_update_2d(p['update_rows'], p['W'], p['dW'], \
+                p['mW'], np.float32(1e-3))
+    if name == 'ag_update_1d':
+        return lambda: kf.ag_update_1d(p['update_rows'], p['b'], p['db'], \
+                p['mb'], np.float32(1e-3))
+    # the Numba-only kernels take int32 keys
+    keys = p['pn_keys'].astype(np.int32)
+    if name == 'nsl_ff':
+        return lambda: kf.nsl_ff(keys, p['X'], p['W'], p['b'], p['Y_pn'])
+    if name == 'nsl_bp':
+        return lambda: kf.nsl_bp(keys, p['X'], p['W'], p['dLdY_pn'], p['dX'], \
+                p['dW'], p['db'])
+    assert False, "unknown kernel: {0:s}".format(name)
+    return None
+
+def kernel_work(name, cfg, p):
+    """Get the examples and (approximate) bytes of table traffic per call.
+
+    Each row read counts D*4 bytes and each row update (read + write) counts
+    2*D*4 bytes, ignoring bias terms. For the adagrad updates, an "example"
+    is one updated row, which reads and writes W, dW and mW.
+    """
+    N, K = cfg['batch_size'], cfg['pn_size']
+    row = 4.0 * cfg['vec_dim']
+    if name in ['w2v_ff_bp', 'nsl_ff_bp', 'hsm_ff_bp']:
+        # per example: read X (or Wa), update dX (or dWa)
+        # per target: read W, update dW
+        return [N, N * (3.0 * row) + N * K * (3.0 * row)]
+    if name == 'nsl_ff':
+        return [N, N * row + N * K * row]
+    if name == 'nsl_bp':
+        return [N, N * (3.0 * row) + N * K * (3.0 * row)]
+    if name == 'lut_bp':
+        return [N, N * (3.0 * row)]
+    R = p['update_rows'].shape[0]
+    if name == 'ag_update_2d':
+        return [R, R * (6.0 * row)]
+    return [R, R * 6.0 * 4.0]
+
+def load_backends(backends=None):
+    """Import the named backend modules, skipping any that fail to load."""
+    names = sorted(BACKEND_MODULES.keys()) if backends is None else backends
+    modules = {}
+    for name in names:
+        try:
+            modules[name] = importlib.import_module(BACKEND_MODULES[name])
+        except Exception as e:
+            print("skipping backend {0:s} ({1:s})".format(name, type(e).__name__))
+    return modules
+
+def bench_configs(sweeps=None):
+    """Get the list of configs covered by one-at-a-time sweeps."""
+    sweeps = BENCH_SWEEPS if sweeps is None else sweeps
+    configs = [dict(BENCH_DEFAULTS)]
+    for key in CONFIG_KEYS:
+        for val in sweeps.get(key, []):
+            cfg = dict(BENCH_DEFAULTS)
+            cfg[key] = val
+            if cfg not in configs:
+                configs.append(cfg)
+    return configs
+
+def run_bench(backends=None, kernels=None, sweeps=None, out_file=None, \
+              min_secs=0.25):
+    """Time each kernel on each backend for each config in the sweeps.
+
+    Returns a list of result dicts, which is also written to out_file (as
+    JSON) if given. Timings on the 'numpy' backend ignore the thread count.
+    """
+    modules = load_backends(backends)
+    kernels = BACKEND_KERNELS + NUMBA_KERNELS if kernels is None else kernels
+    old_threads = KernelPool.get_thread_num()
+    results = []
+    print("{0:s} {1:s} {2:>7s} {3:>4s} {4:>3s} {5:>7s} {6:>7s} {7:>2s} {8:>12s} {9:>7s}".format( \
+          "kernel".ljust(12), "backend".ljust(7), "batch", "dim", "pn", "vocab", \
+          "skew", "th", "examples/s", "GB/s"))
+    for cfg in bench_configs(sweeps):
+        KernelPool.set_thread_num(cfg['threads'])
+        p = make_problem(cfg)
+        for name in kernels:
+            for be_name in sorted(modules.keys()):
+                kf = modules[be_name]
+                if not hasattr(kf, name):
+                    continue
+                if (be_name == 'numpy') and (cfg['threads'] > 1):
+                    continue
+                secs = _time_calls(kernel_call(kf, name, p), min_secs)
+                examples, byte_count = kernel_work(name, cfg, p)
+                res = dict(cfg)
+                res['kernel'] = name
+                res['backend'] = be_name
+                res['secs_per_call'] = secs
+                res['examples_per_sec'] = examples / secs
+                res['gb_per_sec'] = byte_count / secs / 1e9
+                results.append(res)
+                print("{0:s} {1:s} {2:7d} {3:4d} {4:3d} {5:7d} {6:>7s} {7:2d} {8:12.0f} {9:7.2f}".format( \
+                      name.ljust(12), be_name.ljust(7), cfg['batch_size'], \
+                      cfg['vec_dim'], cfg['pn_size'], cfg['vocab_size'], \
+                      cfg['skew'], cfg['threads'], res['examples_per_sec'], \
+                      res['gb_per_sec']))
+        p = None
+    KernelPool.set_thread_num(old_threads)
+    if out_file is not None:
+        save_results(results, out_file)
+    return results
+
+def save_results(results, out_file):
+    """Write benchmark results, and some info about this machine, as JSON."""
+    info = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), \
+            'python': platform.python_version(), \
+            'machine': platform.machine(), 'numpy': np.__version__}
+    with open(out_file, 'w') as f:
+        json.dump({'info': info, 'results': results}, f, indent=1, sort_keys=True)
+    print("wrote {0:d} results to {1:s}".format(len(results), out_file))
+    return
+
+def load_results(in_file):
+    """Load benchmark results written by save_results."""
+    with open(in_file) as f:
+        results = json.load(f)['results']
+    return results
+
+def _result_key(res):
+    return tuple([res['kernel'], res['backend']] + [res[k] for k in CONFIG_KEYS])
+
+def compare_results(results, baseline, tolerance=0.1):
+    """Compare results against baseline results (lists or JSON file names).
+
+    Prints the speed ratio (new / baseline examples/sec) for each timing
+    found in both, flagging those that are more than tolerance slower or
+    faster. Returns a list of (result key, ratio).
+    """
+    if not isinstance(results, list):
+        results = load_results(results)
+    if not isinstance(baseline, list):
+        baseline = load_results(baseline)
+    base_speeds = dict((_result_key(r), r['examples_per_sec']) for r in baseline)
+    ratios = []
+    slower = 0
+    for res in results:
+        key = _result_key(res)
+        if key not in base_speeds:
+            continue
+        ratio = res['examples_per_sec'] / base_speeds[key]
+        ratios.append((key, ratio))
+        flag = ''
+        if ratio < (1.0 - tolerance):
+            flag = '  SLOWER'
+            slower += 1
+        elif ratio > (1.0 + tolerance):
+            flag = '  faster'
+        print("{0:s} {1:6.2f}x{2:s}".format(str(key).ljust(72), ratio, flag))
+    if len(ratios) > 0:
+        log_ratios = np.log([r for k, r in ratios])
+        print("{0:d} timings compared, geometric mean ratio {1:.3f}, {2:d} slower".format( \
+              len(ratios), np.exp(np.mean(log_ratios)), slower))
+    return ratios
+
+#############################
+# DENSE VS SCALAR CROSSOVER #
+#############################
+
+DENSE_KERNELS = ['nsl_ff_bp', 'w2v_ff_bp']
+CROSSOVER_PN_SIZES = [5, 10, 20, 50]
+CROSSOVER_VEC_DIMS = [32, 128, 512]
+
+def run_dense_crossover(backends=None, kernels=None, pn_sizes=None, \
+                        vec_dims=None, min_secs=0.25):
+    """Time the scalar and dense (see DenseFuncs) ff/bp kernels.
+
+    For each backend, kernel and vec_dim, this times both versions at each
+    pn_size (other config values are from BENCH_DEFAULTS), and reports the
+    smallest pn_size at which the dense version is faster. The dense kernels
+    scatter their row grads via the backend's lut_bp, so KernelBackends is
+    set to each backend in turn. Returns a list of result dicts.
+    """
+    modules = load_backends(backends)
+    kernels = DENSE_KERNELS if kernels is None else kernels
+    pn_sizes = CROSSOVER_PN_SIZES if pn_sizes is None else pn_sizes
+    vec_dims = CROSSOVER_VEC_DIMS if vec_dims is None else vec_dims
+    old_backend = KernelBackends.get_backend()
+    old_threads = KernelPool.get_thread_num()
+    KernelPool.set_thread_num(BENCH_DEFAULTS['threads'])
+    results = []
+    print("{0:s} {1:s} {2:>4s} {3:>3s} {4:>10s} {5:>10s} {6:>6s}".format( \
+          "kernel".ljust(12), "backend".ljust(7), "dim", "pn", "scalar ms", \
+          "dense ms", "ratio"))
+    for be_name in sorted(modules.keys()):
+        KernelBackends.set_backend(be_name)
+        for name in kernels:
+            for vec_dim in vec_dims:
+                crossover = None
+                for pn_size in pn_sizes:
+                    cfg = dict(BENCH_DEFAULTS)
+                    cfg['vec_dim'] = vec_dim
+                    cfg['pn_size'] = pn_size
+                    p = make_problem(cfg)
+                    s_secs = _time_calls(kernel_call(modules[be_name], name, p), \
+                                         min_secs)
+                    d_secs = _time_calls(kernel_call(DenseFuncs, name, p), \
+                                         min_secs)
+                    if (d_secs < s_secs) and (crossover is None):
+                        crossover = pn_size
+                    res = dict(cfg)
+                    res['kernel'] = name
+                    res['backend'] = be_name
+                    res['scalar_secs'] = s_secs
+                    res['dense_secs'] = d_secs
+                    results.append(res)
+                    print("{0:s} {1:s} {2:4d} {3:3d} {4:10.2f} {5:10.2f} {6:6.2f}".format( \
+                          name.ljust(12), be_name.ljust(7), vec_dim, pn_size, \
+                          (1e3 * s_secs), (1e3 * d_secs), (s_secs / d_secs)))
+                print("{0:s} {1:s} {2:4d} dense wins from pn_size: {3:s}".format( \
+                      name.ljust(12), be_name.ljust(7), vec_dim, \
+                      ('never' if crossover is None else str(crossover))))
+    KernelBackends.set_backend(old_backend)
+    KernelPool.set_thread_num(old_threads)
+    return results
+
+###############################
+# LOGISTIC TABLE VS EXACT EXP #
+###############################
+
+TABLE_KERNELS = ['w2v_ff_bp', 'nsl_ff_bp', 'hsm_ff_bp']
+TABLE_VEC_DIMS = [32, 128, 300]
+TABLE_LOSS_KEYS = {'nsl_ff_bp': 'L_pn', 'hsm_ff_bp': 'L_code'}
+
+def run_table_bench(backends=None, kernels=None, vec_dims=None, \
+                    z_max=LogisticTables.TABLE_Z_MAX, \
+                    bins=LogisticTables.TABLE_BINS, min_secs=0.25):
+    """Time the ff/bp kernels with exact and table-driven softplus/sigmoid.
+
+    For each backend, kernel and vec_dim (other config values are from
+    BENCH_DEFAULTS), this reports ns/example with exact exp/log and with a
+    logistic table (see LogisticTables), and the max error in the per-target
+    losses from the table, which should be within the softplus bound from
+    LogisticTables.table_error_bounds(). Returns a list of result dicts.
+    """
+    modules = load_backends(backends)
+    kernels = TABLE_KERNELS if kernels is None else kernels
+    vec_dims = TABLE_VEC_DIMS if vec_dims is None else vec_dims
+    old_z_max, old_bins = LogisticTables.get_table_config()
+    old_threads = KernelPool.get_thread_num()
+    KernelPool.set_thread_num(BENCH_DEFAULTS['threads'])
+    sp_bound = LogisticTables.table_error_bounds(z_max, bins)[0]
+    results = []
+    print("softplus error bound: {0:.2e}".format(sp_bound))
+    print("{0:s} {1:s} {2:>4s} {3:>9s} {4:>9s} {5:>7s} {6:>9s}".format( \
+          "kernel".ljust(12), "backend".ljust(7), "dim", "exact ns", \
+          "table ns", "speedup", "loss err"))
+    for be_name in sorted(modules.keys()):
+        for name in kernels:
+            for vec_dim in vec_dims:
+                cfg = dict(BENCH_DEFAULTS)
+                cfg['vec_dim'] = vec_dim
+                p = make_problem(cfg)
+                func = kernel_call(modules[be_name], name, p)
+                loss_key = TABLE_LOSS_KEYS.get(name, None)
+                LogisticTables.use_exact_logistic()
+                e_secs = _time_calls(func, min_secs)
+                L_exact = None if loss_key is None else p[loss_key].copy()
+                LogisticTables.set_logistic_table(z_max, bins)
+                t_secs = _time_calls(func, min_secs)
+                loss_err = np.nan if loss_key is None else \
+                           np.max(np.abs(p[loss_key] - L_exact))
+                res = dict(cfg)
+                res['kernel'] = name
+                res['backend'] = be_name
+                res['exact_secs'] = e_secs
+                res['table_secs'] = t_secs
+                res['loss_err'] = float(loss_err)
+                results.append(res)
+                N = cfg['batch_size']
+                print("{0:s} {1:s} {2:4d} {3:9.1f} {4:9.1f} {5:7.2f} {6:9.2e}".format( \
+                      name.ljust(12), be_name.ljust(7), vec_dim, \
+                      (1e9 * e_secs / N), (1e9 * t_secs / N), \
+                      (e_secs / t_secs), loss_err))
+                assert (np.isnan(loss_err) or (loss_err <= sp_bound)), \
+                        "table loss error above bound"
+    LogisticTables.set_logistic_table(old_z_max, old_bins)
+    KernelPool.set_thread_num(old_threads)
+    return results
+
+if __name__ == '__main__':
+    # usage: python KernelBench.py [results.json [baseline.json]]
+    #    or: python KernelBench.py --crossover
+    #    or: python KernelBench.py --tables
+    if (len(sys.argv) > 1) and (sys.argv[1] == '--crossover'):
+        run_dense_crossover()
+        sys.exit(0)
+    if (len(sys.argv) > 1) and (sys.argv[1] == '--tables'):
+        run_table_bench()
+        sys.exit(0)
+    out_file = sys.argv[1] if (len(sys.argv) > 1) else 'kernel_bench.json'
+    results = run_bench(out_file=out_file)
+    if len(sys.argv) > 2:
+        compare_results(results, sys.argv[2])
@@ -0,0 +1,364 @@
+from __future__ import absolute_import
+
+import os
+import time
+import threading
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+import numpy as np
+
+#####################################
+# PERSISTENT POOL FOR KERNEL CHUNKS #
+#####################################
+
+# number of threads (including the caller) used by each kernel call, and the
+# fewest rows worth handing to a thread of their own. both can be set via the
+# environment or via set_thread_num() / set_min_chunk().
+THREAD_NUM = max(1, int(os.environ.get('NLP_THREAD_NUM', 4)))
+MIN_CHUNK = max(1, int(os.environ.get('NLP_MIN_CHUNK', 64)))
+
+# how kernels that scatter-add into shared gradient rows are run when split
+# across threads. 'hogwild' lets threads race on rows touched by more than one
+# chunk, while 'exact' keeps each row's sum race-free and deterministic. can be
+# set via the environment or via set_scatter_mode().
+SCATTER_MODES = ('hogwild', 'exact')
+SCATTER_MODE = os.environ.get('NLP_SCATTER_MODE', 'hogwild')
+assert (SCATTER_MODE in SCATTER_MODES), "bad NLP_SCATTER_MODE."
+
+class KernelPool(object):
+    """
+    Long-lived daemon threads that run chunks of GIL-releasing kernels.
+
+    A call to run() splits its work into chunks, queues all but the last one
+    for the pool and runs the last one in the calling thread, then waits for
+    the queued chunks to finish. Workers are started lazily and kept around,
+    so a kernel call costs a few queue hops rather than a thread start/join.
+    Errors raised in a worker are re-raised in the caller, and run() waits
+    for all queued chunks even when the caller's chunk fails. Kernels called
+    from inside a chunk (e.g. by chunks that each train on their own part
+    of a job, as in ContextInference) run unsplit, in the chunk's thread.
+    """
+    def __init__(self, thread_num):
+        self.tasks = Queue()
+        self.workers = []
+        self.worker_ids = set()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.thread_num = 1
+        self.resize(thread_num)
+        return
+
+    def resize(self, thread_num):
+        """Set the number of threads (incl. the caller) used per call."""
+        assert (thread_num >= 1), "thread_num must be >= 1."
+        with self.lock:
+            self.thread_num = thread_num
+            # stop extra workers, they exit after finishing queued chunks
+            while len(self.workers) > (thread_num - 1):
+                self.workers.pop()
+                self.tasks.put(None)
+        return
+
+    def _start_workers(self):
+        with self.lock:
+            while len(self.workers) < (self.thread_num - 1):
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+        return
+
+    def _work(self):
+        self.worker_ids.add(threading.current_thread().ident)
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            func, args, job = task
+            try:
+                func(*args)
+            except Exception as e:
+                job['error'] = e
+            with job['lock']:
+                job['left'] -= 1
+                if (job['left'] == 0):
+                    job['done'].set()
+        self.worker_ids.discard(threading.current_thread().ident)
+        return
+
+    def in_worker(self):
+        """Check if the current thread is running a chunk for this pool."""
+        return (threading.current_thread().ident in self.worker_ids) or \
+               getattr(self.local, 'in_chunk', False)
+
+    def run(self, func, chunk_args):
+        """Run func(*args) for each args in chunk_args, and wait for all."""
+        if (len(chunk_args) > 1) and self.in_worker():
+            # a kernel called from inside a chunk would deadlock the pool
+            for args in chunk_args:
+                func(*args)
+            return
+        if len(chunk_args) > 1:
+            self._start_workers()
+            job = {'left': len(chunk_args) - 1, 'error': None, \
+                   'lock': threading.Lock(), 'done': threading.Event()}
+            for args in chunk_args[:-1]:
+                self.tasks.put((func, args, job))
+        # the caller's chunk counts as being in the pool too, as its kernels
+        # would otherwise wait on workers that are busy with this job
+        was_in_chunk = getattr(self.local, 'in_chunk', False)
+        self.local.in_chunk = True
+        try:
+            func(*chunk_args[-1])
+        finally:
+            self.local.in_chunk = was_in_chunk
+            # don't leave (even on an error in the caller's chunk) while
+            # queued chunks may still be writing to the caller's arrays
+            if len(chunk_args) > 1:
+                job['done'].wait()
+        # errors in the caller's chunk take precedence over workers' errors
+        if (len(chunk_args) > 1) and (job['error'] is not None):
+            raise job['error']
+        return
+
+POOL = KernelPool(THREAD_NUM)
+
+def set_thread_num(thread_num):
+    """Set the number of threads used by all pooled kernel wrappers."""
+    global THREAD_NUM
+    THREAD_NUM = max(1, int(thread_num))
+    POOL.resize(THREAD_NUM)
+    return
+
+def get_thread_num():
+    """Get the number of threads used by pooled kernel wrappers."""
+    return THREAD_NUM
+
+def set_min_chunk(min_chunk):
+    """Set the fewest rows that get their own thread in a kernel call."""
+    global MIN_CHUNK
+    MIN_CHUNK = max(1, int(min_chunk))
+    return
+
+def set_scatter_mode(mode):
+    """Set scatter-add mode for pooled kernels, 'hogwild' or 'exact'."""
+    global SCATTER_MODE
+    assert (mode in SCATTER_MODES), "mode must be in {0:s}.".format(str(SCATTER_MODES))
+    SCATTER_MODE = mode
+    return
+
+def get_scatter_mode():
+    """Get scatter-add mode for pooled kernels."""
+    return SCATTER_MODE
+
+def chunk_bounds(length, max_chunks, min_chunk):
+    """Split range(length) into <= max_chunks pieces of >= min_chunk rows."""
+    chunk_count = max(1, min(max_chunks, length // min_chunk))
+    return np.linspace(0, length, chunk_count+1).astype(np.int64)
+
+_IDX_CACHE = {}
+
+def _sample_idx(length, idx_dtype):
+    """Get arange(length) as idx_dtype, reusing a cached array if possible."""
+    idx = _IDX_CACHE.get(idx_dtype)
+    if (idx is None) or (idx.shape[0] < length):
+        idx = np.arange(max(length, 1024)).astype(idx_dtype)
+        _IDX_CACHE[idx_dtype] = idx
+    return idx[0:length]
+
+#########################################
+# RACE-FREE SCATTER-ADD FOR SHARED ROWS #
+#########################################
+
+def _run_sorted(inner_func, args, key_arg, bounds, idx_dtype):
+    """Run a pure row scatter (e.g. lut_bp) with each thread owning a
+    disjoint range of destination rows.
+
+    Samples are stably sorted by destination row and the chunk bounds are
+    moved back to the start of a run of equal rows, so no row is split
+    across chunks. Each row then gets its updates in the original sample
+    order, which gives the same sums as a single-threaded call.
+    """
+    keys = args[key_arg]
+    order = np.argsort(keys, kind='mergesort').astype(idx_dtype)
+    sorted_keys = keys[order]
+    length = keys.shape[0]
+    inner = np.searchsorted(sorted_keys, sorted_keys[bounds[1:-1]], 'left')
+    bounds = np.unique(np.concatenate(([0], inner, [length])))
+    chunkargs = [(order[bounds[i]:bounds[i+1]],)+args \
+                 for i in range(bounds.shape[0]-1)]
+    POOL.run(inner_func, chunkargs)
+    return
+
+def _run_partial(inner_func, args, sp_idx, bounds, scatter, sums):
+    """Run a kernel with a private gradient buffer per chunk, then reduce.
+
+    Each entry of scatter is (key arg, param args, grad args), giving the
+    positions in args of an array of row keys, the params they read and
+    the grads they scatter-add into. Keys are remapped onto the set of
+    touched rows, so each chunk gets compact copies of the params and
+    zeroed grad buffers with one row per touched row. Keys beyond the
+    table size (e.g. padding keys, which kernels skip) are left as-is.
+    Args in sums (e.g. a shared loss accumulator) get a private copy per
+    chunk too. Partial results are added up in chunk order, so the result
+    does not depend on thread timing.
+    """
+    chunk_count = bounds.shape[0] - 1
+    chunk_args = [list(args) for i in range(chunk_count)]
+    reduce_jobs = []
+    for key_arg, param_args, grad_args in scatter:
+        keys = args[key_arg]
+        in_table = keys < args[grad_args[0]].shape[0]
+        rows, slots = np.unique(keys[in_table], return_inverse=True)
+        slot_keys = keys.copy()
+        slot_keys[in_table] = slots
+        for p_arg in param_args:
+            p_rows = args[p_arg][rows]
+            for c_args in chunk_args:
+                c_args[p_arg] = p_rows
+        for c_args in chunk_args:
+            c_args[key_arg] = slot_keys
+        for g_arg in grad_args:
+            g_shape = (rows.shape[0],) + args[g_arg].shape[1:]
+            partials = [np.zeros(g_shape, dtype=args[g_arg].dtype) \
+                        for i in range(chunk_count)]
+            for c_args, partial in zip(chunk_args, partials):
+                c_args[g_arg] = partial
+            reduce_jobs.append((args[g_arg], rows, partials))
+    for s_arg in sums:
+        partials = [np.zeros_like(args[s_arg]) for i in range(chunk_count)]
+        for c_args, partial in zip(chunk_args, partials):
+            c_args[s_arg] = partial
+        reduce_jobs.append((args[s_arg], None, partials))
+    chunkargs = [(sp_idx[bounds[i]:bounds[i+1]],)+tuple(chunk_args[i]) \
+                 for i in range(chunk_count)]
+    POOL.run(inner_func, chunkargs)
+    for target, rows, partials in reduce_jobs:
+        total = partials[0]
+        for partial in partials[1:]:
+            total += partial
+        if rows is None:
+            target += total
+        else:
+            target[rows] += total
+    return
+
+def make_multithread(inner_func, numthreads=None, idx_dtype=np.int32, \
+                     min_chunk=None, scatter=(), sums=(), sort_rows=False):
+    """Wrap inner_func(sp_idx, *args) to run chunks of len(args[0]) on POOL.
+
+    Calls use at most numthreads threads, or the current pool size if
+    numthreads is None, and use fewer threads when the batch has too few
+    rows to keep each thread busy for min_chunk rows (MIN_CHUNK if None).
+
+    scatter and sums describe the shared rows that inner_func scatter-adds
+    into (see _run_partial). When SCATTER_MODE is 'exact', multi-threaded
+    calls to such kernels are race-free: pure row scatters given with
+    sort_rows=True give each thread its own rows (see _run_sorted), and
+    other kernels use per-chunk partial buffers.
+    """
+    def func_mt(*args):
+        length = len(args[0])
+        sp_idx = _sample_idx(length, idx_dtype)
+        max_chunks = THREAD_NUM if numthreads is None \
+                     else min(numthreads, THREAD_NUM)
+        bounds = chunk_bounds(length, max_chunks, \
+                              MIN_CHUNK if min_chunk is None else min_chunk)
+        if (bounds.shape[0] > 2) and (len(scatter) > 0) and \
+           (SCATTER_MODE == 'exact'):
+            if sort_rows:
+                _run_sorted(inner_func, args, scatter[0][0], bounds, idx_dtype)
+            else:
+                _run_partial(inner_func, args, sp_idx, bounds, scatter, sums)
+            return 1
+        chunkargs = [(sp_idx[bounds[i]:bounds[i+1]],)+args \
+                     for i in range(bounds.shape[0]-1)]
+        POOL.run(inner_func, chunkargs)
+        return 1
+    def func_st(*args):
+        length = len(args[0])
+        sp_idx = _sample_idx(length, idx_dtype)
+        sp_args = (sp_idx,) + args
+        inner_func(*sp_args)
+        return 1
+    func = None
+    if numthreads == 1:
+        func = func_st
+    else:
+        func = func_mt
+    return func
+
+#############################
+# THREADING CROSSOVER BENCH #
+#############################
+
+def _spawn_call(inner_func, numthreads, args):
+    """Run a kernel the old way, starting fresh threads for every call."""
+    length = len(args[0])
+    sp_idx = np.arange(0,length).astype(np.int32)
+    chunklen = (length + (numthreads-1)) // numthreads
+    chunkargs = [(sp_idx[i*chunklen:(i+1)*chunklen],)+args for i in range(numthreads)]
+    threads = [threading.Thread(target=inner_func, args=cargs) \
+               for cargs in chunkargs[:-1]]
+    for thread in threads:
+        thread.start()
+    inner_func(*chunkargs[-1])
+    for thread in threads:
+        thread.join()
+    return
+
+def _time_calls(func, min_secs=0.2):
+    """Get the mean seconds per call to func(), over >= min_secs."""
+    func()
+    call_count = 0
+    t0 = time.time()
+    while True:
+        func()
+        call_count += 1
+        elapsed = time.time() - t0
+        if (elapsed >= min_secs):
+            break
+    return elapsed / call_count
+
+def run_crossover_bench(batch_sizes=(16, 64, 256, 1024, 4096, 16384), \
+                        vec_dim=100, neg_count=10, thread_num=4):
+    """Time NumbaFuncs.nsl_ff single-threaded, with fresh threads per call,
+    and on the persistent pool, for a range of batch sizes.
+
+    Returns a list of (batch size, st secs, spawn secs, pool secs) and the
+    smallest batch size at which the pool beat the single-threaded call.
+    """
+    import NumbaFuncs as nf
+    old_thread_num, old_min_chunk = THREAD_NUM, MIN_CHUNK
+    set_thread_num(thread_num)
+    set_min_chunk(1)
+    st_func = make_multithread(nf.nsl_ff_st, 1)
+    mt_func = make_multithread(nf.nsl_ff_st)
+    W = np.random.randn(50000, vec_dim).astype(np.float32)
+    b = np.zeros((50000,)).astype(np.float32)
+    results = []
+    crossover = None
+    print("batch_size    single    spawn     pool  (usecs/call, {0:d} threads)".format(thread_num))
+    for bs in batch_sizes:
+        X = np.random.randn(bs, vec_dim).astype(np.float32)
+        idx = np.random.randint(0, 50000, (bs, neg_count)).astype(np.int32)
+        Y = np.zeros((bs, neg_count)).astype(np.float32)
+        args = (idx, X, W, b, Y)
+        t_st = _time_calls(lambda: st_func(*args))
+        t_sp = _time_calls(lambda: _spawn_call(nf.nsl_ff_st, thread_num, args))
+        t_mt = _time_calls(lambda: mt_func(*args))
+        results.append((bs, t_st, t_sp, t_mt))
+        if (crossover is None) and (t_mt < t_st):
+            crossover = bs
+        print("{0:10d}  {1:8.1f} {2:8.1f} {3:8.1f}".format(bs, 1e6*t_st, \
+              1e6*t_sp, 1e6*t_mt))
+    print("pool beats single thread from batch size: {0:s}".format(str(crossover)))
+    set_thread_num(old_thread_num)
+    set_min_chunk(old_min_chunk)
+    return results, crossover
+
+if __name__ == '__main__':
+    run_crossover_bench()
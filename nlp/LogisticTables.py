@@ -0,0 +1,142 @@
+from __future__ import absolute_import
+
+import os
+import numpy as np
+
+###########################
+# LOGISTIC LOOK-UP TABLES #
+###########################
+
+# The ff/bp kernels for W2VLayer/NSLayer/HSMLayer get the loss and gradient
+# for each target from z = -sign * y, as L = softplus(z) = log(1 + exp(z))
+# and g = -sign * sigmoid(z). By default these are computed exactly, with an
+# exp() and a log() per target. With a logistic table set, all backends get
+# them from one shared table instead (like the EXP_TABLE in word2vec.c).
+#
+# The table holds softplus(z) and sigmoid(z) at bins+1 evenly spaced points
+# in [-z_max, z_max], interleaved, i.e. table[2*i] = softplus(z_i) and
+# table[2*i+1] = sigmoid(z_i). Lookups interpolate linearly between points.
+# Outside the range, softplus(z) = max(z, 0) and sigmoid(z) = (z > 0).
+#
+# Accuracy: with step h = 2 * z_max / bins, linear interpolation is within
+# (h^2 / 8) * max|f''| of f, where max|softplus''| = 1/4 and max|sigmoid''|
+# = 1 / (6 * sqrt(3)). Outside the range, both are within exp(-z_max). So:
+#   |softplus error| <= h^2 / 32 + exp(-z_max)
+#   |sigmoid error|  <= 0.0962 * h^2 / 8 + exp(-z_max)
+# plus float32 rounding (about 6e-8 relative). The defaults (z_max = 12,
+# 4096 bins, 32KB) give about 6.2e-6 for both, dominated by exp(-z_max).
+# check_table_accuracy() tests these bounds.
+
+TABLE_Z_MAX = 12.0
+TABLE_BINS = 4096
+SIGMOID_D2_MAX = 1.0 / (6.0 * np.sqrt(3.0))
+F32_SLACK = 2e-6 # allowance for float32 rounding of values up to ~z_max
+
+_EMPTY = np.zeros((0,), dtype=np.float32)
+_TABLE = {'table': _EMPTY, 'z_max': np.float32(0.0), \
+          'inv_step': np.float32(0.0), 'bins': 0}
+_LISTENERS = []
+
+def make_logistic_table(z_max=TABLE_Z_MAX, bins=TABLE_BINS):
+    """Make an interleaved softplus/sigmoid table (see above)."""
+    z = np.linspace(-z_max, z_max, (bins + 1))
+    table = np.zeros((2 * (bins + 1),), dtype=np.float32)
+    table[0::2] = np.logaddexp(0.0, z)
+    table[1::2] = 1.0 / (1.0 + np.exp(-z))
+    return table
+
+def set_logistic_table(z_max=TABLE_Z_MAX, bins=TABLE_BINS):
+    """Make all kernels use a logistic table with the given range and bins.
+
+    Setting bins to 0 goes back to exact computation.
+    """
+    assert ((bins == 0) or ((bins > 0) and (z_max > 0.0)))
+    if bins == 0:
+        _TABLE['table'] = _EMPTY
+        _TABLE['z_max'] = np.float32(0.0)
+        _TABLE['inv_step'] = np.float32(0.0)
+    else:
+        _TABLE['table'] = make_logistic_table(z_max, bins)
+        _TABLE['z_max'] = np.float32(z_max)
+        _TABLE['inv_step'] = np.float32(bins / (2.0 * z_max))
+    _TABLE['bins'] = bins
+    for listener in _LISTENERS:
+        listener(*get_logistic_table())
+    return
+
+def use_exact_logistic():
+    """Make all kernels compute softplus/sigmoid exactly (the default)."""
+    set_logistic_table(bins=0)
+    return
+
+def get_logistic_table():
+    """Get (table, z_max, inv_step) for the current table.
+
+    The table is empty when exact computation is in use.
+    """
+    return (_TABLE['table'], _TABLE['z_max'], _TABLE['inv_step'])
+
+def get_table_config():
+    """Get (z_max, bins) for the current table, with bins = 0 for exact."""
+    return (float(_TABLE['z_max']), _TABLE['bins'])
+
+def add_table_listener(listener):
+    """Call listener(table, z_max, inv_step) now, and on each table change.
+
+    This lets backends that keep their own pointer to the table (i.e. the
+    Cython kernels) stay in sync.
+    """
+    _LISTENERS.append(listener)
+    listener(*get_logistic_table())
+    return
+
+def table_error_bounds(z_max=TABLE_Z_MAX, bins=TABLE_BINS):
+    """Get the (softplus, sigmoid) absolute error bounds for a table."""
+    h = 2.0 * z_max / bins
+    clip_err = np.exp(-z_max)
+    sp_bound = (h**2.0 / 32.0) + clip_err + F32_SLACK
+    sg_bound = (SIGMOID_D2_MAX * h**2.0 / 8.0) + clip_err + F32_SLACK
+    return [sp_bound, sg_bound]
+
+def table_logistic(z, table, z_max, inv_step):
+    """Look up softplus(z) and sigmoid(z) for an array z, as the kernels do."""
+    z = np.asarray(z, dtype=np.float32)
+    t = (np.clip(z, -z_max, z_max) + z_max) * inv_step
+    i = np.minimum(t.astype(np.int64), ((table.size // 2) - 2))
+    f = (t - i).astype(np.float32)
+    sp = table[2*i] + f * (table[2*i+2] - table[2*i])
+    sg = table[2*i+1] + f * (table[2*i+3] - table[2*i+1])
+    sp = np.where((z >= z_max), z, np.where((z <= -z_max), 0.0, sp))
+    sg = np.where((z >= z_max), 1.0, np.where((z <= -z_max), 0.0, sg))
+    return [sp.astype(np.float32), sg.astype(np.float32)]
+
+def check_table_accuracy(z_max=TABLE_Z_MAX, bins=TABLE_BINS, \
+                         sample_count=1000000):
+    """Check the table lookups against float64 softplus/sigmoid.
+
+    The check covers z in [-2*z_max, 2*z_max], i.e. it includes values that
+    fall outside the table. Asserts that the errors are within the bounds
+    from table_error_bounds(), and returns the max errors.
+    """
+    table = make_logistic_table(z_max, bins)
+    inv_step = np.float32(bins / (2.0 * z_max))
+    z = np.linspace(-2.0 * z_max, 2.0 * z_max, sample_count)
+    z = np.concatenate([z, np.linspace(-z_max, z_max, (bins + 1))])
+    z = z.astype(np.float32)
+    sp, sg = table_logistic(z, table, np.float32(z_max), inv_step)
+    z64 = z.astype(np.float64)
+    sp_err = np.max(np.abs(sp - np.logaddexp(0.0, z64)))
+    sg_err = np.max(np.abs(sg - (1.0 / (1.0 + np.exp(-z64)))))
+    sp_bound, sg_bound = table_error_bounds(z_max, bins)
+    print("z_max: {0:.1f}, bins: {1:d}, softplus err: {2:.2e} (bound {3:.2e}), sigmoid err: {4:.2e} (bound {5:.2e})".format( \
+          z_max, bins, sp_err, sp_bound, sg_err, sg_bound))
+    assert (sp_err <= sp_bound), "softplus table error above bound"
+    assert (sg_err <= sg_bound), "sigmoid table error above bound"
+    return [sp_err, sg_err]
+
+if os.environ.get('NLP_LOGISTIC_TABLE', '0') == '1':
+    set_logistic_table()
+
+if __name__ == '__main__':
+    for (z_max, bins) in [(6.0, 1000), (8.0, 1024), (12.0, 4096), (16.0, 16384)]:
+        check_table_accuracy(z_max, bins)
@@ -1,30 +1,44 @@
 from __future__ import absolute_import
 
 # Imports of public stuff
+import time
 import numpy as np
 import numpy.random as npr
 import numexpr as ne
 
 # Imports of my stuff
-from HelperFuncs import randn, ones, zeros
-from CythonFuncs import w2v_ff_bp, nsl_ff_bp, lut_bp, \
-                        ag_update_2d, ag_update_1d, hsm_ff_bp
+from HelperFuncs import randn, ones, zeros, RowTracker, LazyDecay, \
+                        RowClipper, fill_rows
+from HalfStorage import store_tables
+from PackedGrads import PackedGrads, run_packed_kernel
+from KernelBackends import w2v_ff_bp, nsl_ff_bp, lut_bp, \
+                           ag_update_2d, ag_update_1d, hsm_ff_bp
+from DenseFuncs import w2v_ff_bp as dense_w2v_ff_bp, \
+                       nsl_ff_bp as dense_nsl_ff_bp
 
 # UH OH, GLOBAL PARAMS (TODO: GET RID OF THESE!)
 ADA_EPS = 1e-3
 MAX_HSM_KEY = 12345678
 
+# ff/bp kernels for NSLayer and W2VLayer, by mode (see set_ff_bp_mode())
+NSL_FF_BP = {'scalar': nsl_ff_bp, 'dense': dense_nsl_ff_bp}
+W2V_FF_BP = {'scalar': w2v_ff_bp, 'dense': dense_w2v_ff_bp}
+# ways to keep grads (see set_grad_storage())
+GRAD_STORAGE_TYPES = ('dense', 'packed')
+
 ###########################
 # NEGATIVE SAMPLING LAYER #
 ###########################
 
 class NSLayer:
-    def __init__(self, in_dim=0, max_out_key=0):
+    def __init__(self, in_dim=0, max_out_key=0, rand_init=True):
         # Record and initialize layer parameters
         self.dim_input = in_dim
         self.key_count = max_out_key + 1 # assume 0 is a key
         self.params = {}
-        self.params['W'] = 0.01 * randn((self.key_count, in_dim))
+        # (without rand_init, params start at 0, e.g. for loading them)
+        self.params['W'] = 0.01 * randn((self.key_count, in_dim)) \
+                if rand_init else zeros((self.key_count, in_dim))
         self.params['b'] = zeros((self.key_count,))
         self.grads = {}
         self.grads['W'] = zeros((self.key_count, in_dim))
@@ -38,25 +52,87 @@ class NSLayer:
         self.dLdX = []
         self.dLdY = []
         self.samp_keys = []
-        self.grad_idx = []
+        self.grad_rows = RowTracker(self.key_count)
+        # rows changed since the last checkpoint (see Checkpoints)
+        self.unsaved_rows = RowTracker(self.key_count)
+        self.decay = LazyDecay(self.key_count, self.unsaved_rows)
+        self.clipper = RowClipper(self.key_count, self.unsaved_rows)
+        self.storage = 'float32'
+        self.stochastic = False
+        self.ff_bp_mode = 'scalar'
+        self.grad_storage = 'dense'
+        self.grad_stores = {}
         return
 
     def init_params(self, w_scale=0.01, b_scale=0.0):
         """Randomly initialize the weights in this layer."""
         self.params['W'] = w_scale * randn((self.key_count, self.dim_input))
-        self.grads['W'] = zeros((self.key_count, self.dim_input))
         self.params['b'] = zeros((self.key_count,))
-        self.grads['b'] = zeros((self.key_count,))
+        self.set_grad_storage(self.grad_storage)
+        self.decay.reset()
+        self.set_storage(self.storage, self.stochastic)
+        return
+
+    def set_storage(self, storage='float32', stochastic=False):
+        """Store params and moms as 'float32', 'float16' or 'bfloat16'.
+
+        Grads stay float32, and all compute is done in float32. Stochastic
+        rounding is used when writing updated rows back to half storage if
+        stochastic is True. See HalfStorage.
+        """
+        self.storage = storage
+        self.stochastic = stochastic
+        store_tables(self.params, storage, stochastic)
+        store_tables(self.moms, storage, stochastic)
+        self._reset_clippers()
+        self.unsaved_rows.mark_all()
+        return
+
+    def set_ff_bp_mode(self, mode='scalar'):
+        """Set the ff/bp kernel to 'scalar' or 'dense'.
+
+        The 'dense' kernels (see DenseFuncs) gather target rows for blocks of
+        examples and use batched matrix-vector products. Run the crossover
+        benchmark in KernelBench to see which mode is faster on a machine.
+        """
+        assert (mode in NSL_FF_BP), "unknown ff/bp mode: {0:s}".format(mode)
+        self.ff_bp_mode = mode
+        return
+
+    def set_grad_storage(self, storage='dense'):
+        """Keep grads in 'dense' tables, or in a 'packed' store.
+
+        A packed store (see PackedGrads) holds grads for just the rows used
+        since the last apply_grad(), rather than a grad table as big as each
+        param table. Any pending grads are dropped.
+        """
+        assert (storage in GRAD_STORAGE_TYPES), \
+                "unknown grad storage: {0:s}".format(storage)
+        self.grad_storage = storage
+        self.grad_rows.clear()
+        if storage == 'dense':
+            self.grads = {'W': zeros((self.key_count, self.dim_input)), \
+                          'b': zeros((self.key_count,))}
+            self.grad_stores = {}
+        else:
+            self.grads = {}
+            self.grad_stores = {'W': PackedGrads(self.key_count, \
+                    [('W', (self.dim_input,)), ('b', ())])}
         return
 
     def clip_params(self, max_norm=5.0):
-        """Bound L2 (row-wise) norm of W by max_norm."""
-        M = self.params['W']
-        m_scales = max_norm / np.sqrt(np.sum(M**2.0,axis=1) + 1e-5)
-        mask = (m_scales < 1.0)
-        mask = mask.astype(np.float32) # why is explicit cast needed?
-        m_scales = (m_scales * mask) + (1.0 - mask)
-        self.params['W'] = M * m_scales[:,np.newaxis]
+        """Bound L2 (row-wise) norm of W by max_norm.
+
+        Only rows changed since the last clip are checked (see RowClipper).
+        """
+        rows = self.clipper.dirty_rows(max_norm)
+        self.decay.sync(rows, [self.params['W'], self.params['b']])
+        self.clipper.clip(self.params['W'], rows, max_norm)
+        return
+
+    def _reset_clippers(self):
+        """Make the next clip_params() check all rows."""
+        self.clipper.reset()
         return
 
     def ff_bp(self, X, pos_samples, neg_samples, do_grad=True):
@@ -81,49 +157,88 @@ class NSLayer:
         samp_keys = np.hstack((pos_samples, neg_samples))
         samp_sign = -1.0 * ones(samp_keys.shape)
         samp_sign[:,0] = 1.0
+        # apply any pending l2 decay to the rows we're about to use
+        self.decay.sync(samp_keys, [self.params['W'], self.params['b']])
         # do feedforward and backprop all in one go
         L = zeros(samp_keys.shape)
         dLdX = zeros(X.shape)
-        nsl_ff_bp(samp_keys, samp_sign, X, self.params['W'], self.params['b'], \
-                  dLdX, self.grads['W'], self.grads['b'], L, do_grad)
+        ff_bp_func = NSL_FF_BP[self.ff_bp_mode]
+        if self.grad_stores:
+            run_packed_kernel('nsl_ff_bp', ff_bp_func, (samp_keys, samp_sign, \
+                    X, self.params['W'], self.params['b'], dLdX, None, None, \
+                    L, do_grad), [self.grad_stores['W']], do_grad)
+        else:
+            ff_bp_func(samp_keys, samp_sign, X, self.params['W'], \
+                       self.params['b'], dLdX, self.grads['W'], \
+                       self.grads['b'], L, do_grad)
         # derp dorp
         L = np.sum(L)
-        if do_grad:
-            if len(self.grad_idx) == 0:
-                self.grad_idx = np.unique(samp_keys)
-            else:
-                self.grad_idx = np.unique(np.concatenate( \
-                        (self.grad_idx, np.unique(samp_keys)) ))
+        if do_grad and (not self.grad_stores):
+            self.grad_rows.mark(samp_keys)
         return [dLdX, L]
 
     def l2_regularize(self, lam_l2=1e-5):
-        """Add gradients for l2 regularization. And compute loss."""
-        self.params['W'] -= lam_l2 * self.params['W']
-        self.params['b'] -= lam_l2 * self.params['b']
+        """Scale W and b by (1 - lam_l2), lazily (see flush_decay())."""
+        self.decay.decay(lam_l2)
         return 1
 
+    def flush_decay(self):
+        """Apply any pending l2 decay to all rows of W and b.
+
+        Rows are otherwise decayed when next used, so call this before
+        reading the params directly (e.g. for eval or checkpoints).
+        """
+        self.decay.flush([self.params['W'], self.params['b']])
+        return
+
     def apply_grad(self, learn_rate=1e-2):
         """Apply the current accumulated gradients, with adagrad."""
-        nz_idx = self.grad_idx[self.grad_idx < self.key_count]
+        if self.grad_stores:
+            store = self.grad_stores['W']
+            store.ag_update('W', self.params['W'], self.moms['W'], learn_rate)
+            store.ag_update('b', self.params['b'], self.moms['b'], learn_rate)
+            self.clipper.mark(store.rows())
+            store.clear()
+            return
+        nz_idx = self.grad_rows.rows()
         ag_update_2d(nz_idx, self.params['W'], self.grads['W'], \
                      self.moms['W'], learn_rate)
         ag_update_1d(nz_idx, self.params['b'], self.grads['b'], \
                      self.moms['b'], learn_rate)
-        self.grad_idx = []
+        self.clipper.mark(nz_idx)
+        self.grad_rows.clear()
         return
 
-    def reset_moms(self, ada_init=1e-3):
-        """Reset the gradient accumulators for this layer."""
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
-        self.moms['b'] = (0.0 * self.moms['b']) + ada_init
+    def reset_moms(self, ada_init=1e-3, rows=None):
+        """Reset the adagrad moms, in place, for the given rows (or all)."""
+        fill_rows([self.moms['W'], self.moms['b']], rows, ada_init)
+        if rows is None:
+            self.unsaved_rows.mark_all()
+        else:
+            self.unsaved_rows.mark(rows)
         return
 
-    def reset_grads_and_moms(self, ada_init=1e-3):
-        """Reset the gradient accumulators for this layer."""
-        self.grads['W'] = (0.0 * self.grads['W'])
-        self.grads['b'] = (0.0 * self.grads['b'])
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
-        self.moms['b'] = (0.0 * self.moms['b']) + ada_init
+    def reset_grads(self, rows=None):
+        """Set the grads to 0, in place, for the given rows.
+
+        apply_grad() zeros the grads for the rows it updates, so only rows
+        with pending grads can be non-zero. With rows=None, this resets
+        just those rows, and drops them from the pending list.
+        """
+        if self.grad_stores:
+            self.grad_stores['W'].reset(rows)
+        elif rows is None:
+            fill_rows([self.grads['W'], self.grads['b']], \
+                      self.grad_rows.rows(), 0.0)
+            self.grad_rows.clear()
+        else:
+            fill_rows([self.grads['W'], self.grads['b']], rows, 0.0)
+        return
+
+    def reset_grads_and_moms(self, ada_init=1e-3, rows=None):
+        """Reset the grads and the adagrad moms, in place."""
+        self.reset_grads(rows)
+        self.reset_moms(ada_init, rows)
         return
 
     def _cleanup(self):
@@ -140,12 +255,14 @@ class NSLayer:
 #################################################
 
 class HSMLayer:
-    def __init__(self, in_dim=0, max_hs_key=0):
+    def __init__(self, in_dim=0, max_hs_key=0, rand_init=True):
         # Record and initialize some layer parameters
         self.dim_input = in_dim
         self.key_count = max_hs_key + 1 # assume 0 is a key
         self.params = {}
-        self.params['W'] = 0.01 * randn((self.key_count, in_dim))
+        # (without rand_init, params start at 0, e.g. for loading them)
+        self.params['W'] = 0.01 * randn((self.key_count, in_dim)) \
+                if rand_init else zeros((self.key_count, in_dim))
         self.params['b'] = zeros((self.key_count,))
         self.grads = {}
         self.grads['W'] = zeros((self.key_count, in_dim))
@@ -158,90 +275,198 @@ class HSMLayer:
         self.Y = []
         self.dLdX = []
         self.dLdY = []
-        self.grad_idx = []
+        self.grad_rows = RowTracker(self.key_count)
+        # rows changed since the last checkpoint (see Checkpoints)
+        self.unsaved_rows = RowTracker(self.key_count)
+        self.decay = LazyDecay(self.key_count, self.unsaved_rows)
+        self.clipper = RowClipper(self.key_count, self.unsaved_rows)
+        self.storage = 'float32'
+        self.stochastic = False
+        self.grad_storage = 'dense'
+        self.grad_stores = {}
         return
 
     def init_params(self, w_scale=0.01, b_scale=0.0):
         """Randomly initialize the weights in this layer."""
         self.params['W'] = w_scale * randn((self.key_count, self.dim_input))
-        self.grads['W'] = zeros((self.key_count, self.dim_input))
         self.params['b'] = zeros((self.key_count,))
-        self.grads['b'] = zeros((self.key_count,))
+        self.set_grad_storage(self.grad_storage)
+        self.decay.reset()
+        self.set_storage(self.storage, self.stochastic)
+        return
+
+    def set_storage(self, storage='float32', stochastic=False):
+        """Store params and moms as 'float32', 'float16' or 'bfloat16'.
+
+        Grads stay float32, and all compute is done in float32. Stochastic
+        rounding is used when writing updated rows back to half storage if
+        stochastic is True. See HalfStorage.
+        """
+        self.storage = storage
+        self.stochastic = stochastic
+        store_tables(self.params, storage, stochastic)
+        store_tables(self.moms, storage, stochastic)
+        self._reset_clippers()
+        self.unsaved_rows.mark_all()
+        return
+
+    def set_grad_storage(self, storage='dense'):
+        """Keep grads in 'dense' tables, or in a 'packed' store.
+
+        A packed store (see PackedGrads) holds grads for just the rows used
+        since the last apply_grad(), rather than a grad table as big as each
+        param table. Any pending grads are dropped.
+        """
+        assert (storage in GRAD_STORAGE_TYPES), \
+                "unknown grad storage: {0:s}".format(storage)
+        self.grad_storage = storage
+        self.grad_rows.clear()
+        if storage == 'dense':
+            self.grads = {'W': zeros((self.key_count, self.dim_input)), \
+                          'b': zeros((self.key_count,))}
+            self.grad_stores = {}
+        else:
+            self.grads = {}
+            self.grad_stores = {'W': PackedGrads(self.key_count, \
+                    [('W', (self.dim_input,)), ('b', ())])}
         return
 
     def clip_params(self, max_norm=5.0):
-        """Bound L2 (row-wise) norm of W by max_norm."""
-        M = self.params['W']
-        m_scales = max_norm / np.sqrt(np.sum(M**2.0,axis=1) + 1e-5)
-        mask = (m_scales < 1.0)
-        mask = mask.astype(np.float32) # why is explicit cast needed?
-        m_scales = (m_scales * mask) + (1.0 - mask)
-        self.params['W'] = M * m_scales[:,np.newaxis]
+        """Bound L2 (row-wise) norm of W by max_norm.
+
+        Only rows changed since the last clip are checked (see RowClipper).
+        """
+        rows = self.clipper.dirty_rows(max_norm)
+        self.decay.sync(rows, [self.params['W'], self.params['b']])
+        self.clipper.clip(self.params['W'], rows, max_norm)
+        return
+
+    def _reset_clippers(self):
+        """Make the next clip_params() check all rows."""
+        self.clipper.reset()
         return
 
-    def ff_bp(self, X, code_keys, code_signs, do_grad=True):
+    def ff_bp(self, X, code_keys, code_signs, do_grad=True, code_offsets=None):
         """Perform feedforward and then backprop for this layer.
 
         By setting do_grad to False, we can just compute the loss, without
         making modifications to the gradient accumulators (i.e. no backprop).
+
+        If code_offsets is given, the codes are in CSR form, i.e. code_keys
+        and code_signs are flat arrays and the codes for X[i] are in entries
+        code_offsets[i]:code_offsets[i+1] (see CorpusUtils.fetch_hsm_codes).
+        Otherwise, code_keys and code_signs are padded code matrices.
         """
         # check array types, to avoid "silent" type errors in Cython code
         assert(type(X[0,0]) == np.float32)
-        assert(type(code_keys[0,0]) == np.uint32)
-        assert(type(code_signs[0,0]) == np.float32)
+        assert(code_keys.dtype == np.uint32)
+        assert(code_signs.dtype == np.float32)
         # check for valid input shapes
         assert(X.shape[1] == self.params['W'].shape[1])
-        assert(code_keys.shape[0] == X.shape[0])
-        assert(code_signs.shape[0] == X.shape[0])
+        if code_offsets is None:
+            assert(code_keys.shape[0] == X.shape[0])
+            assert(code_signs.shape[0] == X.shape[0])
+        else:
+            assert(code_offsets.dtype == np.int64)
+            assert(code_offsets.size == (X.shape[0] + 1))
+            assert(code_keys.size == code_offsets[-1])
+            assert(code_signs.size == code_offsets[-1])
         # cleanup debris from any previous feedforward
         self._cleanup()
         # change from boolean to int, for Cython code
         do_grad = 1 if do_grad else 0
+        # apply any pending l2 decay to the rows we're about to use
+        self.decay.sync(code_keys, [self.params['W'], self.params['b']])
         # do feedforward and backprop all in one go
         dLdX = zeros(X.shape)
         L_cy = zeros(code_keys.shape)
-        hsm_ff_bp(code_keys, code_signs, X, self.params['W'], self.params['b'], \
-                  dLdX, self.grads['W'], self.grads['b'], L_cy, do_grad)
+        if code_offsets is None:
+            # padded codes use the same kernel as negative sampling, which
+            # skips keys > MAX_HSM_KEY
+            kernel_name, kernel = 'nsl_ff_bp', nsl_ff_bp
+            args = [code_keys, code_signs, X, self.params['W'], \
+                    self.params['b'], dLdX, self.grads.get('W'), \
+                    self.grads.get('b'), L_cy, do_grad]
+        else:
+            kernel_name, kernel = 'hsm_ff_bp', hsm_ff_bp
+            args = [X, code_offsets, code_keys, code_signs, \
+                    self.params['W'], self.params['b'], dLdX, \
+                    self.grads.get('W'), self.grads.get('b'), L_cy, do_grad]
+        if self.grad_stores:
+            run_packed_kernel(kernel_name, kernel, args, \
+                              [self.grad_stores['W']], do_grad)
+        else:
+            kernel(*args)
         L_cy_sum = np.sum(L_cy)
         L_cy_pre = L_cy_sum
         # Derp dorp
         L = L_cy_sum
-        if do_grad:
-            if len(self.grad_idx) == 0:
-                self.grad_idx = np.unique(code_keys)
-            else:
-                self.grad_idx = np.unique(np.concatenate( \
-                        (self.grad_idx, np.unique(code_keys)) ))
+        if do_grad and (not self.grad_stores):
+            self.grad_rows.mark(code_keys)
         return [dLdX, L]
 
     def l2_regularize(self, lam_l2=1e-5):
-        """Add gradients for l2 regularization. And compute loss."""
-        self.params['W'] -= lam_l2 * self.params['W']
-        self.params['b'] -= lam_l2 * self.params['b']
+        """Scale W and b by (1 - lam_l2), lazily (see flush_decay())."""
+        self.decay.decay(lam_l2)
         return 1
 
+    def flush_decay(self):
+        """Apply any pending l2 decay to all rows of W and b.
+
+        Rows are otherwise decayed when next used, so call this before
+        reading the params directly (e.g. for eval or checkpoints).
+        """
+        self.decay.flush([self.params['W'], self.params['b']])
+        return
+
     def apply_grad(self, learn_rate=1e-2):
         """Apply the current accumulated gradients, with adagrad."""
-        nz_idx = self.grad_idx[self.grad_idx < self.key_count]
+        if self.grad_stores:
+            store = self.grad_stores['W']
+            store.ag_update('W', self.params['W'], self.moms['W'], learn_rate)
+            store.ag_update('b', self.params['b'], self.moms['b'], learn_rate)
+            self.clipper.mark(store.rows())
+            store.clear()
+            return
+        nz_idx = self.grad_rows.rows()
         ag_update_2d(nz_idx, self.params['W'], self.grads['W'], \
                      self.moms['W'], learn_rate)
         ag_update_1d(nz_idx, self.params['b'], self.grads['b'], \
                      self.moms['b'], learn_rate)
-        self.grad_idx = []
+        self.clipper.mark(nz_idx)
+        self.grad_rows.clear()
         return
 
-    def reset_moms(self, ada_init=1e-3):
-        """Reset the gradient accumulators for this layer."""
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
-        self.moms['b'] = (0.0 * self.moms['b']) + ada_init
+    def reset_moms(self, ada_init=1e-3, rows=None):
+        """Reset the adagrad moms, in place, for the given rows (or all)."""
+        fill_rows([self.moms['W'], self.moms['b']], rows, ada_init)
+        if rows is None:
+            self.unsaved_rows.mark_all()
+        else:
+            self.unsaved_rows.mark(rows)
         return
 
-    def reset_grads_and_moms(self, ada_init=1e-3):
-        """Reset the gradient accumulators for this layer."""
-        self.grads['W'] = (0.0 * self.grads['W'])
-        self.grads['b'] = (0.0 * self.grads['b'])
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
-        self.moms['b'] = (0.0 * self.moms['b']) + ada_init
+    def reset_grads(self, rows=None):
+        """Set the grads to 0, in place, for the given rows.
+
+        apply_grad() zeros the grads for the rows it updates, so only rows
+        with pending grads can be non-zero. With rows=None, this resets
+        just those rows, and drops them from the pending list.
+        """
+        if self.grad_stores:
+            self.grad_stores['W'].reset(rows)
+        elif rows is None:
+            fill_rows([self.grads['W'], self.grads['b']], \
+                      self.grad_rows.rows(), 0.0)
+            self.grad_rows.clear()
+        else:
+            fill_rows([self.grads['W'], self.grads['b']], rows, 0.0)
+        return
+
+    def reset_grads_and_moms(self, ada_init=1e-3, rows=None):
+        """Reset the grads and the adagrad moms, in place."""
+        self.reset_grads(rows)
+        self.reset_moms(ada_init, rows)
         return
 
     def _cleanup(self):
@@ -257,18 +482,28 @@ class HSMLayer:
 #######################
 
 class LUTLayer:
-    def __init__(self, max_key, embed_dim, n_gram=1):
+    def __init__(self, max_key, embed_dim, n_gram=1, rand_init=True):
         # Set stuff for managing this type of layer
         self.key_count = max_key + 1 # add 1 to accommodate 0 indexing
         self.params = {}
-        self.params['W'] = 0.01 * randn((self.key_count, embed_dim))
+        # (without rand_init, params start at 0, e.g. for loading them)
+        self.params['W'] = 0.01 * randn((self.key_count, embed_dim)) \
+                if rand_init else zeros((self.key_count, embed_dim))
         self.grads = {}
         self.grads['W'] = zeros(self.params['W'].shape)
         self.moms = {}
         self.moms['W'] = zeros(self.params['W'].shape)
-        self.grad_idx = set()
+        self.grad_rows = RowTracker(self.key_count)
+        # rows changed since the last checkpoint (see Checkpoints)
+        self.unsaved_rows = RowTracker(self.key_count)
+        self.decay = LazyDecay(self.key_count, self.unsaved_rows)
+        self.clipper = RowClipper(self.key_count, self.unsaved_rows)
         self.embed_dim = embed_dim
         self.n_gram = n_gram
+        self.storage = 'float32'
+        self.stochastic = False
+        self.grad_storage = 'dense'
+        self.grad_stores = {}
         self.X = []
         self.Y = []
         return
@@ -276,17 +511,57 @@ class LUTLayer:
     def init_params(self, w_scale=0.01):
         """Randomly initialize the weights in this layer."""
         self.params['W'] = w_scale * randn((self.key_count, self.embed_dim))
-        self.grads['W'] = zeros((self.key_count, self.embed_dim))
+        self.set_grad_storage(self.grad_storage)
+        self.decay.reset()
+        self.set_storage(self.storage, self.stochastic)
+        return
+
+    def set_storage(self, storage='float32', stochastic=False):
+        """Store params and moms as 'float32', 'float16' or 'bfloat16'.
+
+        Grads stay float32, and all compute is done in float32. Stochastic
+        rounding is used when writing updated rows back to half storage if
+        stochastic is True. See HalfStorage.
+        """
+        self.storage = storage
+        self.stochastic = stochastic
+        store_tables(self.params, storage, stochastic)
+        store_tables(self.moms, storage, stochastic)
+        self._reset_clippers()
+        self.unsaved_rows.mark_all()
+        return
+
+    def set_grad_storage(self, storage='dense'):
+        """Keep grads in a 'dense' table, or in a 'packed' store.
+
+        See NSLayer.set_grad_storage(). Any pending grads are dropped.
+        """
+        assert (storage in GRAD_STORAGE_TYPES), \
+                "unknown grad storage: {0:s}".format(storage)
+        self.grad_storage = storage
+        self.grad_rows.clear()
+        if storage == 'dense':
+            self.grads = {'W': zeros((self.key_count, self.embed_dim))}
+            self.grad_stores = {}
+        else:
+            self.grads = {}
+            self.grad_stores = {'W': PackedGrads(self.key_count, \
+                                                 [('W', (self.embed_dim,))])}
         return
 
     def clip_params(self, max_norm=5.0):
-        """Bound L2 (row-wise) norm of W by max_norm."""
-        M = self.params['W']
-        m_scales = max_norm / np.sqrt(np.sum(M**2.0,axis=1) + 1e-5)
-        mask = (m_scales < 1.0)
-        mask = mask.astype(np.float32) # why is explicit cast needed?
-        m_scales = (m_scales * mask) + (1.0 - mask)
-        self.params['W'] = M * m_scales[:,np.newaxis]
+        """Bound L2 (row-wise) norm of W by max_norm.
+
+        Only rows changed since the last clip are checked (see RowClipper).
+        """
+        rows = self.clipper.dirty_rows(max_norm)
+        self.decay.sync(rows, [self.params['W']])
+        self.clipper.clip(self.params['W'], rows, max_norm)
+        return
+
+    def _reset_clippers(self):
+        """Make the next clip_params() check all rows."""
+        self.clipper.reset()
         return
 
     def feedforward(self, X):
@@ -299,6 +574,8 @@ class LUTLayer:
         self._cleanup()
         # Record the incoming list of row indices to extract
         self.X = X.astype(np.uint32)
+        # Apply any pending l2 decay to the rows we're about to use
+        self.decay.sync(self.X, [self.params['W']])
         # Use look-up table to generate the desired sequences
         if (self.n_gram == 1):
             self.Y = self.params['W'].take(self.X, axis=0)
@@ -314,39 +591,83 @@ class LUTLayer:
         """Backprop through this layer.
         """
         assert(np.max(self.X) < self.key_count)
-        self.grad_idx.update(self.X.ravel())
+        if self.grad_stores:
+            # Rows of dLdY hold n_gram chunks, one per column of X, so this
+            # does all the columns in one go
+            dLdY = dLdY.reshape((self.X.size, self.embed_dim))
+            run_packed_kernel('lut_bp', lut_bp, (self.X.ravel(), dLdY, None), \
+                              [self.grad_stores['W']])
+            return 1
+        self.grad_rows.mark(self.X)
         # Add the gradients to the gradient accumulator
         if (self.n_gram == 1):
             lut_bp(self.X, dLdY, self.grads['W'])
         else:
-            # Backprop for each of the predictor words
+            # Backprop for each of the predictor words (the Cython lut_bp
+            # needs contiguous keys and rows, as noted in CMLayer.backprop)
             dLdY_chunks = np.hsplit(dLdY, self.n_gram)
             for i in range(self.n_gram):
-                lut_bp(self.X[:,i], dLdY_chunks[i], self.grads['W'])
+                lut_bp(np.ascontiguousarray(self.X[:,i]), \
+                       np.ascontiguousarray(dLdY_chunks[i]), self.grads['W'])
         return 1
 
     def l2_regularize(self, lam_l2=1e-5):
-        """Add gradients for l2 regularization. And compute loss."""
-        self.params['W'] -= lam_l2 * self.params['W']
+        """Scale W by (1 - lam_l2), lazily (see flush_decay())."""
+        self.decay.decay(lam_l2)
         return 1
 
+    def flush_decay(self):
+        """Apply any pending l2 decay to all rows of W.
+
+        Rows are otherwise decayed when next used, so call this before
+        reading the params directly (e.g. for eval or checkpoints).
+        """
+        self.decay.flush([self.params['W']])
+        return
+
     def apply_grad(self, learn_rate=1e-2):
         """Apply the current accumulated gradients, with adagrad."""
-        nz_idx = np.asarray([i for i in self.grad_idx]).astype(np.uint32)
+        if self.grad_stores:
+            store = self.grad_stores['W']
+            store.ag_update('W', self.params['W'], self.moms['W'], learn_rate)
+            self.clipper.mark(store.rows())
+            store.clear()
+            return
+        nz_idx = self.grad_rows.rows()
         ag_update_2d(nz_idx, self.params['W'], self.grads['W'], \
                      self.moms['W'], learn_rate)
-        self.grad_idx = set()
+        self.clipper.mark(nz_idx)
+        self.grad_rows.clear()
         return
 
-    def reset_moms(self, ada_init=1e-3):
-        """Reset the gradient accumulators for this layer."""
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
+    def reset_moms(self, ada_init=1e-3, rows=None):
+        """Reset the adagrad moms, in place, for the given rows (or all)."""
+        fill_rows([self.moms['W']], rows, ada_init)
+        if rows is None:
+            self.unsaved_rows.mark_all()
+        else:
+            self.unsaved_rows.mark(rows)
+        return
+
+    def reset_grads(self, rows=None):
+        """Set the grads to 0, in place, for the given rows.
+
+        With rows=None, this resets the rows with pending grads (the only
+        rows that can be non-zero), as in NSLayer.reset_grads().
+        """
+        if self.grad_stores:
+            self.grad_stores['W'].reset(rows)
+        elif rows is None:
+            fill_rows([self.grads['W']], self.grad_rows.rows(), 0.0)
+            self.grad_rows.clear()
+        else:
+            fill_rows([self.grads['W']], rows, 0.0)
         return
 
-    def reset_grads_and_moms(self, ada_init=1e-3):
-        """Reset the gradient accumulators for this layer."""
-        self.grads['W'] = (0.0 * self.grads['W'])
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
+    def reset_grads_and_moms(self, ada_init=1e-3, rows=None):
+        """Reset the grads and the adagrad moms, in place."""
+        self.reset_grads(rows)
+        self.reset_moms(ada_init, rows)
         return
 
     def _cleanup(self):
@@ -375,7 +696,17 @@ class CMLayer:
         self.moms = {}
         self.moms['Wm'] = zeros(self.params['Wm'].shape)
         self.moms['Wb'] = zeros(self.params['Wb'].shape)
-        self.grad_idx = set()
+        self.grad_rows = RowTracker(self.key_count)
+        # rows changed since the last checkpoint (see Checkpoints)
+        self.unsaved_rows = RowTracker(self.key_count)
+        self.decay = {'Wm': LazyDecay(self.key_count, self.unsaved_rows), \
+                      'Wb': LazyDecay(self.key_count, self.unsaved_rows)}
+        self.clippers = {'Wm': RowClipper(self.key_count, self.unsaved_rows), \
+                         'Wb': RowClipper(self.key_count, self.unsaved_rows)}
+        self.storage = 'float32'
+        self.stochastic = False
+        self.grad_storage = 'dense'
+        self.grad_stores = {}
         # Set common stuff for all types layers
         self.X = []
         self.C = []
@@ -391,27 +722,77 @@ class CMLayer:
         assert((param == 'Wb') or (param == 'Wm'))
         if param == 'Wm':
             self.params['Wm'] = w_scale * randn((self.key_count, self.source_dim))
-            self.grads['Wm'] = zeros(self.params['Wm'].shape)
         else:
             self.params['Wb'] = w_scale * randn((self.key_count, self.bias_dim))
-            self.grads['Wb'] = zeros(self.params['Wb'].shape)
+        if self.grad_stores:
+            self.grad_stores[param].reset()
+        else:
+            self.grads[param] = zeros(self.params[param].shape)
+        self.decay[param].reset()
+        self.set_storage(self.storage, self.stochastic)
+        return
+
+    def set_storage(self, storage='float32', stochastic=False):
+        """Store params and moms as 'float32', 'float16' or 'bfloat16'.
+
+        Grads stay float32, and all compute is done in float32. Stochastic
+        rounding is used when writing updated rows back to half storage if
+        stochastic is True. See HalfStorage.
+        """
+        self.storage = storage
+        self.stochastic = stochastic
+        store_tables(self.params, storage, stochastic)
+        store_tables(self.moms, storage, stochastic)
+        self._reset_clippers()
+        self.unsaved_rows.mark_all()
+        return
+
+    def set_grad_storage(self, storage='dense'):
+        """Keep grads in 'dense' tables, or in 'packed' stores.
+
+        See NSLayer.set_grad_storage(). Wm and Wb get a store each, as the
+        grads for Wm are only computed with do_rescale set. Any pending
+        grads are dropped.
+        """
+        assert (storage in GRAD_STORAGE_TYPES), \
+                "unknown grad storage: {0:s}".format(storage)
+        self.grad_storage = storage
+        self.grad_rows.clear()
+        if storage == 'dense':
+            self.grads = {'Wm': zeros((self.key_count, self.source_dim)), \
+                          'Wb': zeros((self.key_count, self.bias_dim))}
+            self.grad_stores = {}
+        else:
+            self.grads = {}
+            self.grad_stores = { \
+                    'Wm': PackedGrads(self.key_count, \
+                                      [('Wm', (self.source_dim,))]), \
+                    'Wb': PackedGrads(self.key_count, \
+                                      [('Wb', (self.bias_dim,))])}
         return
 
     def clip_params(self, Wm_norm=5.0, Wb_norm=5.0):
-        """Bound L2 (row-wise) norm of Wm and Wb by max_norm."""
+        """Bound L2 (row-wise) norm of Wm and Wb by max_norm.
+
+        Only rows changed since the last clip are checked (see RowClipper).
+        """
         for (param, max_norm) in zip(['Wm','Wb'],[Wm_norm, Wb_norm]):
-            M = self.params[param]
-            m_scales = max_norm / np.sqrt(np.sum(M**2.0,axis=1) + 1e-5)
-            mask = (m_scales < 1.0)
-            mask = mask.astype(np.float32) # why is explicit cast needed?
-            m_scales = (m_scales * mask) + (1.0 - mask)
-            self.params[param] = M * m_scales[:,np.newaxis]
+            rows = self.clippers[param].dirty_rows(max_norm)
+            self.decay[param].sync(rows, [self.params[param]])
+            self.clippers[param].clip(self.params[param], rows, max_norm)
+        return
+
+    def _reset_clippers(self):
+        """Make the next clip_params() check all rows."""
+        for param in ['Wm', 'Wb']:
+            self.clippers[param].reset()
         return
 
     def norm_info(self, param_name='Wm'):
         """Diagnostic info about norms of W's rows."""
-        M = self.params[param_name]
+        M = np.asarray(self.params[param_name])
         row_norms = np.sqrt(np.sum(M**2.0, axis=1))
+        row_norms *= self.decay[param_name].row_scales() # for pending decay
         men_n = np.mean(row_norms)
         min_n = np.min(row_norms)
         med_n = np.median(row_norms)
@@ -428,6 +809,9 @@ class CMLayer:
         # Record the incoming list of row indices to extract
         self.X = X
         self.C = C.astype(np.uint32)
+        # Apply any pending l2 decay to the rows we're about to use
+        for param in ['Wm', 'Wb']:
+            self.decay[param].sync(self.C, [self.params[param]])
         # Extract the relevant bias parameter rows
         Wb = self.params['Wb'].take(C, axis=0)
         if (self.bias_dim < 5):
@@ -457,7 +841,8 @@ class CMLayer:
         """
         # Add the gradients to the gradient accumulators
         assert (np.max(self.C) < self.key_count)
-        self.grad_idx.update(self.C.ravel())
+        if not self.grad_stores:
+            self.grad_rows.mark(self.C)
         self.dLdY = dLdY
         dLdYb, dLdYw = np.hsplit(dLdY, [self.bias_dim])
         dLdYb = dLdYb.copy() # copy, because hsplit leaves the new arrays in
@@ -467,14 +852,26 @@ class CMLayer:
                              # that are in contiguous memory
         if self.do_rescale:
             dLdW = (self.Wm_sig / self.Wm_exp) * self.X * dLdYw
-            lut_bp(self.C, dLdW, self.grads['Wm'])
-        lut_bp(self.C, dLdYb, self.grads['Wb'])
+            self._lut_bp('Wm', dLdW)
+        self._lut_bp('Wb', dLdYb)
         dLdX = self.Wm_sig * dLdYw
         return dLdX
 
+    def _lut_bp(self, param, dLdW):
+        """Add the rows of dLdW into the grads for param, at keys self.C."""
+        if self.grad_stores:
+            run_packed_kernel('lut_bp', lut_bp, (self.C, dLdW, None), \
+                              [self.grad_stores[param]])
+        else:
+            lut_bp(self.C, dLdW, self.grads[param])
+        return
+
     def apply_grad(self, learn_rate=1e-2):
         """Apply the current accumulated gradients, with adagrad."""
-        nz_idx = np.asarray([i for i in self.grad_idx]).astype(np.uint32)
+        if self.grad_stores:
+            self._apply_packed(learn_rate)
+            return
+        nz_idx = self.grad_rows.rows()
         # Information from the word LUT should not pass through this
         # layer when source_dim < 5. In this case, we assume that we
         # will do prediction using only the context-adaptive biases.
@@ -488,27 +885,68 @@ class CMLayer:
         b_rate = learn_rate if (self.bias_dim >= 5) else 0.0
         ag_update_2d(nz_idx, self.params['Wb'], self.grads['Wb'], \
                      self.moms['Wb'], b_rate)
-        self.grad_idx = set()
+        self.clippers['Wm'].mark(nz_idx)
+        self.clippers['Wb'].mark(nz_idx)
+        self.grad_rows.clear()
+        return
+
+    def _apply_packed(self, learn_rate):
+        """As apply_grad(), for packed grads."""
+        m_rate = learn_rate if (self.source_dim >= 5) else 0.0
+        b_rate = learn_rate if (self.bias_dim >= 5) else 0.0
+        for (param, rate) in zip(['Wm', 'Wb'], [m_rate, b_rate]):
+            store = self.grad_stores[param]
+            store.ag_update(param, self.params[param], self.moms[param], rate)
+            self.clippers[param].mark(store.rows())
+            store.clear()
         return
 
     def l2_regularize(self, lam_Wm=1e-5, lam_Wb=1e-5):
-        """Add gradients for l2 regularization."""
-        self.params['Wm'] -= lam_Wm * self.params['Wm']
-        self.params['Wb'] -= lam_Wb * self.params['Wb']
+        """Scale Wm and Wb by (1 - lam), lazily (see flush_decay())."""
+        self.decay['Wm'].decay(lam_Wm)
+        self.decay['Wb'].decay(lam_Wb)
         return 1
 
-    def reset_moms(self, ada_init=1e-3):
-        """Reset the gradient accumulators for this layer."""
-        self.moms['Wm'] = (0.0 * self.moms['Wm']) + ada_init
-        self.moms['Wb'] = (0.0 * self.moms['Wb']) + ada_init
+    def flush_decay(self):
+        """Apply any pending l2 decay to all rows of Wm and Wb.
+
+        Rows are otherwise decayed when next used, so call this before
+        reading the params directly (e.g. for eval or checkpoints).
+        """
+        for param in ['Wm', 'Wb']:
+            self.decay[param].flush([self.params[param]])
+        return
+
+    def reset_moms(self, ada_init=1e-3, rows=None):
+        """Reset the adagrad moms, in place, for the given rows (or all)."""
+        fill_rows([self.moms['Wm'], self.moms['Wb']], rows, ada_init)
+        if rows is None:
+            self.unsaved_rows.mark_all()
+        else:
+            self.unsaved_rows.mark(rows)
         return
 
-    def reset_grads_and_moms(self, ada_init=1e-3):
-        """Reset the gradient accumulators for this layer."""
-        self.grads['Wm'] = (0.0 * self.grads['Wm'])
-        self.grads['Wb'] = (0.0 * self.grads['Wb'])
-        self.moms['Wm'] = (0.0 * self.moms['Wm']) + ada_init
-        self.moms['Wb'] = (0.0 * self.moms['Wb']) + ada_init
+    def reset_grads(self, rows=None):
+        """Set the grads to 0, in place, for the given rows.
+
+        With rows=None, this resets the rows with pending grads (the only
+        rows that can be non-zero), as in NSLayer.reset_grads().
+        """
+        if self.grad_stores:
+            for param in ['Wm', 'Wb']:
+                self.grad_stores[param].reset(rows)
+        elif rows is None:
+            fill_rows([self.grads['Wm'], self.grads['Wb']], \
+                      self.grad_rows.rows(), 0.0)
+            self.grad_rows.clear()
+        else:
+            fill_rows([self.grads['Wm'], self.grads['Wb']], rows, 0.0)
+        return
+
+    def reset_grads_and_moms(self, ada_init=1e-3, rows=None):
+        """Reset the grads and the adagrad moms, in place."""
+        self.reset_grads(rows)
+        self.reset_moms(ada_init, rows)
         return
 
     def _cleanup(self):
@@ -526,12 +964,14 @@ class CMLayer:
 ##########################
 
 class NoiseLayer:
-    def __init__(self, drop_rate=0.0, fuzz_scale=0.0):
+    def __init__(self, drop_rate=0.0, fuzz_scale=0.0, rs=None):
         # Set stuff required for managing this type of layer
         self.dYdX = []
         self.drop_rate = drop_rate
         self.drop_scale = 1.0 / (1.0 - drop_rate)
         self.fuzz_scale = fuzz_scale
+        # RandomState to draw the noise from (None for numpy.random)
+        self.rs = rs
         # Set stuff common to all layer types
         self.X = []
         self.Y = []
@@ -552,16 +992,17 @@ class NoiseLayer:
         self._cleanup()
         # Record (a pointer to) the passed input
         self.X = X
+        rs = npr if self.rs is None else self.rs
         # Generate and apply a dropout mask to the input
         if (self.drop_rate > 1e-4):
             drop_mask = self.drop_scale * \
-                    (npr.rand(self.X.shape[0], self.X.shape[1]) > self.drop_rate)
+                    (rs.rand(self.X.shape[0], self.X.shape[1]) > self.drop_rate)
         else:
             drop_mask = ones((self.X.shape[0], self.X.shape[1]))
         self.dYdX = drop_mask
         if (self.fuzz_scale > 1e-4):
             fuzz_bump = (self.fuzz_scale / self.drop_scale) * \
-                    npr.randn(self.X.shape[0], self.X.shape[1])
+                    rs.randn(self.X.shape[0], self.X.shape[1])
             self.Y = drop_mask * (self.X + fuzz_bump)
         else:
             self.Y = drop_mask * self.X
@@ -622,7 +1063,8 @@ class TanhLayer:
 ################################
 
 class W2VLayer:
-    def __init__(self, max_word_key=0, word_dim=0, lam_l2=1e-3):
+    def __init__(self, max_word_key=0, word_dim=0, lam_l2=1e-3, \
+                 rand_init=True):
         # Set basic layer parameters. The max_word_key passed as an argument
         # is incremented by 1 to accommodate 0 indexing.
         self.word_dim = word_dim
@@ -630,8 +1072,11 @@ class W2VLayer:
         # Initialize arrays for tracking parameters, gradients, and
         # adagrad "momentums" (i.e. sums of squared gradients).
         self.params = {}
-        self.params['Wa'] = 0.01 * randn((self.word_count, word_dim))
-        self.params['Wc'] = 0.01 * randn((self.word_count, word_dim))
+        # (without rand_init, params start at 0, e.g. for loading them)
+        self.params['Wa'] = 0.01 * randn((self.word_count, word_dim)) \
+                if rand_init else zeros((self.word_count, word_dim))
+        self.params['Wc'] = 0.01 * randn((self.word_count, word_dim)) \
+                if rand_init else zeros((self.word_count, word_dim))
         self.params['b'] = zeros((self.word_count,))
         self.grads = {}
         self.grads['Wa'] = zeros((self.word_count, word_dim))
@@ -646,38 +1091,127 @@ class W2VLayer:
         # Initialize sets for tracking which words we have trained
         self.trained_Wa = set()
         self.trained_Wc = set()
+        # Trackers for the rows touched by each batch
+        self.a_rows = RowTracker(self.word_count)
+        self.c_rows = RowTracker(self.word_count)
+        # rows changed since the last checkpoint (see Checkpoints)
+        self.unsaved_rows = RowTracker(self.word_count)
+        self.decay = {'Wa': LazyDecay(self.word_count, self.unsaved_rows), \
+                      'Wc': LazyDecay(self.word_count, self.unsaved_rows)}
+        self.clippers = {'Wa': RowClipper(self.word_count, self.unsaved_rows), \
+                         'Wc': RowClipper(self.word_count, self.unsaved_rows)}
+        self.storage = 'float32'
+        self.stochastic = False
+        self.ff_bp_mode = 'scalar'
+        self.grad_storage = 'dense'
+        self.grad_stores = {}
         return
 
     def init_params(self, w_scale=0.01, b_scale=0.0):
         """Randomly initialize the weights in this layer."""
         self.params['Wa'] = w_scale * randn((self.word_count, self.word_dim))
-        self.grads['Wa'] = zeros((self.word_count, self.word_dim))
         self.moms['Wa'] = zeros((self.word_count, self.word_dim)) + 1e-3
         self.params['Wc'] = w_scale * randn((self.word_count, self.word_dim))
-        self.grads['Wc'] = zeros((self.word_count, self.word_dim))
         self.moms['Wc'] = zeros((self.word_count, self.word_dim)) + 1e-3
         self.params['b'] = zeros((self.word_count,))
-        self.grads['b'] = zeros((self.word_count,))
         self.moms['b'] = zeros((self.word_count,)) + 1e-3
+        self.set_grad_storage(self.grad_storage)
+        self.decay['Wa'].reset()
+        self.decay['Wc'].reset()
+        self.set_storage(self.storage, self.stochastic)
+        return
+
+    def set_storage(self, storage='float32', stochastic=False):
+        """Store params and moms as 'float32', 'float16' or 'bfloat16'.
+
+        Grads stay float32, and all compute is done in float32. Stochastic
+        rounding is used when writing updated rows back to half storage if
+        stochastic is True. See HalfStorage.
+        """
+        self.storage = storage
+        self.stochastic = stochastic
+        store_tables(self.params, storage, stochastic)
+        store_tables(self.moms, storage, stochastic)
+        self._reset_clippers()
+        self.unsaved_rows.mark_all()
+        return
+
+    def set_ff_bp_mode(self, mode='scalar'):
+        """Set the ff/bp kernel to 'scalar' or 'dense'.
+
+        The 'dense' kernels (see DenseFuncs) gather target rows for blocks of
+        examples and use batched matrix-vector products. Run the crossover
+        benchmark in KernelBench to see which mode is faster on a machine.
+        """
+        assert (mode in W2V_FF_BP), "unknown ff/bp mode: {0:s}".format(mode)
+        self.ff_bp_mode = mode
+        return
+
+    def set_grad_storage(self, storage='dense'):
+        """Keep grads in 'dense' tables, or in 'packed' stores.
+
+        See NSLayer.set_grad_storage(). Wa gets a store for the anchor rows,
+        and Wc and b share a store for the context rows. Any pending grads
+        are dropped.
+        """
+        assert (storage in GRAD_STORAGE_TYPES), \
+                "unknown grad storage: {0:s}".format(storage)
+        self.grad_storage = storage
+        self.a_rows.clear()
+        self.c_rows.clear()
+        if storage == 'dense':
+            self.grads = {'Wa': zeros((self.word_count, self.word_dim)), \
+                          'Wc': zeros((self.word_count, self.word_dim)), \
+                          'b': zeros((self.word_count,))}
+            self.grad_stores = {}
+        else:
+            self.grads = {}
+            self.grad_stores = { \
+                    'Wa': PackedGrads(self.word_count, \
+                                      [('Wa', (self.word_dim,))]), \
+                    'Wc': PackedGrads(self.word_count, \
+                                      [('Wc', (self.word_dim,)), ('b', ())])}
         return
 
     def clip_params(self, max_norm=5.0):
-        """Bound L2 (row-wise) norm of Wa and Wc by max_norm."""
+        """Bound L2 (row-wise) norm of Wa and Wc by max_norm.
+
+        Only rows changed since the last clip are checked (see RowClipper).
+        """
         for param in ['Wa', 'Wc']:
-            M = self.params[param]
-            m_scales = max_norm / np.sqrt(np.sum(M**2.0,axis=1) + 1e-5)
-            mask = (m_scales < 1.0)
-            mask = mask.astype(np.float32) # why is explicit cast needed?
-            m_scales = (m_scales * mask) + (1.0 - mask)
-            self.params[param] = M * m_scales[:,np.newaxis]
+            rows = self.clippers[param].dirty_rows(max_norm)
+            self.decay[param].sync(rows, [self.params[param]])
+            self.clippers[param].clip(self.params[param], rows, max_norm)
+        return
+
+    def _reset_clippers(self):
+        """Make the next clip_params() check all rows."""
+        for param in ['Wa', 'Wc']:
+            self.clippers[param].reset()
         return
 
     def l2_regularize(self, lam_l2=1e-5):
-        """Add gradients for l2 regularization. And compute loss."""
-        self.params['Wa'] -= lam_l2 * self.params['Wa']
-        self.params['Wc'] -= lam_l2 * self.params['Wc']
+        """Scale Wa and Wc by (1 - lam_l2), lazily (see flush_decay())."""
+        self.decay['Wa'].decay(lam_l2)
+        self.decay['Wc'].decay(lam_l2)
         return 1
 
+    def flush_decay(self):
+        """Apply any pending l2 decay to all rows of Wa and Wc.
+
+        Rows are otherwise decayed when next used, so call this before
+        reading the params directly (e.g. for eval or checkpoints).
+        """
+        for param in ['Wa', 'Wc']:
+            self.decay[param].flush([self.params[param]])
+        return
+
+    def _sync_decay(self, anc_idx, pn_idx):
+        """Apply any pending l2 decay to the rows used by a batch."""
+        self.decay['Wa'].sync(anc_idx, [self.params['Wa']])
+        self.decay['Wc'].sync(pn_idx, [self.params['Wc']])
+        return
+
     def batch_train(self, anc_idx, pos_idx, neg_idx, learn_rate=1e-3):
         """Perform a batch update of all parameters based on the given sets
         of anchor, positive example, and negative example indices.
@@ -689,62 +1223,115 @@ class W2VLayer:
         pn_sign = -1.0 * ones(pn_idx.shape)
         pn_sign[:,0] = 1.0
         L = zeros((1,))
+        self._sync_decay(anc_idx, pn_idx)
+        if self.grad_stores:
+            return self._packed_train(anc_idx, pn_idx, pn_sign, learn_rate)
         # Do feedforward and backprop through the predictor/predictee tables
-        w2v_ff_bp(anc_idx, pn_idx, pn_sign, self.params['Wa'], \
-                  self.params['Wc'], self.params['b'], self.grads['Wa'], \
-                  self.grads['Wc'], self.grads['b'], L, 1)
+        ff_bp_func = W2V_FF_BP[self.ff_bp_mode]
+        ff_bp_func(anc_idx, pn_idx, pn_sign, self.params['Wa'], \
+                   self.params['Wc'], self.params['b'], self.grads['Wa'], \
+                   self.grads['Wc'], self.grads['b'], L, 1)
         L = L[0]
         # Apply gradients to (touched only) look-up-table parameters
-        a_mod_idx = np.unique(anc_idx)
-        c_mod_idx = np.unique(pn_idx)
+        self.a_rows.mark(anc_idx)
+        self.c_rows.mark(pn_idx)
+        a_mod_idx = self.a_rows.rows()
+        c_mod_idx = self.c_rows.rows()
         ag_update_2d(a_mod_idx, self.params['Wa'], self.grads['Wa'], \
                 self.moms['Wa'], learn_rate)
         ag_update_2d(c_mod_idx, self.params['Wc'], self.grads['Wc'], \
                 self.moms['Wc'], learn_rate)
         ag_update_1d(c_mod_idx, self.params['b'], self.grads['b'], \
                 self.moms['b'], learn_rate)
+        self.clippers['Wa'].mark(a_mod_idx)
+        self.clippers['Wc'].mark(c_mod_idx)
+        self.a_rows.clear()
+        self.c_rows.clear()
         return L
 
+    def _packed_train(self, anc_idx, pn_idx, pn_sign, learn_rate):
+        """As batch_train(), for packed grads."""
+        L = zeros((1,))
+        a_store = self.grad_stores['Wa']
+        c_store = self.grad_stores['Wc']
+        run_packed_kernel('w2v_ff_bp', W2V_FF_BP[self.ff_bp_mode], \
+                (anc_idx, pn_idx, pn_sign, self.params['Wa'], \
+                 self.params['Wc'], self.params['b'], None, None, None, L, 1), \
+                [a_store, c_store])
+        a_store.ag_update('Wa', self.params['Wa'], self.moms['Wa'], learn_rate)
+        c_store.ag_update('Wc', self.params['Wc'], self.moms['Wc'], learn_rate)
+        c_store.ag_update('b', self.params['b'], self.moms['b'], learn_rate)
+        self.clippers['Wa'].mark(a_store.rows())
+        self.clippers['Wc'].mark(c_store.rows())
+        a_store.clear()
+        c_store.clear()
+        return L[0]
+
     def batch_test(self, anc_idx, pos_idx, neg_idx):
         """Run a batch through the model, computing losses but not grads.
         """
         anc_idx = anc_idx.astype(np.uint32)
         pos_idx = pos_idx[:,np.newaxis]
         pn_idx = np.hstack((pos_idx, neg_idx)).astype(np.uint32)
-        pn_sign = ones(pn_idx.shape)
-        pn_sign[:,0] = -1.0
+        pn_sign = -1.0 * ones(pn_idx.shape)
+        pn_sign[:,0] = 1.0
         L = zeros((1,))
+        self._sync_decay(anc_idx, pn_idx)
         # Do feedforward and backprop through the predictor/predictee tables
-        w2v_ff_bp(anc_idx, pn_idx, pn_sign, self.params['Wa'], \
-               self.params['Wc'], self.params['b'], self.grads['Wa'], \
-               self.grads['Wc'], self.grads['b'], L, 0)
-        self.grads['Wa'] = 0.0 * self.grads['Wa']
-        self.grads['Wc'] = 0.0 * self.grads['Wc']
-        self.grads['b'] = 0.0 * self.grads['b']
+        ff_bp_func = W2V_FF_BP[self.ff_bp_mode]
+        if self.grad_stores:
+            run_packed_kernel('w2v_ff_bp', ff_bp_func, (anc_idx, pn_idx, \
+                    pn_sign, self.params['Wa'], self.params['Wc'], \
+                    self.params['b'], None, None, None, L, 0), \
+                    [self.grad_stores['Wa'], self.grad_stores['Wc']], False)
+        else:
+            ff_bp_func(anc_idx, pn_idx, pn_sign, self.params['Wa'], \
+                       self.params['Wc'], self.params['b'], self.grads['Wa'], \
+                       self.grads['Wc'], self.grads['b'], L, 0)
+        # (with do_grad=0, the kernels leave the grads alone)
         L = L[0]
         return L
 
     def l2_regularize(self, lam_l2=1e-5):
-        """Add gradients for l2 regularization."""
-        self.params['Wa'] -= lam_l2 * self.params['Wa']
-        self.params['Wc'] -= lam_l2 * self.params['Wc']
+        """Scale Wa and Wc by (1 - lam_l2), lazily (see flush_decay())."""
+        self.decay['Wa'].decay(lam_l2)
+        self.decay['Wc'].decay(lam_l2)
         return
 
-    def reset_moms(self, ada_init=1e-3):
-        """Reset the gradient accumulators for this layer."""
-        self.moms['Wa'] = (0.0 * self.moms['Wa']) + ada_init
-        self.moms['Wc'] = (0.0 * self.moms['Wc']) + ada_init
-        self.moms['b'] = (0.0 * self.moms['b']) + ada_init
+    def reset_moms(self, ada_init=1e-3, rows=None):
+        """Reset the adagrad moms, in place, for the given rows (or all)."""
+        fill_rows([self.moms['Wa'], self.moms['Wc'], self.moms['b']], rows, \
+                  ada_init)
+        if rows is None:
+            self.unsaved_rows.mark_all()
+        else:
+            self.unsaved_rows.mark(rows)
         return
 
-    def reset_grads_and_moms(self, ada_init=1e-3):
-        """Reset the gradient accumulators for this layer."""
-        self.grads['Wa'] = (0.0 * self.grads['Wa']) + ada_init
-        self.grads['Wc'] = (0.0 * self.grads['Wc']) + ada_init
-        self.grads['b'] = (0.0 * self.grads['b']) + ada_init
-        self.moms['Wa'] = (0.0 * self.moms['Wa']) + ada_init
-        self.moms['Wc'] = (0.0 * self.moms['Wc']) + ada_init
-        self.moms['b'] = (0.0 * self.moms['b']) + ada_init
+    def reset_grads(self, rows=None):
+        """Set the grads to 0, in place, for the given rows.
+
+        batch_train() applies and zeros all grads that it computes, so with
+        rows=None, this only resets rows still marked in a_rows/c_rows.
+        """
+        if self.grad_stores:
+            for param in ['Wa', 'Wc']:
+                self.grad_stores[param].reset(rows)
+        elif rows is None:
+            fill_rows([self.grads['Wa']], self.a_rows.rows(), 0.0)
+            fill_rows([self.grads['Wc'], self.grads['b']], \
+                      self.c_rows.rows(), 0.0)
+            self.a_rows.clear()
+            self.c_rows.clear()
+        else:
+            fill_rows([self.grads['Wa'], self.grads['Wc'], self.grads['b']], \
+                      rows, 0.0)
+        return
+
+    def reset_grads_and_moms(self, ada_init=1e-3, rows=None):
+        """Reset the grads (to 0) and the adagrad moms, in place."""
+        self.reset_grads(rows)
+        self.reset_moms(ada_init, rows)
         return
 
 ###################################
@@ -757,9 +1344,189 @@ def run_test():
     #########################################################
     print("TODO: WRITE TEST FOR Word2Vec.py")
 
+def _train_for_check(word_count, dim, batch_count, batch_size, reg_freq, \
+                     eager, clip_freq=0, full_clip=False, seed=1, \
+                     grad_storage='dense', layers_out=None):
+    """Train a LUT->CM->NS stack and a W2VLayer on random keys.
+
+    With eager=True, each l2_regularize() is followed by flush_decay(),
+    which makes it a full-table sweep (i.e. the old behavior). If clip_freq
+    is > 0, the params get clipped every clip_freq batches, and full_clip
+    makes each clip check all rows. All layers keep their grads as given
+    by grad_storage, and get appended to layers_out if it's a list. Returns
+    the flushed params of all layers, and the training time.
+    """
+    npr.seed(seed)
+    lut = LUTLayer(word_count - 1, dim)
+    cml = CMLayer(max_key=99, source_dim=dim, bias_dim=dim, do_rescale=True)
+    nsl = NSLayer(in_dim=(2 * dim), max_out_key=(word_count - 1))
+    w2v = W2VLayer(max_word_key=(word_count - 1), word_dim=dim)
+    lut.init_params(0.05)
+    cml.init_params(0.05, param='Wm')
+    cml.init_params(0.05, param='Wb')
+    nsl.init_params(0.05)
+    w2v.init_params(0.05)
+    layers = [lut, cml, nsl, w2v]
+    for layer in layers:
+        layer.reset_moms(1.0)
+        layer.set_grad_storage(grad_storage)
+    if layers_out is not None:
+        layers_out.extend(layers)
+    rs = npr.RandomState(seed)
+    t0 = time.time()
+    for b in range(batch_count):
+        keys = rs.randint(0, word_count, size=(batch_size, 7)).astype(np.uint32)
+        ctx = rs.randint(0, 100, size=(batch_size,)).astype(np.uint32)
+        Xw = lut.feedforward(keys[:,0])
+        Xc = cml.feedforward(Xw, ctx)
+        dLdXc, L = nsl.ff_bp(Xc, keys[:,1], keys[:,2:])
+        lut.backprop(cml.backprop(dLdXc))
+        w2v.batch_train(keys[:,0], keys[:,1], keys[:,2:], learn_rate=1e-2)
+        for layer in layers[0:3]:
+            layer.apply_grad(learn_rate=1e-2)
+        if ((b > 1) and ((b % reg_freq) == 0)):
+            lut.l2_regularize(1e-2)
+            cml.l2_regularize(lam_Wm=1e-2, lam_Wb=2e-2)
+            nsl.l2_regularize(1e-2)
+            w2v.l2_regularize(1e-2)
+            if eager:
+                for layer in layers:
+                    layer.flush_decay()
+        if ((clip_freq > 0) and ((b % clip_freq) == 0)):
+            for layer in layers:
+                if full_clip:
+                    layer._reset_clippers()
+            lut.clip_params(0.4)
+            cml.clip_params(Wm_norm=0.4, Wb_norm=0.3)
+            nsl.clip_params(0.4)
+            w2v.clip_params(0.4)
+    t1 = time.time()
+    for layer in layers:
+        layer.flush_decay()
+    params = [np.asarray(layer.params[p]).copy() for layer in layers \
+              for p in sorted(layer.params.keys())]
+    return [params, (t1 - t0)]
+
+def check_lazy_decay(word_count=2000, dim=32, batch_count=400, \
+                     batch_size=100, reg_freq=5, rtol=1e-4):
+    """Check that lazy l2 decay gives the same params as eager sweeps."""
+    P_eager, t_eager = _train_for_check(word_count, dim, batch_count, \
+                                        batch_size, reg_freq, True)
+    P_lazy, t_lazy = _train_for_check(word_count, dim, batch_count, \
+                                      batch_size, reg_freq, False)
+    max_err = 0.0
+    for (Pe, Pl) in zip(P_eager, P_lazy):
+        err = np.max(np.abs(Pe - Pl)) / (np.max(np.abs(Pe)) + 1e-8)
+        max_err = max(max_err, err)
+    print("lazy vs. eager l2 decay, max relative error: {0:.2e}".format(max_err))
+    assert (max_err < rtol), "lazy l2 decay doesn't match eager decay"
+    return max_err
+
+def run_lazy_decay_bench(word_count=200000, dim=128, batch_count=200, \
+                         batch_size=500, reg_freq=20):
+    """Time training with eager and lazy l2 decay, for a large vocab."""
+    P, t_eager = _train_for_check(word_count, dim, batch_count, batch_size, \
+                                  reg_freq, True)
+    P, t_lazy = _train_for_check(word_count, dim, batch_count, batch_size, \
+                                 reg_freq, False)
+    print("vocab: {0:d}, dim: {1:d}, reg_freq: {2:d}".format(word_count, \
+          dim, reg_freq))
+    print("-- eager: {0:.2f}s, lazy: {1:.2f}s, speedup: {2:.2f}x".format( \
+          t_eager, t_lazy, (t_eager / t_lazy)))
+    return [t_eager, t_lazy]
+
+def check_touched_clip(word_count=2000, dim=32, batch_count=400, \
+                       batch_size=100, reg_freq=5, clip_freq=3, rtol=1e-5):
+    """Check that clipping only changed rows matches clipping all rows."""
+    P_full, t_full = _train_for_check(word_count, dim, batch_count, \
+            batch_size, reg_freq, False, clip_freq=clip_freq, full_clip=True)
+    P_part, t_part = _train_for_check(word_count, dim, batch_count, \
+            batch_size, reg_freq, False, clip_freq=clip_freq, full_clip=False)
+    max_err = 0.0
+    for (Pf, Pp) in zip(P_full, P_part):
+        err = np.max(np.abs(Pf - Pp)) / (np.max(np.abs(Pf)) + 1e-8)
+        max_err = max(max_err, err)
+    print("touched-row vs. full clip, max relative error: {0:.2e}".format(max_err))
+    assert (max_err < rtol), "touched-row clipping doesn't match full clipping"
+    return max_err
+
+def run_clip_bench(word_count=500000, dim=64, batch_size=1000, \
+                   call_count=20):
+    """Time clip_params() for a LUTLayer, checking changed rows vs. all rows.
+
+    Each call follows an update to the rows for one batch of keys.
+    """
+    lut = LUTLayer(word_count - 1, dim)
+    lut.init_params(0.05)
+    lut.reset_moms(1.0)
+    rs = npr.RandomState(1)
+    times = {'full': 0.0, 'touched': 0.0}
+    for i in range(call_count):
+        for mode in ['full', 'touched']:
+            keys = rs.randint(0, word_count, size=(batch_size,))
+            lut.feedforward(keys.astype(np.uint32))
+            lut.backprop(ones((batch_size, dim)))
+            lut.apply_grad(learn_rate=1e-2)
+            if mode == 'full':
+                lut._reset_clippers()
+            t0 = time.time()
+            lut.clip_params(0.5)
+            times[mode] += time.time() - t0
+    print("vocab: {0:d}, dim: {1:d}, rows per batch: {2:d}".format( \
+          word_count, dim, batch_size))
+    print("-- full: {0:.2f}ms, touched: {1:.3f}ms, speedup: {2:.0f}x".format( \
+          (1e3 * times['full'] / call_count), \
+          (1e3 * times['touched'] / call_count), \
+          (times['full'] / times['touched'])))
+    return times
+
+def check_packed_grads(word_count=2000, dim=32, batch_count=400, \
+                       batch_size=100, reg_freq=5, clip_freq=3, rtol=1e-4):
+    """Check that training with packed grads matches dense grads."""
+    P_dense, t_dense = _train_for_check(word_count, dim, batch_count, \
+            batch_size, reg_freq, False, clip_freq=clip_freq, \
+            grad_storage='dense')
+    P_pack, t_pack = _train_for_check(word_count, dim, batch_count, \
+            batch_size, reg_freq, False, clip_freq=clip_freq, \
+            grad_storage='packed')
+    max_err = 0.0
+    for (Pd, Pp) in zip(P_dense, P_pack):
+        err = np.max(np.abs(Pd - Pp)) / (np.max(np.abs(Pd)) + 1e-8)
+        max_err = max(max_err, err)
+    print("packed vs. dense grads, max relative error: {0:.2e}".format(max_err))
+    assert (max_err < rtol), "training with packed grads doesn't match dense"
+    return max_err
+
+def run_packed_grads_bench(word_count=200000, dim=128, batch_count=200, \
+                           batch_size=500, reg_freq=20):
+    """Compare grad memory and training time for dense and packed grads."""
+    from HalfStorage import layer_bytes
+    results = {}
+    for grad_storage in ['dense', 'packed']:
+        layers = []
+        P, t = _train_for_check(word_count, dim, batch_count, batch_size, \
+                                reg_freq, False, grad_storage=grad_storage, \
+                                layers_out=layers)
+        grad_mb = sum(layer_bytes(layer)['grads'] for layer in layers) / 1e6
+        all_mb = sum(layer_bytes(layer)['total'] for layer in layers) / 1e6
+        results[grad_storage] = [grad_mb, all_mb, t]
+    print("vocab: {0:d}, dim: {1:d}, batch_size: {2:d}".format(word_count, \
+          dim, batch_size))
+    for grad_storage in ['dense', 'packed']:
+        grad_mb, all_mb, t = results[grad_storage]
+        print("-- {0:s}: grads {1:.1f}MB, total {2:.1f}MB, {3:.2f}s".format( \
+              grad_storage, grad_mb, all_mb, t))
+    return results
+
 
 if __name__ == '__main__':
     run_test()
+    check_lazy_decay()
+    run_lazy_decay_bench()
+    check_touched_clip()
+    run_clip_bench()
+    check_packed_grads()
+    run_packed_grads_bench()
 
 
 
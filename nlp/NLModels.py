@@ -1,10 +1,56 @@
+import time
 import numpy as np
 import numpy.random as npr
 import NLMLayers as nlml
-import cPickle as pickle
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 from HelperFuncs import zeros, ones, randn, rand_word_seqs
 import CorpusUtils as cu
 
+def _stat_samplers(sampler):
+    """Get a sampler, or a prefetcher and the sampler it draws from."""
+    if hasattr(sampler, 'next_batch') and (sampler.sampler is not None):
+        return [sampler, sampler.sampler]
+    return [sampler]
+
+def check_batch_size(sampler, batch_size):
+    """Check that a prefetcher (if given) makes batches of batch_size."""
+    if hasattr(sampler, 'next_batch') and (sampler.batch_size is not None):
+        assert (sampler.batch_size == batch_size), \
+                "batch_size differs from the prefetcher's batch_size."
+    return
+
+def start_sampler_stats(sampler):
+    """Reset a sampler's (or prefetcher's) stats, if it keeps any."""
+    for s in _stat_samplers(sampler):
+        if hasattr(s, 'reset_stats'):
+            s.reset_stats()
+    return time.time()
+
+def print_sampler_stats(sampler, sample_count, start_time):
+    """
+    Print a sampler's effective speedup from frequent-word subsampling, and
+    a prefetcher's time spent waiting on data (along with the stats for the
+    sampler it draws from).
+    """
+    if hasattr(sampler, 'next_batch'):
+        st = sampler.stats()
+        print("-- prefetch: {0:d} batches, waited {1:.2f}s ({2:.1%} of " \
+              "train time)".format(st['batches'], st['wait_secs'], \
+              st['wait_frac']))
+    for s in _stat_samplers(sampler):
+        if not hasattr(s, 'subsample_report'):
+            continue
+        rep = s.subsample_report(sample_count=sample_count, \
+                                 elapsed=(time.time() - start_time))
+        print("-- subsampling: kept {0:.3f} of tokens, {1:.0f} samples/s, " \
+              "{2:.0f} effective tokens/s ({3:.2f}x)".format(rep['keep_rate'], \
+              rep['samples_per_sec'], rep['effective_tokens_per_sec'], \
+              rep['effective_speedup']))
+    return
+
 class PVModel:
     """
     Paragraph Vector model, as described in "Distributed Representations of
@@ -28,7 +74,8 @@ class PVModel:
           noise for stronger regularization.
     """
     def __init__(self, wv_dim, cv_dim, max_wv_key, max_cv_key, max_hs_key, \
-                 pre_words=5, lam_wv=1e-4, lam_cv=1e-4, lam_cl=1e-4):
+                 pre_words=5, lam_wv=1e-4, lam_cv=1e-4, lam_cl=1e-4, \
+                 rand_init=True):
         # Record options/parameters
         self.wv_dim = wv_dim
         self.cv_dim = cv_dim
@@ -45,9 +92,11 @@ class PVModel:
         # Set noise layer parameters (for better regularization, perhaps)
         self.drop_rate = 0.0
         self.fuzz_scale = 0.0
-        # Create layers to use during training
+        # Create layers to use during training (with their params set to 0
+        # if not rand_init, e.g. for loading saved params)
         self.word_layer = nlml.LUTLayer(self.max_wv_key, wv_dim, \
-                                        n_gram=self.pre_words)
+                                        n_gram=self.pre_words, \
+                                        rand_init=rand_init)
         self.context_layer = nlml.CMLayer(max_key=max_cv_key, \
                                           source_dim=wv_dim, \
                                           bias_dim=cv_dim, \
@@ -56,7 +105,9 @@ class PVModel:
                                            fuzz_scale=self.fuzz_scale)
         self.class_layer = nlml.HSMLayer(\
                 in_dim=(self.cv_dim + (self.pre_words * self.wv_dim)), \
-                max_hs_key=self.max_hs_key)
+                max_hs_key=self.max_hs_key, rand_init=rand_init)
+        # id of the last checkpoint saved/loaded (see Checkpoints)
+        self.checkpoint_id = None
         return
 
     def set_noise(self, drop_rate=0.0, fuzz_scale=0.0):
@@ -81,9 +132,50 @@ class PVModel:
         self.class_layer.reset_moms(ada_init)
         return
 
+    def set_storage(self, storage='float32', stochastic=False):
+        """Set the storage type for params and moms in each layer.
+
+        See the set_storage() method of the layers in NLMLayers.
+        """
+        self.word_layer.set_storage(storage, stochastic)
+        self.context_layer.set_storage(storage, stochastic)
+        self.class_layer.set_storage(storage, stochastic)
+        return
+
+    def set_grad_storage(self, storage='dense'):
+        """Keep grads in 'dense' tables or 'packed' stores, in each layer.
+
+        See the set_grad_storage() method of the layers in NLMLayers.
+        """
+        self.word_layer.set_grad_storage(storage)
+        self.context_layer.set_grad_storage(storage)
+        self.class_layer.set_grad_storage(storage)
+        return
+
+    def get_config(self):
+        """Get the constructor args and settings that define this model."""
+        args = {'wv_dim': self.wv_dim, 'cv_dim': self.cv_dim, \
+                'max_wv_key': (self.max_wv_key - 1), \
+                'max_cv_key': self.max_cv_key, 'max_hs_key': self.max_hs_key, \
+                'pre_words': self.pre_words, 'lam_wv': self.lam_wv, \
+                'lam_cv': self.lam_cv, 'lam_cl': self.lam_cl}
+        attrs = {'reg_freq': self.reg_freq, 'drop_rate': self.drop_rate, \
+                 'fuzz_scale': self.fuzz_scale}
+        return {'args': args, 'attrs': attrs}
+
+    def flush_decay(self):
+        """Apply any pending (lazy) l2 decay in each layer.
+
+        See the flush_decay() method of the layers in NLMLayers.
+        """
+        self.word_layer.flush_decay()
+        self.context_layer.flush_decay()
+        self.class_layer.flush_decay()
+        return
+
     def batch_update(self, pre_keys, post_code_keys, post_code_signs, \
             phrase_keys, train_ctx=True, train_lut=True, train_cls=True, \
-            learn_rate=1e-3):
+            learn_rate=1e-3, post_code_offsets=None):
         """
         Perform a single "minibatch" update of the model parameters.
 
@@ -96,6 +188,8 @@ class PVModel:
             train_lut: train the basic word LUT vectors
             train_cls: train the hierarchical softmax parameters
             learn_rate: learning rate to use in parameter updates
+            post_code_offsets: CSR offsets for post_code_keys/signs, if the
+                               codes are in CSR form (else None)
         """
         # Feedforward through look-up-table, noise, and prediction layers
         Xw = self.word_layer.feedforward(pre_keys)
@@ -104,7 +198,7 @@ class PVModel:
 
         # Turn the corner with feedforward and backprop at class layer
         dLdXn, L = self.class_layer.ff_bp(Xn, post_code_keys, \
-                post_code_signs, do_grad=True)
+                post_code_signs, do_grad=True, code_offsets=post_code_offsets)
 
         # Backprop through remaining layers
         dLdXc = self.noise_layer.backprop(dLdXn)
@@ -120,18 +214,48 @@ class PVModel:
             self.class_layer.apply_grad(learn_rate=learn_rate)
         return L
 
-    def train(self, ngram_sampler, hsm_code_keys, hsm_code_signs, batch_size, \
-            batch_count, train_ctx=True, train_lut=True, train_cls=True, \
-            learn_rate=1e-3):
+    def sample_batch(self, ngram_sampler, hs_tree, batch_size):
+        """
+        Sample a batch of training n-grams, and fetch the HSM codes for their
+        final words. Returns the arguments for batch_update(), as a list:
+        [pre_keys, post_code_keys, post_code_signs, phrase_keys,
+         post_code_offsets].
+        """
+        [seq_keys, phrase_keys] = ngram_sampler.sample_ngrams( \
+            batch_size, gram_n=self.pre_words+1, pad_key=self.max_wv_key)
+        pre_keys = seq_keys[:,0:-1]
+        post_keys = seq_keys[:,-1]
+        post_code_offsets, post_code_keys, post_code_signs = \
+                cu.fetch_hsm_codes(hs_tree, post_keys)
+        return [pre_keys, post_code_keys, post_code_signs, phrase_keys, \
+                post_code_offsets]
+
+    def prefetch_batches(self, ngram_sampler, hs_tree, batch_size, \
+                         queue_size=8):
+        """
+        Get a CorpusUtils.BatchPrefetcher that prepares batches for train()
+        in a background thread. Pass it to train() in place of ngram_sampler,
+        and close() it when done.
+        """
+        batch_func = lambda: self.sample_batch(ngram_sampler, hs_tree, \
+                                               batch_size)
+        return cu.BatchPrefetcher(batch_func, queue_size=queue_size, \
+                                  batch_size=batch_size, sampler=ngram_sampler)
+
+    def train(self, ngram_sampler, hs_tree, batch_size, batch_count, \
+            train_ctx=True, train_lut=True, train_cls=True, learn_rate=1e-3):
         """
         Train all parameters in the model using the given phrases.
 
         Parameters:
             ngram_sampler: a sampler that produces ngrams in LUT key form,
-                           along with keys to their source context/phrase.
-            hsm_code_keys: table mapping word keys to their hsm code keys
-            hsm_code_signs: table mapping word keys to their hsm code signs
-            batch_size: size of minibatches for each update
+                           along with keys to their source context/phrase,
+                           or a BatchPrefetcher from prefetch_batches()
+            hs_tree: dict mapping word keys to their hsm code keys/signs, as
+                     returned by CorpusUtils.build_vocab() (not used when
+                     ngram_sampler is a BatchPrefetcher)
+            batch_size: size of minibatches for each update (which must
+                        match the batch_size of a BatchPrefetcher)
             batch_count: number of minibatch updates to perform
             train_ctx: train the per context/phrase bias vectors
             train_lut: train the basic word LUT vectors
@@ -144,16 +268,19 @@ class PVModel:
         self.class_layer.reset_moms(ada_init=1.0)
         pad_key = np.asarray([0]).astype(np.uint32)
         print("Training all parameters:")
+        check_batch_size(ngram_sampler, batch_size)
+        t0 = start_sampler_stats(ngram_sampler)
         for b in range(batch_count):
-            [seq_keys, phrase_keys] = ngram_sampler.sample_ngrams( \
-                batch_size, gram_n=self.pre_words+1, pad_key=self.max_wv_key)
-            pre_keys = seq_keys[:,0:-1]
-            post_keys = seq_keys[:,-1]
-            post_code_keys = hsm_code_keys.take(post_keys,axis=0)
-            post_code_signs = hsm_code_signs.take(post_keys,axis=0)
+            if hasattr(ngram_sampler, 'next_batch'):
+                batch = ngram_sampler.next_batch()
+            else:
+                batch = self.sample_batch(ngram_sampler, hs_tree, batch_size)
+            [pre_keys, post_code_keys, post_code_signs, phrase_keys, \
+                    post_code_offsets] = batch
             L += self.batch_update(pre_keys, post_code_keys, post_code_signs, \
                     phrase_keys, train_ctx=train_ctx, train_lut=train_lut, \
-                    train_cls=train_cls, learn_rate=learn_rate)
+                    train_cls=train_cls, learn_rate=learn_rate, \
+                    post_code_offsets=post_code_offsets)
             # apply l2 regularization, but not every round (to save flops)
             if ((b > 1) and ((b % self.reg_freq) == 0)):
                 reg_rate = learn_rate * self.reg_freq
@@ -173,21 +300,26 @@ class PVModel:
                 obs_count = 250.0 * batch_size
                 print("Batch {0:d}/{1:d}, loss {2:.4f}".format(b, batch_count, L/obs_count))
                 L = 0.0
+        self.flush_decay()
+        print_sampler_stats(ngram_sampler, batch_size*batch_count, t0)
         return
 
-    def infer_context_vectors(self, ngram_sampler, hsm_code_keys, hsm_code_signs, \
-            batch_size, batch_count, learn_rate=1e-3):
+    def infer_context_vectors(self, ngram_sampler, hs_tree, batch_size, \
+            batch_count, learn_rate=1e-3):
         """
         Train context/paragraph vectors for each of the given phrases.
 
         Parameters:
             ngram_sampler: a sampler that produces ngrams in LUT key form,
                            along with keys to their source phrases.
-            hsm_code_keys: table matching word keys to their hsm code keys
-            hsm_code_signs: table matching word keys to their hsm code signs
+            hs_tree: dict mapping word keys to their hsm code keys/signs, as
+                     returned by CorpusUtils.build_vocab()
             batch_size: batch size for minibatch updates
             batch_count: number of minibatch updates to perform
             learn_rate: learning rate for parameter updates
+
+        See ContextInference for batched, multi-threaded inference with a
+        frozen model, which stops early for each phrase.
         """
         # Put a new context layer in place of self.context_layer, but keep
         # a pointer to self.context_layer around to restore later...
@@ -197,6 +329,7 @@ class PVModel:
                                          bias_dim=self.cv_dim, \
                                          do_rescale=False)
         new_context_layer.init_params(0.02, param='Wb')
+        new_context_layer.set_grad_storage(self.context_layer.grad_storage)
         prev_context_layer = self.context_layer
         self.context_layer = new_context_layer
         # Update the context vectors in the new context layer for some number
@@ -208,11 +341,12 @@ class PVModel:
                     gram_n=self.pre_words+1, pad_key=self.max_wv_key)
             pre_keys = seq_keys[:,0:-1]
             post_keys = seq_keys[:,-1]
-            post_code_keys = hsm_code_keys.take(post_keys,axis=0)
-            post_code_signs = hsm_code_signs.take(post_keys,axis=0)
+            post_code_offsets, post_code_keys, post_code_signs = \
+                    cu.fetch_hsm_codes(hs_tree, post_keys)
             L += self.batch_update(pre_keys, post_code_keys, post_code_signs, \
                     phrase_keys, train_ctx=True, train_lut=False, \
-                    train_cls=False, learn_rate=learn_rate)
+                    train_cls=False, learn_rate=learn_rate, \
+                    post_code_offsets=post_code_offsets)
             # apply l2 regularization, but not every round (to save flops)
             if ((b > 1) and ((b % self.reg_freq) == 0)):
                 reg_rate = learn_rate * self.reg_freq
@@ -227,10 +361,11 @@ class PVModel:
                 obs_count = 250.0 * batch_size
                 print("Batch {0:d}/{1:d}, loss {2:.4f}".format(b, batch_count, L/obs_count))
                 L = 0.0
+        new_context_layer.flush_decay()
         # Set self.context_layer back to what it was prior to retraining
         self.word_layer.reset_grads()
         self.context_layer = prev_context_layer
-        self.context_laye.rest_grads()
+        self.context_layer.reset_grads()
         self.class_layer.reset_grads()
         return new_context_layer
 
@@ -258,7 +393,8 @@ class CAModel:
           Gaussian "weight fuzzing" noise for stronger regularization.
     """
     def __init__(self, wv_dim, cv_dim, max_wv_key, max_cv_key, use_ns=True, \
-                 max_hs_key=0, lam_wv=1e-4, lam_cv=1e-4, lam_cl=1e-4):
+                 max_hs_key=0, lam_wv=1e-4, lam_cv=1e-4, lam_cl=1e-4, \
+                 rand_init=True):
         # Record options/parameters
         self.wv_dim = wv_dim
         self.cv_dim = cv_dim
@@ -273,10 +409,12 @@ class CAModel:
         # Set noise layer parameters (for better regularization)
         self.drop_rate = 0.0
         self.fuzz_scale = 0.0
-        # Create layers to use during training
+        # Create layers to use during training (with their params set to 0
+        # if not rand_init, e.g. for loading saved params)
         self.use_tanh = True
         self.tanh_layer = nlml.TanhLayer()
-        self.word_layer = nlml.LUTLayer(max_wv_key, wv_dim)
+        self.word_layer = nlml.LUTLayer(max_wv_key, wv_dim, \
+                                        rand_init=rand_init)
         self.context_layer = nlml.CMLayer(max_key=max_cv_key, \
                                           source_dim=wv_dim, \
                                           bias_dim=cv_dim, \
@@ -285,11 +423,15 @@ class CAModel:
                                            fuzz_scale=self.fuzz_scale)
         if self.use_ns:
             self.class_layer = nlml.NSLayer(in_dim=(self.cv_dim+self.wv_dim), \
-                                            max_out_key=self.max_wv_key)
+                                            max_out_key=self.max_wv_key, \
+                                            rand_init=rand_init)
         else:
             assert(self.max_hs_key > 0)
             self.class_layer = nlml.HSMLayer(in_dim=(self.cv_dim+self.wv_dim), \
-                                             max_hs_key=self.max_hs_key)
+                                             max_hs_key=self.max_hs_key, \
+                                             rand_init=rand_init)
+        # id of the last checkpoint saved/loaded (see Checkpoints)
+        self.checkpoint_id = None
         return
 
     def init_params(self, weight_scale=0.05):
@@ -306,6 +448,47 @@ class CAModel:
         self.class_layer.reset_moms(ada_init)
         return
 
+    def set_storage(self, storage='float32', stochastic=False):
+        """Set the storage type for params and moms in each layer.
+
+        See the set_storage() method of the layers in NLMLayers.
+        """
+        self.word_layer.set_storage(storage, stochastic)
+        self.context_layer.set_storage(storage, stochastic)
+        self.class_layer.set_storage(storage, stochastic)
+        return
+
+    def set_grad_storage(self, storage='dense'):
+        """Keep grads in 'dense' tables or 'packed' stores, in each layer.
+
+        See the set_grad_storage() method of the layers in NLMLayers.
+        """
+        self.word_layer.set_grad_storage(storage)
+        self.context_layer.set_grad_storage(storage)
+        self.class_layer.set_grad_storage(storage)
+        return
+
+    def get_config(self):
+        """Get the constructor args and settings that define this model."""
+        args = {'wv_dim': self.wv_dim, 'cv_dim': self.cv_dim, \
+                'max_wv_key': self.max_wv_key, 'max_cv_key': self.max_cv_key, \
+                'use_ns': self.use_ns, 'max_hs_key': self.max_hs_key, \
+                'lam_wv': self.lam_wv, 'lam_cv': self.lam_cv, \
+                'lam_cl': self.lam_cl}
+        attrs = {'reg_freq': self.reg_freq, 'drop_rate': self.drop_rate, \
+                 'fuzz_scale': self.fuzz_scale, 'use_tanh': self.use_tanh}
+        return {'args': args, 'attrs': attrs}
+
+    def flush_decay(self):
+        """Apply any pending (lazy) l2 decay in each layer.
+
+        See the flush_decay() method of the layers in NLMLayers.
+        """
+        self.word_layer.flush_decay()
+        self.context_layer.flush_decay()
+        self.class_layer.flush_decay()
+        return
+
     def set_noise(self, drop_rate=0.0, fuzz_scale=0.0):
         """Set params for the noise injection (i.e. perturbation) layer."""
         self.noise_layer.set_noise_params(drop_rate=drop_rate, \
@@ -316,7 +499,7 @@ class CAModel:
 
     def batch_update(self, anc_keys, param_1, param_2, phrase_keys, \
                      train_ctx=True, train_lut=True, train_cls=True, \
-                     learn_rate=1e-3):
+                     learn_rate=1e-3, code_offsets=None):
         """
         Perform a single "minibatch" update of the model parameters.
 
@@ -335,6 +518,8 @@ class CAModel:
             train_lut: train the basic word LUT vectors
             train_cls: train the classification layer parameters
             learn_rate: learning rate for adagrad updates
+            code_offsets: CSR offsets for the HSM codes in param_1/param_2,
+                          if they are in CSR form (else None)
         """
         # Feedforward through the various layers of this model
         Xb = self.word_layer.feedforward(anc_keys)
@@ -346,7 +531,13 @@ class CAModel:
         Xn = self.noise_layer.feedforward(Xt)
 
         # Turn the corner with feedforward and backprop at class layer
-        dLdXn, L = self.class_layer.ff_bp(Xn, param_1, param_2, do_grad=True)
+        if code_offsets is None:
+            dLdXn, L = self.class_layer.ff_bp(Xn, param_1, param_2, \
+                                              do_grad=True)
+        else:
+            dLdXn, L = self.class_layer.ff_bp(Xn, param_1, param_2, \
+                                              do_grad=True, \
+                                              code_offsets=code_offsets)
 
         # Backprop through layers based on feedforward result
         dLdXt = self.noise_layer.backprop(dLdXn)
@@ -366,18 +557,50 @@ class CAModel:
             self.class_layer.apply_grad(learn_rate=learn_rate)
         return L
 
+    def sample_batch(self, pos_sampler, var_param, batch_size):
+        """
+        Sample a batch of training pairs, along with their negative samples
+        or HSM codes. Returns the arguments for batch_update(), as a list:
+        [anc_keys, param_1, param_2, phrase_keys, code_offsets].
+        """
+        anc_keys, pos_keys, phrase_keys = pos_sampler.sample_pairs(batch_size)
+        code_offsets = None
+        if self.use_ns:
+            param_1 = pos_keys
+            param_2 = var_param.sample(batch_size)
+        else:
+            code_offsets, param_1, param_2 = \
+                    cu.fetch_hsm_codes(var_param, pos_keys)
+        return [anc_keys, param_1, param_2, phrase_keys, code_offsets]
+
+    def prefetch_batches(self, pos_sampler, var_param, batch_size, \
+                         queue_size=8):
+        """
+        Get a CorpusUtils.BatchPrefetcher that prepares batches for train()
+        in a background thread. Pass it to train() in place of pos_sampler,
+        and close() it when done.
+        """
+        batch_func = lambda: self.sample_batch(pos_sampler, var_param, \
+                                               batch_size)
+        return cu.BatchPrefetcher(batch_func, queue_size=queue_size, \
+                                  batch_size=batch_size, sampler=pos_sampler)
+
     def train(self, pos_sampler, var_param, batch_size, batch_count, \
               train_ctx=True, train_lut=True, train_cls=True, learn_rate=1e-3):
         """
         Train all parameters in the model using the given phrases.
 
         Parameters:
-            pos_sampler: sampler for generating positive prediction pairs
+            pos_sampler: sampler for generating positive prediction pairs,
+                         or a BatchPrefetcher from prefetch_batches()
             if self.use_ns:
                 var_param: sampler for generating negative prediction pairs
             else:
-                var_param: dict containing HSM code keys and signs (in LUTs)
-            batch_size: size of minibatches for each update
+                var_param: dict containing HSM code keys and signs, as
+                           returned by CorpusUtils.build_vocab()
+            (var_param is not used when pos_sampler is a BatchPrefetcher)
+            batch_size: size of minibatches for each update (which must
+                        match the batch_size of a BatchPrefetcher)
             batch_count: number of minibatch updates to perform
             train_ctx: train the per context/phrase biases/modulators
             train_lut: train the basic word LUT vectors
@@ -385,21 +608,22 @@ class CAModel:
             learn_rate: learning rate for adagrad updates
         """
         print("Training all parameters:")
+        check_batch_size(pos_sampler, batch_size)
+        t0 = start_sampler_stats(pos_sampler)
         L = 0.0
         self.word_layer.reset_moms(1.0)
         self.context_layer.reset_moms(1.0)
         self.class_layer.reset_moms(1.0)
         for b in range(batch_count):
-            anc_keys, pos_keys, phrase_keys = pos_sampler.sample_pairs(batch_size)
-            if self.use_ns:
-                param_1 = pos_keys
-                param_2 = var_param.sample(batch_size)
+            if hasattr(pos_sampler, 'next_batch'):
+                batch = pos_sampler.next_batch()
             else:
-                param_1 = var_param['keys_to_code_keys'].take(pos_keys,axis=0)
-                param_2 = var_param['keys_to_code_signs'].take(pos_keys,axis=0)
+                batch = self.sample_batch(pos_sampler, var_param, batch_size)
+            [anc_keys, param_1, param_2, phrase_keys, code_offsets] = batch
             L += self.batch_update(anc_keys, param_1, param_2, phrase_keys, \
                                    train_ctx=train_ctx, train_lut=train_lut, \
-                                   train_cls=train_cls, learn_rate=learn_rate)
+                                   train_cls=train_cls, learn_rate=learn_rate, \
+                                   code_offsets=code_offsets)
             # apply l2 regularization, but not every round (to save flops)
             if ((b > 1) and ((b % self.reg_freq) == 0)):
                 reg_rate = learn_rate * self.reg_freq
@@ -419,6 +643,8 @@ class CAModel:
                 obs_count = 500.0 # * batch_size
                 print("Batch {0:d}/{1:d}, loss {2:.4f}".format(b, batch_count, L/obs_count))
                 L = 0.0
+        self.flush_decay()
+        print_sampler_stats(pos_sampler, batch_size*batch_count, t0)
         return
 
     def infer_context_vectors(self, pos_sampler, var_param, batch_size, \
@@ -431,9 +657,13 @@ class CAModel:
             if self.use_ns:
                 var_param: sampler for generating negative prediction pairs
             else:
-                var_param: dict containing HSM code keys and signs (in LUTs)
+                var_param: dict containing HSM code keys and signs, as
+                           returned by CorpusUtils.build_vocab()
             batch_size: size of minibatches for each update
             batch_count: number of minibatch updates to perform
+
+        See ContextInference for batched, multi-threaded inference with a
+        frozen model, which stops early for each phrase.
         """
         # Put a new context layer in place of self.context_layer, but keep
         # a pointer to self.context_layer around to restore later...
@@ -443,6 +673,7 @@ class CAModel:
                                          bias_dim=self.cv_dim, \
                                          do_rescale=True)
         new_context_layer.init_params(0.02)
+        new_context_layer.set_grad_storage(self.context_layer.grad_storage)
         prev_context_layer = self.context_layer
         self.context_layer = new_context_layer
         self.context_layer.reset_moms(1.0)
@@ -450,15 +681,17 @@ class CAModel:
         L = 0.0
         for b in range(batch_count):
             anc_keys, pos_keys, phrase_keys = pos_sampler.sample_pairs(batch_size)
+            code_offsets = None
             if self.use_ns:
                 param_1 = pos_keys
                 param_2 = var_param.sample(batch_size)
             else:
-                param_1 = var_param['keys_to_code_keys'].take(pos_keys,axis=0)
-                param_2 = var_param['keys_to_code_signs'].take(pos_keys,axis=0)
+                code_offsets, param_1, param_2 = \
+                        cu.fetch_hsm_codes(var_param, pos_keys)
             L += self.batch_update(anc_keys, param_1, param_2, phrase_keys, \
                                    train_ctx=True, train_lut=False, \
-                                   train_cls=False, learn_rate=learn_rate)
+                                   train_cls=False, learn_rate=learn_rate, \
+                                   code_offsets=code_offsets)
             if ((b > 1) and ((b % self.reg_freq) == 0)):
                 reg_rate = learn_rate * self.reg_freq
                 self.context_layer.l2_regularize(lam_Wm=(reg_rate*self.lam_cv), \
@@ -471,6 +704,7 @@ class CAModel:
                 obs_count = 500.0 * batch_size
                 print("Batch {0:d}/{1:d}, loss {2:.4f}".format(b, batch_count, L/obs_count))
                 L = 0.0
+        new_context_layer.flush_decay()
         # Set self.context_layer back to what it was previously
         self.context_layer = prev_context_layer
         # Reset gradients in all layers
@@ -492,16 +726,20 @@ class W2VModel:
       max_wv_key: max key of a valid word in the LUTs
       lam_l2: l2 regularization parameter for word vectors
     """
-    def __init__(self, wv_dim, max_wv_key, lam_l2=1e-4):
+    def __init__(self, wv_dim, max_wv_key, lam_l2=1e-4, rand_init=True):
         # Record options/parameters
         self.wv_dim = wv_dim
         self.max_wv_key = max_wv_key
         self.lam_l2 = lam_l2
         self.reg_freq = 20 # number of batches between regularization updates
-        # Create the layer to use during training
+        # Create the layer to use during training (with its params set to 0
+        # if not rand_init, e.g. for loading saved params)
         self.w2v_layer = nlml.W2VLayer(max_word_key=self.max_wv_key, \
                                        word_dim=self.wv_dim, \
-                                       lam_l2=self.lam_l2)
+                                       lam_l2=self.lam_l2, \
+                                       rand_init=rand_init)
+        # id of the last checkpoint saved/loaded (see Checkpoints)
+        self.checkpoint_id = None
         return
 
     def init_params(self, weight_scale=0.05):
@@ -514,6 +752,34 @@ class W2VModel:
         self.w2v_layer.reset_moms(ada_init)
         return
 
+    def set_storage(self, storage='float32', stochastic=False):
+        """Set the storage type for params and moms in the W2VLayer.
+
+        See the set_storage() method of the layers in NLMLayers.
+        """
+        self.w2v_layer.set_storage(storage, stochastic)
+        return
+
+    def set_grad_storage(self, storage='dense'):
+        """Keep grads in 'dense' tables or 'packed' stores, in the W2VLayer.
+
+        See the set_grad_storage() method of the layers in NLMLayers.
+        """
+        self.w2v_layer.set_grad_storage(storage)
+        return
+
+    def get_config(self):
+        """Get the constructor args and settings that define this model."""
+        args = {'wv_dim': self.wv_dim, 'max_wv_key': self.max_wv_key, \
+                'lam_l2': self.lam_l2}
+        attrs = {'reg_freq': self.reg_freq}
+        return {'args': args, 'attrs': attrs}
+
+    def flush_decay(self):
+        """Apply any pending (lazy) l2 decay in the W2VLayer."""
+        self.w2v_layer.flush_decay()
+        return
+
     def batch_update(self, anc_keys, pos_keys, neg_keys, learn_rate=1e-3):
         """
         Perform a single "minibatch" update of the model parameters.
@@ -529,6 +795,28 @@ class W2VModel:
                                        learn_rate=learn_rate)
         return L
 
+    def sample_batch(self, pos_sampler, neg_sampler, batch_size):
+        """
+        Sample a batch of training pairs and negative examples. Returns the
+        arguments for batch_update(), as a list: [anc_keys, pos_keys,
+        neg_keys].
+        """
+        anc_keys, pos_keys, phrase_keys = pos_sampler.sample_pairs(batch_size)
+        neg_keys = neg_sampler.sample(batch_size)
+        return [anc_keys, pos_keys, neg_keys]
+
+    def prefetch_batches(self, pos_sampler, neg_sampler, batch_size, \
+                         queue_size=8):
+        """
+        Get a CorpusUtils.BatchPrefetcher that prepares batches for train()
+        in a background thread. Pass it to train() in place of pos_sampler,
+        and close() it when done.
+        """
+        batch_func = lambda: self.sample_batch(pos_sampler, neg_sampler, \
+                                               batch_size)
+        return cu.BatchPrefetcher(batch_func, queue_size=queue_size, \
+                                  batch_size=batch_size, sampler=pos_sampler)
+
     def train(self, pos_sampler, neg_sampler, batch_size, batch_count, \
               learn_rate=1e-3):
         """
@@ -538,17 +826,25 @@ class W2VModel:
         words from the "negative contrastive sampling" distribution.
 
         Parameters:
-            pos_sampler: sampler for generating positive prediction pairs
-            neg_sampler: sampler for generating contrastive examples
-            batch_size: size of minibatches for each update
+            pos_sampler: sampler for generating positive prediction pairs,
+                         or a BatchPrefetcher from prefetch_batches()
+            neg_sampler: sampler for generating contrastive examples (not
+                         used when pos_sampler is a BatchPrefetcher)
+            batch_size: size of minibatches for each update (which must
+                        match the batch_size of a BatchPrefetcher)
             batch_count: number of minibatch updates to perform
             learn_rate: learning rate for adagrad updates
         """
         L = 0.0
         print("Training all parameters:")
+        check_batch_size(pos_sampler, batch_size)
+        t0 = start_sampler_stats(pos_sampler)
         for b in range(batch_count):
-            anc_keys, pos_keys, phrase_keys = pos_sampler.sample_pairs(batch_size)
-            neg_keys = neg_sampler.sample(batch_size)
+            if hasattr(pos_sampler, 'next_batch'):
+                batch = pos_sampler.next_batch()
+            else:
+                batch = self.sample_batch(pos_sampler, neg_sampler, batch_size)
+            [anc_keys, pos_keys, neg_keys] = batch
             L += self.batch_update(anc_keys, pos_keys, neg_keys, learn_rate=learn_rate)
             if ((b > 1) and ((b % self.reg_freq) == 0)):
                 lam_multi = self.reg_freq * learn_rate * self.lam_l2
@@ -557,6 +853,8 @@ class W2VModel:
                 obs_count = 1000.0# * batch_size
                 print("Batch {0:d}/{1:d}, loss {2:.4f}".format(b, batch_count, L/obs_count))
                 L = 0.0
+        self.flush_decay()
+        print_sampler_stats(pos_sampler, batch_size*batch_count, t0)
         return
 
     def test(self, pos_sampler, neg_sampler, test_samples):
@@ -582,7 +880,7 @@ def some_nearest_words(keys_to_words, sample_count, W1=None, W2=None):
     if not (W2 is None):
         W = np.hstack((W1, W2))
     else:
-        W = W1
+        W = np.asarray(W1)
     norms = np.sqrt(np.sum(W**2.0,axis=1,keepdims=1))
     W = W / (norms + 1e-5)
     max_valid_key = np.max(keys_to_words.keys())
@@ -641,7 +939,8 @@ def test_cam_model():
     cam.set_noise(drop_rate=0.5, fuzz_scale=0.0)
 
     # initialize samplers for drawing positive pairs and negative contrastors
-    pos_sampler = cu.PhraseSampler(tr_phrases, sg_window)
+    pos_sampler = cu.PhraseSampler(tr_phrases, sg_window, \
+                                   keep_probs=key_dicts['keep_probs'])
     neg_sampler = cu.NegSampler(neg_table=neg_table, neg_count=ns_count)
 
     # train all parameters using the training set phrases
@@ -668,8 +967,7 @@ def test_pv_model():
     sentences = cu.SentenceFileIterator(data_dir)
     tr_phrases = cu.sample_phrases(sentences, w2k, unk_word=unk_word, \
                                 max_phrases=100000)
-    hsm_code_keys = key_dicts['hs_tree']['keys_to_code_keys']
-    hsm_code_signs = key_dicts['hs_tree']['keys_to_code_signs']
+    hs_tree = key_dicts['hs_tree']
     max_cv_key = len(tr_phrases) + 1
     max_wv_key = max(w2k.values()) + 1
     max_hs_key = key_dicts['hs_tree']['max_code_key']
@@ -688,12 +986,13 @@ def test_pv_model():
     pvm.set_noise(drop_rate=0.5, fuzz_scale=0.0)
 
     # Initialize samplers for training
-    ngram_sampler = cu.PhraseSampler(tr_phrases, sg_window)
+    ngram_sampler = cu.PhraseSampler(tr_phrases, sg_window, \
+                                     keep_probs=key_dicts['keep_probs'])
 
     # Train all parameters using the training set phrases
     for i in range(100):
-        pvm.train(ngram_sampler, hsm_code_keys, hsm_code_signs, 300, 10001, \
-                train_ctx=True, train_lut=True, train_cls=True, learn_rate=1e-3)
+        pvm.train(ngram_sampler, hs_tree, 300, 10001, train_ctx=True, \
+                train_lut=True, train_cls=True, learn_rate=1e-3)
         [s_keys, n_keys, s_words, n_words] = some_nearest_words( k2w, 10, \
                 W1=pvm.word_layer.params['W'], W2=None)
         for w in range(10):
@@ -725,7 +1024,8 @@ def test_w2v_model():
     w2vm.init_params(0.025)
 
     # initialize samplers for drawing positive pairs and negative contrastors
-    pos_sampler = cu.PhraseSampler(tr_phrases, sg_window)
+    pos_sampler = cu.PhraseSampler(tr_phrases, sg_window, \
+                                   keep_probs=key_dicts['keep_probs'])
     neg_sampler = cu.NegSampler(neg_table=neg_table, neg_count=ns_count)
 
     # train all parameters using the training set phrases
@@ -739,6 +1039,42 @@ def test_w2v_model():
         for w in range(10):
             print("{0:s}: {1:s}".format(s_words[w],", ".join(n_words[w])))
 
+def run_infer_alloc_bench(word_count=100000, wv_dim=100, cv_dim=10, \
+                          phrase_count=1000, call_count=5, batch_count=50, \
+                          batch_size=200):
+    """Measure memory allocated by calls to CAModel.infer_context_vectors().
+
+    Uses random phrases. For each call, this reports the peak memory traced
+    by tracemalloc (which includes numpy arrays), above what was in use
+    before the call. The new context layer returned by each call accounts
+    for some of this, so its size is reported too.
+    """
+    import tracemalloc
+    rs = npr.RandomState(1)
+    phrases = [rs.randint(0, word_count, size=(rs.randint(5, 30),)).astype( \
+               np.uint32) for i in range(phrase_count)]
+    cam = CAModel(wv_dim, cv_dim, (word_count - 1), phrase_count, use_ns=True)
+    cam.init_params(0.05)
+    pos_sampler = cu.PhraseSampler(phrases, 5)
+    neg_sampler = cu.NegSampler(neg_table=np.arange(word_count, \
+                                dtype=np.uint32), neg_count=10)
+    table_mb = (4.0 * word_count * wv_dim) / 1e6
+    print("word table: {0:.1f}MB".format(table_mb))
+    tracemalloc.start()
+    for i in range(call_count):
+        tracemalloc.reset_peak()
+        base_bytes = tracemalloc.get_traced_memory()[0]
+        ctx_layer = cam.infer_context_vectors(pos_sampler, neg_sampler, \
+                                              batch_size, batch_count)
+        peak_bytes = tracemalloc.get_traced_memory()[1] - base_bytes
+        ctx_bytes = sum([np.asarray(t).nbytes for d in [ctx_layer.params, \
+                         ctx_layer.grads, ctx_layer.moms] for t in d.values()])
+        print("call {0:d}: peak alloc {1:.1f}MB, new context layer {2:.1f}MB".format( \
+              i, (peak_bytes / 1e6), (ctx_bytes / 1e6)))
+        del ctx_layer
+    tracemalloc.stop()
+    return
+
 if __name__=="__main__":
     #test_cam_model()
     #test_pv_model()
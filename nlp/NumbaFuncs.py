@@ -1,128 +1,184 @@
 from __future__ import absolute_import
 
+import sys
 import numpy as np
 import numpy.random as npr
-import threading
 import numba
 from math import exp, log, sqrt
-from numba import jit, void, i4, f4, u4
-from ctypes import pythonapi, c_void_p
+from numba import jit, void, i4, i8, f4, u4
+from KernelPool import make_multithread, set_thread_num, get_thread_num, \
+                       set_scatter_mode, get_scatter_mode
+from LogisticTables import get_logistic_table
 
+# these match the constants in CythonFuncsPyx.pyx, so that the kernels here
+# are drop-in replacements for the ones in CythonFuncs (see KernelBackends)
 ADA_EPS = 0.001
+ADA_RHO = 0.98
+MAX_HSM_KEY = 12345678
 
-########################################
-# MULTITHREADING HELPER-FUNC AND DEFNS #
-########################################
-
-THREAD_NUM = 4
-
-savethread = pythonapi.PyEval_SaveThread
-savethread.argtypes = []
-savethread.restype = c_void_p
-
-restorethread = pythonapi.PyEval_RestoreThread
-restorethread.argtypes = [c_void_p]
-restorethread.restype = None
-
-def make_multithread(inner_func, numthreads):
-    def func_mt(*args):
-        length = len(args[0])
-        sp_idx = np.arange(0,length).astype(np.int32)
-        chunklen = (length + (numthreads-1)) // numthreads
-        chunkargs = [(sp_idx[i*chunklen:(i+1)*chunklen],)+args for i in range(numthreads)]
-        # Start a thread for all but the last chunk of work
-        threads = [threading.Thread(target=inner_func, args=cargs)
-                   for cargs in chunkargs[:-1]]
-        for thread in threads:
-            thread.start()
-        # Give the last chunk of work to the main thread
-        inner_func(*chunkargs[-1])
-        for thread in threads:
-            thread.join()
-        return 1
-    def func_st(*args):
-        length = len(args[0])
-        sp_idx = np.arange(0,length).astype(np.int32)
-        sp_args = (sp_idx,) + args
-        inner_fun(*sp_args)
-    func = None
-    if numthreads == 1:
-        func = func_st
-    else:
-        func = func_mt
-    return func_mt
+# All kernels are compiled with nogil=True, which lets the threads started by
+# make_multithread run them in parallel, and with cache=True, which saves the
+# compiled code next to this file so later imports skip the compile.
+
+###############################
+# VECTORIZED ROW HELPER-FUNCS #
+###############################
+
+# The kernels below do all their per-row work through these helpers, on rows
+# of C-contiguous tables. With unit stride and fastmath (which lets LLVM
+# reorder the sum in row_dot), the k-loops compile to packed SIMD ops, in
+# place of the sdot/saxpy BLAS calls used by the Cython kernels.
+
+@numba.jit("f4(f4[::1], f4[::1])", nopython=True, nogil=True, fastmath=True, \
+           cache=True)
+def row_dot(x, y):
+    """Get the dot product of rows x and y."""
+    acc = np.float32(0.0)
+    for k in range(x.shape[0]):
+        acc += x[k] * y[k]
+    return acc
+
+@numba.jit("void(f4, f4[::1], f4[::1])", nopython=True, nogil=True, \
+           fastmath=True, cache=True)
+def row_axpy(a, x, y):
+    """Add a * x to the row y, in place."""
+    for k in range(x.shape[0]):
+        y[k] += a * x[k]
+    return
+
+@numba.jit("UniTuple(f4, 2)(f4, f4[::1], f4, f4)", nopython=True, nogil=True, \
+           cache=True)
+def table_logistic(z, table, z_max, inv_step):
+    """Look up (softplus(z), sigmoid(z)) in a table from LogisticTables."""
+    if z >= z_max:
+        return (z, np.float32(1.0))
+    if z <= -z_max:
+        return (np.float32(0.0), np.float32(0.0))
+    t = (z + z_max) * inv_step
+    i = min(int(t), ((table.shape[0] // 2) - 2))
+    f = t - i
+    j = 2 * i
+    return (table[j] + f * (table[j+2] - table[j]), \
+            table[j+1] + f * (table[j+3] - table[j+1]))
 
 ##############################
 # NUMBA FUNCTION DEFINITIONS #
 ##############################
 
-def w2v_ff_bp_sp(sp_idx, anc_idx, pn_idx, pn_sign, Wa, Wc, b, dWa, dWc, db, L, do_grad):
-    """Feedforward and backprop for unified (neg-sample) word-2-vec layer."""
-    threadstate = savethread()
+def w2v_ff_bp_sp(sp_idx, anc_keys, pn_keys, pn_sign, Wa, Wc, b, dWa, dWc, db, L, do_grad, \
+                 lt, lt_max, lt_inv):
+    """Feedforward and backprop for unified (neg-sample) word-2-vec layer.
+
+    If the logistic table lt is not empty, the loss and gradient come from
+    table lookups (see LogisticTables).
+    """
     sp_size = sp_idx.shape[0]
-    cols = pn_idx.shape[1]
-    vec_dim = Wa.shape[1]
+    cols = pn_keys.shape[1]
+    use_table = (lt.shape[0] > 0)
     for sp_i in range(sp_size):
         i = sp_idx[sp_i]
-        ai = anc_idx[i]
+        ai = anc_keys[i]
         for j in range(cols):
-            ci = pn_idx[i,j]
-            y = b[ci]
-            for k in range(vec_dim):
-                y += (Wa[ai,k] * Wc[ci,k])
-            exp_pns_y = exp(pn_sign[i,j] * y)
-            L[0] += log(1.0 + exp_pns_y)
+            ci = pn_keys[i,j]
+            y = b[ci] + row_dot(Wa[ai], Wc[ci])
+            neg_label = -1.0 * pn_sign[i,j]
+            if use_table:
+                sp_z, sg_z = table_logistic(neg_label * y, lt, lt_max, lt_inv)
+            else:
+                exp_pns_y = exp(neg_label * y)
+                sp_z = log(1.0 + exp_pns_y)
+                sg_z = exp_pns_y / (1.0 + exp_pns_y)
+            L[0] += sp_z
             if (do_grad == 1):
-                dLdy = pn_sign[i,j] * (exp_pns_y / (1.0 + exp_pns_y))
-                db[ci] = db[ci] + dLdy
-                for k in range(vec_dim):
-                    dWa[ai,k] += (dLdy * Wc[ci,k])
-                    dWc[ci,k] += (dLdy * Wa[ai,k])
-    restorethread(threadstate)
+                g = neg_label * sg_z
+                db[ci] = db[ci] + g
+                row_axpy(g, Wc[ci], dWa[ai])
+                row_axpy(g, Wa[ai], dWc[ci])
+    return
+fn_sig_1 = void(i4[:], u4[:], u4[:,:], f4[:,:], f4[:,::1], f4[:,::1], f4[:], f4[:,::1], f4[:,::1], f4[:], f4[:], i4, f4[::1], f4, f4)
+w2v_ff_bp_st = jit(fn_sig_1, nopython=True, nogil=True, cache=True)(w2v_ff_bp_sp)
+# scatter gives (key arg, param args, grad args) for the shared rows that a
+# kernel adds grads into, see KernelPool.make_multithread
+w2v_ff_bp_mt = make_multithread(w2v_ff_bp_st, \
+        scatter=((0, (3,), (6,)), (1, (4, 5), (7, 8))), sums=(9,))
+
+def w2v_ff_bp(anc_keys, pn_keys, pn_sign, Wa, Wc, b, dWa, dWc, db, L, do_grad):
+    """Run w2v_ff_bp_sp (multithreaded), with the current logistic table."""
+    lt, lt_max, lt_inv = get_logistic_table()
+    return w2v_ff_bp_mt(anc_keys, pn_keys, pn_sign, Wa, Wc, b, dWa, dWc, db, \
+                        L, do_grad, lt, lt_max, lt_inv)
+
+def nsl_ff_bp_sp(sp_idx, pn_keys, pn_sign, X, W, b, dX, dW, db, L, do_grad, \
+                 lt, lt_max, lt_inv):
+    """Feedforward and backprop for NSLayer, like nsl_ff_bp_pyx.
+
+    Keys >= MAX_HSM_KEY mark padding, and are skipped. The logistic table
+    lt is used as in w2v_ff_bp_sp.
+    """
+    sp_size = sp_idx.shape[0]
+    cols = pn_keys.shape[1]
+    use_table = (lt.shape[0] > 0)
+    for sp_i in range(sp_size):
+        i = sp_idx[sp_i]
+        for j in range(cols):
+            key = pn_keys[i,j]
+            if (key < MAX_HSM_KEY):
+                y = b[key] + row_dot(X[i], W[key])
+                neg_label = -1.0 * pn_sign[i,j]
+                if use_table:
+                    sp_z, sg_z = table_logistic(neg_label * y, lt, lt_max, \
+                                                lt_inv)
+                else:
+                    exp_pns_y = exp(neg_label * y)
+                    sp_z = log(1.0 + exp_pns_y)
+                    sg_z = exp_pns_y / (1.0 + exp_pns_y)
+                L[i,j] = sp_z
+                if (do_grad == 1):
+                    g = neg_label * sg_z
+                    db[key] = db[key] + g
+                    row_axpy(g, X[i], dW[key])
+                    row_axpy(g, W[key], dX[i])
     return
-fn_sig_1 = void(i4[:], i4[:], i4[:,:], f4[:,:], f4[:,:], f4[:,:], f4[:], f4[:,:], f4[:,:], f4[:], f4[:], i4)
-w2v_ff_bp_st = jit(fn_sig_1, nopython=True)(w2v_ff_bp_sp)
-w2v_ff_bp = make_multithread(w2v_ff_bp_st, THREAD_NUM)
+fn_sig_7 = void(i4[:], u4[:,:], f4[:,:], f4[:,::1], f4[:,::1], f4[:], f4[:,::1], f4[:,::1], f4[:], f4[:,:], i4, f4[::1], f4, f4)
+nsl_ff_bp_st = jit(fn_sig_7, nopython=True, nogil=True, cache=True)(nsl_ff_bp_sp)
+nsl_ff_bp_mt = make_multithread(nsl_ff_bp_st, scatter=((0, (3, 4), (6, 7)),))
+
+def nsl_ff_bp(pn_keys, pn_sign, X, W, b, dX, dW, db, L, do_grad):
+    """Run nsl_ff_bp_sp (multithreaded), with the current logistic table."""
+    lt, lt_max, lt_inv = get_logistic_table()
+    return nsl_ff_bp_mt(pn_keys, pn_sign, X, W, b, dX, dW, db, L, do_grad, \
+                        lt, lt_max, lt_inv)
 
 def nsl_bp_sp(sp_idx, table_idx, X, W, dLdY, dLdX, dW, db):
     """Backprop for NSLayer: main loop in Numba-friendly form."""
-    threadstate = savethread()
     rows = sp_idx.shape[0]
     cols = dLdY.shape[1]
-    vec_dim = X.shape[1]
     for spi in range(rows):
         i = sp_idx[spi]
         for j in range(cols):
             dldy = dLdY[i,j]
             idx = table_idx[i,j]
             db[idx] += dldy
-            for k in range(vec_dim):
-                dW[idx,k] += dldy * X[i,k]
-                dLdX[i,k] += dldy * W[idx,k]
-    restorethread(threadstate)
+            row_axpy(dldy, X[i], dW[idx])
+            row_axpy(dldy, W[idx], dLdX[i])
     return
-fn_sig_2 = void(i4[:], i4[:,:], f4[:,:], f4[:,:], f4[:,:], f4[:,:], f4[:,:], f4[:])
-nsl_bp_st = jit(fn_sig_2, nopython=True)(nsl_bp_sp)
-nsl_bp = make_multithread(nsl_bp_st, THREAD_NUM)
+fn_sig_2 = void(i4[:], i4[:,:], f4[:,::1], f4[:,::1], f4[:,:], f4[:,::1], f4[:,::1], f4[:])
+nsl_bp_st = jit(fn_sig_2, nopython=True, nogil=True, cache=True)(nsl_bp_sp)
+nsl_bp = make_multithread(nsl_bp_st, scatter=((0, (2,), (5, 6)),))
 
 def nsl_ff_sp(sp_idx, table_idx, X, W, b, Y):
     """Feedforward for NSLayer: main loop in Numba-friendly form."""
-    threadstate = savethread()
     rows = sp_idx.shape[0]
     cols = table_idx.shape[1]
-    vec_dim = X.shape[1]
     for spi in range(rows):
         i = sp_idx[spi]
         for j in range(cols):
             idx = table_idx[i,j]
-            Y[i,j] = b[idx]
-            for k in range(vec_dim):
-                Y[i,j] += X[i,k] * W[idx,k]
-    restorethread(threadstate)
+            Y[i,j] = b[idx] + row_dot(X[i], W[idx])
     return
-fn_sig_3 = void(i4[:], i4[:,:], f4[:,:], f4[:,:], f4[:], f4[:,:])
-nsl_ff_st = jit(fn_sig_3, nopython=True)(nsl_ff_sp)
-nsl_ff = make_multithread(nsl_ff_st, THREAD_NUM)
+fn_sig_3 = void(i4[:], i4[:,:], f4[:,::1], f4[:,::1], f4[:], f4[:,:])
+nsl_ff_st = jit(fn_sig_3, nopython=True, nogil=True, cache=True)(nsl_ff_sp)
+nsl_ff = make_multithread(nsl_ff_st)
 
 def ag_update_2d_sp(sp_idx, row_idx, W, dW, mW, learn_rate):
     """Element-wise partial update ala adagrad.
@@ -131,22 +187,21 @@ def ag_update_2d_sp(sp_idx, row_idx, W, dW, mW, learn_rate):
     of squares in mW, then updates the params in W, and finally sets the
     grads in dW back to 0.
     """
-    threadstate = savethread()
     row_count = sp_idx.shape[0]
     vec_dim = W.shape[1]
     for spi in range(row_count):
         idx = row_idx[sp_idx[spi]]
         for j in range(vec_dim):
-            mW[idx,j] = (0.95 * mW[idx,j]) + (0.05 * dW[idx,j] * dW[idx,j])
+            mW[idx,j] = (ADA_RHO * mW[idx,j]) + ((1.0 - ADA_RHO) * dW[idx,j] * dW[idx,j])
             W[idx,j] -= (learn_rate * (dW[idx,j] / (sqrt(mW[idx,j]) + ADA_EPS)))
             dW[idx,j] = 0.0
-    restorethread(threadstate)
     return
-fn_sig_4 = void(i4[:], i4[:], f4[:,:], f4[:,:], f4[:,:], f4)
-ag_update_2d_st = jit(fn_sig_4, nopython=True)(ag_update_2d_sp)
-ag_update_2d = make_multithread(ag_update_2d_st, THREAD_NUM)
+fn_sig_4 = void(i4[:], u4[:], f4[:,:], f4[:,:], f4[:,:], f4)
+ag_update_2d_st = jit(fn_sig_4, nopython=True, nogil=True, cache=True)(ag_update_2d_sp)
+ag_update_2d = make_multithread(ag_update_2d_st)
 
-@numba.jit("void(i4[:], f4[:], f4[:], f4[:], f4)")
+@numba.jit("void(u4[:], f4[:], f4[:], f4[:], f4)", nopython=True, nogil=True, \
+           cache=True)
 def ag_update_1d(row_idx, W, dW, mW, learn_rate):
     """Element-wise partial update ala adagrad.
 
@@ -157,7 +212,7 @@ def ag_update_1d(row_idx, W, dW, mW, learn_rate):
     row_count = row_idx.shape[0]
     for i in range(row_count):
         idx = row_idx[i]
-        mW[idx] = (0.95 * mW[idx]) + (0.05 * dW[idx] * dW[idx])
+        mW[idx] = (ADA_RHO * mW[idx]) + ((1.0 - ADA_RHO) * dW[idx] * dW[idx])
         W[idx] -= learn_rate * (dW[idx] / (sqrt(mW[idx]) + ADA_EPS))
         dW[idx] = 0.0
     return
@@ -167,48 +222,148 @@ def lut_sp(sp_idx, row_idx, dLdY, dW):
 
     This adds each row of dLdY to some row of dW. The row of dW to adjust
     is given by the corresponding item in row_idx."""
-    threadstate = savethread()
     row_count = sp_idx.shape[0]
     vec_dim = dW.shape[1]
-    for i in range(row_count):
-        idx = row_idx[sp_idx[i]]
+    for spi in range(row_count):
+        i = sp_idx[spi]
+        idx = row_idx[i]
         for j in range(vec_dim):
             dW[idx,j] += dLdY[i,j]
-    restorethread(threadstate)
     return
-fn_sig_5 = void(i4[:], i4[:], f4[:,:], f4[:,:])
-lut_st = jit(fn_sig_5, nopython=True)(lut_sp)
-lut_bp = make_multithread(lut_st, THREAD_NUM)
+fn_sig_5 = void(i4[:], u4[:], f4[:,:], f4[:,:])
+lut_st = jit(fn_sig_5, nopython=True, nogil=True, cache=True)(lut_sp)
+lut_bp = make_multithread(lut_st, scatter=((0, (), (2,)),), sort_rows=True)
+
 
+def hsm_ff_bp_sp(sp_idx, X, code_offsets, code_keys, code_signs, W, b, \
+                 dLdX, dLdW, dLdb, L, do_grad, lt, lt_max, lt_inv):
+    """Feedforward and backprop for HSMLayer, with codes in CSR form.
 
-def hsm_ff_bp_sp(sp_idx, X, code_keys, code_signs, W, b, dLdX, dLdW, dLdb, L):
-    threadstate = savethread()
+    The codes for row i of X are in code_keys[code_offsets[i]:code_offsets[i+1]]
+    (and similarly for code_signs). The loss for each code goes into the
+    matching entry of L. The logistic table lt is used as in w2v_ff_bp_sp.
+    """
     obs_count = sp_idx.shape[0]
-    code_len = code_keys.shape[1]
-    vec_dim = X.shape[1]
+    use_table = (lt.shape[0] > 0)
     for spi in range(obs_count):
         i = sp_idx[spi]
-        for j in range(code_len):
-            code_key = code_keys[i,j]
-            if code_key < 1234567:
-                y = b[code_key]
-                # for speed, this needs to change to sdot via BLAS
-                for k in range(vec_dim):
-                    y += X[i,k] * W[code_key,k]
-                neg_label = -1.0 * code_signs[i,j]
+        for c_i in range(code_offsets[i], code_offsets[i+1]):
+            code_key = code_keys[c_i]
+            y = b[code_key] + row_dot(X[i], W[code_key])
+            neg_label = -1.0 * code_signs[c_i]
+            if use_table:
+                sp_z, sg_z = table_logistic(neg_label * y, lt, lt_max, lt_inv)
+            else:
                 exp_y = exp(neg_label * y)
-                L[i,j] = log(1.0 + exp_y)
-                g = neg_label * (exp_y / (1.0 + exp_y))
+                sp_z = log(1.0 + exp_y)
+                sg_z = exp_y / (1.0 + exp_y)
+            L[c_i] = sp_z
+            if (do_grad == 1):
+                g = neg_label * sg_z
                 dLdb[code_key] += g
-                # for speed, this needs to change to saxpy via BLAS
-                for k in range(vec_dim):
-                    dLdX[i,k] += g * W[code_key,k]
-                    dLdW[code_key,k] += g * X[i,k]
-    restorethread(threadstate)
+                row_axpy(g, W[code_key], dLdX[i])
+                row_axpy(g, X[i], dLdW[code_key])
     return
-fn_sig_6 = void(i4[:], f4[:,:], u4[:,:], f4[:,:], f4[:,:], f4[:], f4[:,:], f4[:,:], f4[:], f4[:,:])
-hsm_ff_bp_st = jit(fn_sig_6, nopython=True)(hsm_ff_bp_sp)
-hsm_ff_bp = make_multithread(hsm_ff_bp_st, THREAD_NUM)
+fn_sig_6 = void(i4[:], f4[:,::1], i8[:], u4[:], f4[:], f4[:,::1], f4[:], f4[:,::1], f4[:,::1], f4[:], f4[:], i4, f4[::1], f4, f4)
+hsm_ff_bp_st = jit(fn_sig_6, nopython=True, nogil=True, cache=True)(hsm_ff_bp_sp)
+hsm_ff_bp_mt = make_multithread(hsm_ff_bp_st, scatter=((2, (4, 5), (7, 8)),))
+
+def hsm_ff_bp(X, code_offsets, code_keys, code_signs, W, b, dLdX, dLdW, \
+              dLdb, L, do_grad):
+    """Run hsm_ff_bp_sp (multithreaded), with the current logistic table."""
+    lt, lt_max, lt_inv = get_logistic_table()
+    return hsm_ff_bp_mt(X, code_offsets, code_keys, code_signs, W, b, dLdX, \
+                        dLdW, dLdb, L, do_grad, lt, lt_max, lt_inv)
+
+####################################
+# PARITY AND THROUGHPUT VS. CYTHON #
+####################################
+
+def _make_problem(obs_count, vec_dim, key_count=50000, pn_size=10, seed=1):
+    """Make random inputs shared by the Numba and Cython kernels."""
+    rs = npr.RandomState(seed)
+    prob = {}
+    prob['X'] = (0.1 * rs.randn(obs_count, vec_dim)).astype(np.float32)
+    prob['W'] = (0.1 * rs.randn(key_count, vec_dim)).astype(np.float32)
+    prob['Wc'] = (0.1 * rs.randn(key_count, vec_dim)).astype(np.float32)
+    prob['b'] = (0.1 * rs.randn(key_count)).astype(np.float32)
+    prob['anc_keys'] = rs.randint(0, key_count, (obs_count,)).astype(np.uint32)
+    prob['pn_keys'] = rs.randint(0, key_count, (obs_count, pn_size)).astype(np.uint32)
+    prob['pn_sign'] = -1.0 * np.ones((obs_count, pn_size), dtype=np.float32)
+    prob['pn_sign'][:,0] = 1.0
+    offsets = np.concatenate(([0], np.cumsum(rs.randint(1, 20, obs_count))))
+    prob['code_offsets'] = offsets.astype(np.int64)
+    prob['code_keys'] = rs.randint(0, key_count, (offsets[-1],)).astype(np.uint32)
+    prob['code_signs'] = np.sign(rs.randn(offsets[-1])).astype(np.float32)
+    return prob
+
+def _run_kernel(kf, name, p):
+    """Run the named kernel from the module kf (NumbaFuncs or CythonFuncs)
+    on problem p, and return the outputs."""
+    dX = np.zeros_like(p['X'])
+    dW = np.zeros_like(p['W'])
+    db = np.zeros_like(p['b'])
+    if name == 'w2v_ff_bp':
+        dWc = np.zeros_like(p['Wc'])
+        L = np.zeros((1,), dtype=np.float32)
+        kf.w2v_ff_bp(p['anc_keys'], p['pn_keys'], p['pn_sign'], p['W'], \
+                     p['Wc'], p['b'], dW, dWc, db, L, 1)
+        return [dW, dWc, db, L]
+    if name == 'nsl_ff_bp':
+        L = np.zeros(p['pn_keys'].shape, dtype=np.float32)
+        kf.nsl_ff_bp(p['pn_keys'], p['pn_sign'], p['X'], p['W'], p['b'], \
+                     dX, dW, db, L, 1)
+        return [dX, dW, db, L]
+    L = np.zeros(p['code_keys'].shape, dtype=np.float32)
+    kf.hsm_ff_bp(p['X'], p['code_offsets'], p['code_keys'], p['code_signs'], \
+                 p['W'], p['b'], dX, dW, db, L, 1)
+    return [dX, dW, db, L]
+
+KERNEL_NAMES = ['w2v_ff_bp', 'nsl_ff_bp', 'hsm_ff_bp']
+
+def check_cython_parity(vec_dims=(50, 128, 300), obs_count=500, rtol=1e-4):
+    """Check that the Numba kernels match the Cython kernels."""
+    import CythonFuncs as cf
+    nb = sys.modules[__name__]
+    max_err = 0.0
+    for vec_dim in vec_dims:
+        p = _make_problem(obs_count, vec_dim)
+        for name in KERNEL_NAMES:
+            nb_out = _run_kernel(nb, name, p)
+            cy_out = _run_kernel(cf, name, p)
+            for nb_x, cy_x in zip(nb_out, cy_out):
+                err = np.max(np.abs(nb_x - cy_x)) / (np.max(np.abs(cy_x)) + 1e-8)
+                max_err = max(max_err, err)
+                assert (err < rtol), "{0:s} mismatch, dim={1:d}, err={2:.2e}".format( \
+                        name, vec_dim, err)
+    print("Numba/Cython parity OK, max relative error: {0:.2e}".format(max_err))
+    return max_err
+
+def run_dim_bench(vec_dims=(50, 100, 200, 500, 1000), obs_count=2000, \
+                  min_secs=0.5):
+    """Compare Numba and Cython kernel throughput, in examples/sec."""
+    from KernelPool import _time_calls
+    nb = sys.modules[__name__]
+    try:
+        import CythonFuncs as cf
+    except ImportError:
+        cf = None
+    results = []
+    print("kernel       dim   numba ex/s   cython ex/s")
+    for name in KERNEL_NAMES:
+        for vec_dim in vec_dims:
+            p = _make_problem(obs_count, vec_dim)
+            t_nb = _time_calls(lambda: _run_kernel(nb, name, p), min_secs)
+            t_cy = np.nan if cf is None else \
+                   _time_calls(lambda: _run_kernel(cf, name, p), min_secs)
+            results.append((name, vec_dim, obs_count / t_nb, obs_count / t_cy))
+            print("{0:s} {1:6d} {2:12.0f} {3:13.0f}".format(name.ljust(9), \
+                  vec_dim, obs_count / t_nb, obs_count / t_cy))
+    return results
+
+if __name__ == '__main__':
+    check_cython_parity()
+    run_dim_bench()
 
 ##############
 # EYE BUFFER #
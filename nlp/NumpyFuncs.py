@@ -0,0 +1,88 @@
+from __future__ import absolute_import
+
+import numpy as np
+
+from LogisticTables import get_logistic_table, table_logistic
+
+# these match the constants in CythonFuncsPyx.pyx, so that the functions here
+# are drop-in replacements for the ones in CythonFuncs (see KernelBackends)
+ADA_EPS = 0.001
+ADA_RHO = 0.98
+MAX_HSM_KEY = 12345678
+
+######################################
+# PURE NUMPY VERSIONS OF THE KERNELS #
+######################################
+
+# These are slow, but need no compiler. Scattered updates to rows that may be
+# repeated within a batch go through np.add.at, which handles repeats.
+
+def _logistic_ff_bp(y, sign):
+    """Get the loss and the gradient w.r.t. y of log(1 + exp(-sign * y)).
+
+    This uses the current logistic table, if one is set.
+    """
+    neg_label = -1.0 * sign
+    table, z_max, inv_step = get_logistic_table()
+    if (table.size > 0):
+        L, sig = table_logistic((neg_label * y), table, z_max, inv_step)
+        return [L, (neg_label * sig).astype(np.float32)]
+    exp_pns_y = np.exp(neg_label * y)
+    L = np.log(1.0 + exp_pns_y)
+    g = neg_label * (exp_pns_y / (1.0 + exp_pns_y))
+    return [L.astype(np.float32), g.astype(np.float32)]
+
+def w2v_ff_bp(anc_keys, pn_keys, pn_sign, Wa, Wc, b, dWa, dWc, db, L, do_grad):
+    """Feedforward and backprop for unified (neg-sample) word-2-vec layer."""
+    A = Wa[anc_keys]
+    C = Wc[pn_keys]
+    y = np.einsum('ik,ijk->ij', A, C) + b[pn_keys]
+    L_pn, g = _logistic_ff_bp(y, pn_sign)
+    L[0] += np.sum(L_pn)
+    if (do_grad == 1):
+        np.add.at(db, pn_keys, g)
+        np.add.at(dWa, anc_keys, np.einsum('ij,ijk->ik', g, C))
+        np.add.at(dWc, pn_keys, g[:,:,np.newaxis] * A[:,np.newaxis,:])
+    return 1
+
+def nsl_ff_bp(pn_keys, pn_sign, X, W, b, dX, dW, db, L, do_grad):
+    """Feedforward and backprop for NSLayer. Keys >= MAX_HSM_KEY are skipped."""
+    obs_idx, pn_idx = np.nonzero(pn_keys < MAX_HSM_KEY)
+    keys = pn_keys[obs_idx, pn_idx]
+    y = np.sum(X[obs_idx] * W[keys], axis=1) + b[keys]
+    L_pn, g = _logistic_ff_bp(y, pn_sign[obs_idx, pn_idx])
+    L[obs_idx, pn_idx] = L_pn
+    if (do_grad == 1):
+        np.add.at(db, keys, g)
+        np.add.at(dW, keys, g[:,np.newaxis] * X[obs_idx])
+        np.add.at(dX, obs_idx, g[:,np.newaxis] * W[keys])
+    return 1
+
+def hsm_ff_bp(X, code_offsets, code_keys, code_signs, W, b, dX, dW, db, L, do_grad):
+    """Feedforward and backprop for HSMLayer, with codes in CSR form."""
+    obs_idx = np.repeat(np.arange(X.shape[0]), np.diff(code_offsets))
+    y = np.sum(X[obs_idx] * W[code_keys], axis=1) + b[code_keys]
+    L_code, g = _logistic_ff_bp(y, code_signs)
+    L[:] = L_code
+    if (do_grad == 1):
+        np.add.at(db, code_keys, g)
+        np.add.at(dW, code_keys, g[:,np.newaxis] * X[obs_idx])
+        np.add.at(dX, obs_idx, g[:,np.newaxis] * W[code_keys])
+    return 1
+
+def lut_bp(row_idx, dLdY, dW):
+    """Add each row of dLdY to the row of dW given by row_idx."""
+    np.add.at(dW, row_idx, dLdY)
+    return 1
+
+def ag_update_2d(row_idx, W, dW, mW, learn_rate):
+    """Element-wise partial update ala adagrad, for the (unique) rows in
+    row_idx. Then sets the grads for those rows back to 0."""
+    dW_rows = dW[row_idx]
+    mW_rows = (ADA_RHO * mW[row_idx]) + ((1.0 - ADA_RHO) * dW_rows * dW_rows)
+    mW[row_idx] = mW_rows
+    W[row_idx] -= learn_rate * (dW_rows / (np.sqrt(mW_rows) + ADA_EPS))
+    dW[row_idx] = 0.0
+    return 1
+
+ag_update_1d = ag_update_2d
@@ -0,0 +1,297 @@
+from __future__ import absolute_import
+
+import numpy as np
+import numba
+from math import sqrt
+from numba import jit, void, i4, f4, u4
+
+from KernelPool import make_multithread
+from HalfStorage import HALF_SPECS
+
+# these match the constants in CythonFuncsPyx.pyx and NumbaFuncs.py
+ADA_EPS = 0.001
+ADA_RHO = 0.98
+
+###################################
+# PACKED (ROW-SPARSE) GRAD STORES #
+###################################
+
+# By default, each layer in NLMLayers keeps a dense float32 grad table per
+# param, as big as the param table, though a batch only touches a few rows.
+# A PackedGrads store instead keeps grads for just the rows touched since the
+# last update: a slot map giving each row's slot (or -1 for no slot), a list
+# of the rows in slot order, and a packed (slots, ...) grad buffer for each
+# param that shares those rows. The buffers grow by doubling, as needed.
+#
+# The ff/bp kernels run unchanged (see run_packed_kernel()). For each call,
+# the keys get remapped to batch slots, the params for the batch rows are
+# gathered into compact float32 tables (as for HalfTables), and the kernel
+# writes its grads into compact buffers. When the store is empty, which is
+# the usual case with updates after each batch, those buffers are the front
+# of the packed buffers, so the batch grads need no copy. Otherwise, they are
+# added into the store. packed_ag_update_2d/1d then read the packed grads
+# directly, while updating the rows of the full param and mom tables.
+#
+# Buffer slots at or past the row count are always 0, like the rows of dense
+# grads that aren't pending.
+
+MIN_SLOTS = 1024
+
+# Kernel specs for run_packed_kernel(), i.e. (key_arg, param_args, grad_args)
+# for each set of keys, as in HalfStorage, plus lut_bp(keys, dLdY, dW).
+PACKED_SPECS = dict(HALF_SPECS)
+PACKED_SPECS['lut_bp'] = ((0, (), (2,)),)
+
+@numba.jit("i8(u4[:], i4[:], u4[:], u4[:])", nopython=True, nogil=True, \
+           cache=True)
+def fast_batch_slots(keys, batch_map, batch_rows, slot_keys):
+    """Remap keys to slots for the distinct rows in keys.
+
+    Rows get slots in the order they're first seen, and go in batch_rows.
+    Keys >= batch_map.size (e.g. padding keys) pass through unchanged. The
+    batch_map entries are left at -1. Returns the number of rows.
+    """
+    max_key = batch_map.shape[0]
+    row_count = 0
+    for i in range(keys.shape[0]):
+        key = keys[i]
+        if key < max_key:
+            slot = batch_map[key]
+            if slot < 0:
+                slot = row_count
+                batch_map[key] = slot
+                batch_rows[row_count] = key
+                row_count += 1
+            slot_keys[i] = slot
+        else:
+            slot_keys[i] = key
+    for i in range(row_count):
+        batch_map[batch_rows[i]] = -1
+    return row_count
+
+@numba.jit("i8(u4[:], i4[:], u4[:], i8, u4[:])", nopython=True, nogil=True, \
+           cache=True)
+def fast_assign_slots(rows, slot_map, row_list, row_count, slots):
+    """Get the slot for each of rows, giving new rows the next free slots.
+
+    Returns the new number of rows in row_list.
+    """
+    for i in range(rows.shape[0]):
+        row = rows[i]
+        if slot_map[row] < 0:
+            slot_map[row] = row_count
+            row_list[row_count] = row
+            row_count += 1
+        slots[i] = slot_map[row]
+    return row_count
+
+@numba.jit("void(u4[:], i4[:])", nopython=True, nogil=True, cache=True)
+def fast_clear_slots(row_list, slot_map):
+    """Free the slots of the rows in row_list."""
+    for i in range(row_list.shape[0]):
+        slot_map[row_list[i]] = -1
+    return
+
+def packed_ag_update_2d_sp(sp_idx, row_idx, W, dW, mW, learn_rate):
+    """Element-wise partial update ala adagrad, from packed grads.
+
+    As ag_update_2d, but the grads for row row_idx[s] are in dW[s], i.e. dW
+    has a row per entry in row_idx. The used rows of dW are set back to 0.
+    """
+    row_count = sp_idx.shape[0]
+    vec_dim = W.shape[1]
+    for spi in range(row_count):
+        s = sp_idx[spi]
+        idx = row_idx[s]
+        for j in range(vec_dim):
+            mW[idx,j] = (ADA_RHO * mW[idx,j]) + ((1.0 - ADA_RHO) * dW[s,j] * dW[s,j])
+            W[idx,j] -= (learn_rate * (dW[s,j] / (sqrt(mW[idx,j]) + ADA_EPS)))
+            dW[s,j] = 0.0
+    return
+fn_sig_pk = void(i4[:], u4[:], f4[:,:], f4[:,:], f4[:,:], f4)
+packed_ag_update_2d_st = jit(fn_sig_pk, nopython=True, nogil=True, \
+                             cache=True)(packed_ag_update_2d_sp)
+packed_ag_update_2d = make_multithread(packed_ag_update_2d_st)
+
+@numba.jit("void(u4[:], f4[:], f4[:], f4[:], f4)", nopython=True, nogil=True, \
+           cache=True)
+def packed_ag_update_1d(row_idx, W, dW, mW, learn_rate):
+    """Element-wise partial update ala adagrad, from packed grads.
+
+    As ag_update_1d, but the grad for row row_idx[s] is in dW[s].
+    """
+    for s in range(row_idx.shape[0]):
+        idx = row_idx[s]
+        mW[idx] = (ADA_RHO * mW[idx]) + ((1.0 - ADA_RHO) * dW[s] * dW[s])
+        W[idx] -= learn_rate * (dW[s] / (sqrt(mW[idx]) + ADA_EPS))
+        dW[s] = 0.0
+    return
+
+class PackedGrads:
+    """Grads for the touched rows of one or more tables with shared keys.
+
+    row_shapes is a list of (name, row_shape) for the tables, e.g. for the
+    W and b of an NSLayer: [('W', (in_dim,)), ('b', ())]. rows() gives the
+    rows with grads, in slot order, and grads(name) gives their grads.
+    """
+    def __init__(self, row_count, row_shapes):
+        self.names = [name for (name, shape) in row_shapes]
+        self.row_shapes = dict(row_shapes)
+        self.slot_map = np.zeros((row_count,), dtype=np.int32) - 1
+        self.batch_map = np.zeros((row_count,), dtype=np.int32) - 1
+        self.row_list = np.zeros((row_count,), dtype=np.uint32)
+        self.row_count = 0
+        self.bufs = {}
+        self._alloc(min(row_count, MIN_SLOTS))
+        return
+
+    def __len__(self):
+        return self.row_count
+
+    @property
+    def nbytes(self):
+        buf_bytes = sum(self.bufs[name].nbytes for name in self.names)
+        return (buf_bytes + self.slot_map.nbytes + self.batch_map.nbytes + \
+                self.row_list.nbytes)
+
+    def _alloc(self, slot_count):
+        """Grow the grad buffers to hold slot_count rows."""
+        for name in self.names:
+            buf = np.zeros(((slot_count,) + self.row_shapes[name]), \
+                           dtype=np.float32)
+            if name in self.bufs:
+                buf[0:self.row_count] = self.bufs[name][0:self.row_count]
+            self.bufs[name] = buf
+        return
+
+    def _reserve(self, slot_count):
+        """Make sure the grad buffers hold at least slot_count rows."""
+        cur_count = self.bufs[self.names[0]].shape[0]
+        if slot_count > cur_count:
+            new_count = max(slot_count, (2 * cur_count))
+            self._alloc(min(new_count, self.slot_map.size))
+        return
+
+    def rows(self):
+        """Get the rows with grads, as a uint32 array (a view, not a copy)."""
+        return self.row_list[0:self.row_count]
+
+    def grads(self, name):
+        """Get the packed grads for table name (a view, not a copy)."""
+        return self.bufs[name][0:self.row_count]
+
+    def batch_slots(self, keys):
+        """Get (slot_keys, batch_rows) for remapping keys to batch slots.
+
+        slot_keys has the shape of keys, and batch_rows holds the distinct
+        rows in keys, by slot. Keys past the end of the table pass through.
+        """
+        flat_keys = np.ascontiguousarray(keys, dtype=np.uint32).ravel()
+        slot_keys = np.zeros(flat_keys.shape, dtype=np.uint32)
+        batch_rows = np.zeros((min(flat_keys.size, self.slot_map.size),), \
+                              dtype=np.uint32)
+        row_count = fast_batch_slots(flat_keys, self.batch_map, batch_rows, \
+                                     slot_keys)
+        return [slot_keys.reshape(keys.shape), batch_rows[0:row_count]]
+
+    def batch_grads(self, batch_rows):
+        """Get zeroed grad buffers to use for a batch, in order of names.
+
+        If the store is empty, these are views into the packed buffers, and
+        add_batch() just takes the batch slots as its own.
+        """
+        row_count = batch_rows.size
+        if self.row_count == 0:
+            self._reserve(row_count)
+            return [self.bufs[name][0:row_count] for name in self.names]
+        return [np.zeros(((row_count,) + self.row_shapes[name]), \
+                         dtype=np.float32) for name in self.names]
+
+    def add_batch(self, batch_rows, batch_grads):
+        """Add grads from batch_grads() for the rows in batch_rows."""
+        if self.row_count == 0:
+            self.slot_map[batch_rows] = np.arange(batch_rows.size, \
+                                                  dtype=np.int32)
+            self.row_list[0:batch_rows.size] = batch_rows
+            self.row_count = batch_rows.size
+            return
+        self._reserve(self.row_count + batch_rows.size)
+        slots = np.zeros(batch_rows.shape, dtype=np.uint32)
+        self.row_count = fast_assign_slots(batch_rows, self.slot_map, \
+                                           self.row_list, self.row_count, \
+                                           slots)
+        for (name, G) in zip(self.names, batch_grads):
+            self.bufs[name][slots] += G
+        return
+
+    def ag_update(self, name, W, mW, learn_rate):
+        """Apply the grads for table name to W, with adagrad moms mW.
+
+        This zeros the used grads, but leaves the rows in the store (see
+        clear()). W and mW can be float32 arrays or HalfTables.
+        """
+        if self.row_count == 0:
+            return
+        rows = self.rows()
+        dW = self.grads(name)
+        kernel = packed_ag_update_2d if (dW.ndim == 2) else \
+                 packed_ag_update_1d
+        if isinstance(W, np.ndarray) and isinstance(mW, np.ndarray):
+            kernel(rows, W, dW, mW, np.float32(learn_rate))
+        else:
+            W_rows = np.ascontiguousarray(W[rows])
+            mW_rows = np.ascontiguousarray(mW[rows])
+            slot_idx = np.arange(rows.size, dtype=np.uint32)
+            kernel(slot_idx, W_rows, dW, mW_rows, np.float32(learn_rate))
+            W[rows] = W_rows
+            mW[rows] = mW_rows
+        return
+
+    def clear(self):
+        """Free all slots. The grads should already be 0 (see ag_update())."""
+        fast_clear_slots(self.rows(), self.slot_map)
+        self.row_count = 0
+        return
+
+    def reset(self, rows=None):
+        """Set the grads to 0 for the given rows, or free all slots if None."""
+        if rows is None:
+            for name in self.names:
+                self.grads(name).fill(0.0)
+            self.clear()
+        else:
+            slots = self.slot_map[np.asarray(rows, dtype=np.uint32)]
+            slots = slots[slots >= 0]
+            for name in self.names:
+                self.bufs[name][slots] = 0.0
+        return
+
+def _gather_rows(W, rows):
+    """Get float32 copies of the given rows of W (an array or HalfTable)."""
+    return np.ascontiguousarray(W[rows], dtype=np.float32)
+
+def run_packed_kernel(kernel_name, kernel, args, stores, do_grad=True):
+    """Run an ff/bp kernel (or lut_bp) with its grads going to stores.
+
+    args are the kernel args, with anything (e.g. None) for the grad tables.
+    stores[i] takes the grads for the i-th set of keys in the kernel's spec
+    in PACKED_SPECS, and its names should be in the order of the grad args.
+    With do_grad False, the stores are left alone.
+    """
+    args = list(args)
+    batches = []
+    spec = PACKED_SPECS[kernel_name]
+    for ((key_arg, param_args, grad_args), store) in zip(spec, stores):
+        slot_keys, batch_rows = store.batch_slots(args[key_arg])
+        args[key_arg] = slot_keys
+        for p_arg in param_args:
+            args[p_arg] = _gather_rows(args[p_arg], batch_rows)
+        batch_grads = store.batch_grads(batch_rows)
+        for (g_arg, G) in zip(grad_args, batch_grads):
+            args[g_arg] = G
+        batches.append((store, batch_rows, batch_grads))
+    result = kernel(*args)
+    if do_grad:
+        for (store, batch_rows, batch_grads) in batches:
+            store.add_batch(batch_rows, batch_grads)
+    return result
@@ -91,6 +91,12 @@ def smart_open(fname, mode='rb'):
     if ext == '.gz':
         from gzip import GzipFile
         return make_closing(GzipFile)(fname, mode)
+    if ext == '.xz':
+        try:
+            import lzma
+        except ImportError:
+            from backports import lzma
+        return lzma.open(fname, mode)
     return open(fname, mode)
 
 
@@ -20,7 +20,8 @@ except ImportError:
     from Queue import Queue
 
 from numpy import exp, dot, zeros, outer, random, get_include, float32 as REAL, int64, prod, dtype as np_dtype, \
-    uint32, seterr, array, uint8, vstack, argsort, fromstring, sqrt, newaxis, empty, sum as np_sum
+    uint32, seterr, array, uint8, vstack, argsort, fromstring, sqrt, newaxis, empty, sum as np_sum, \
+    float64, arange, cumsum, rint, diff, concatenate, repeat, ndarray
 
 logger = logging.getLogger("W2VSimple")
 
@@ -154,25 +155,20 @@ class W2VSimple():
         logger.info("constructing a table with noise distribution from %i words" % len(self.vocab))
         # table (= list of words) of noise distribution for negative sampling
         vocab_size = len(self.index2word)
-        self.table = zeros(table_size, dtype=uint32)
-
         if not vocab_size:
             logger.warning("empty vocabulary in word2vec, is this intended?")
+            self.table = zeros(table_size, dtype=uint32)
             return
 
-        # compute sum of all power (Z in paper)
-        train_words_pow = float(sum([self.vocab[word].count**power for word in self.vocab]))
-        # go through the whole table and fill it up with the word indexes proportional to a word's count**power
-        widx = 0
-        # normalize count^0.75 by Z
-        d1 = self.vocab[self.index2word[widx]].count**power / train_words_pow
-        for tidx in xrange(table_size):
-            self.table[tidx] = widx
-            if 1.0 * tidx / table_size > d1:
-                widx += 1
-                d1 += self.vocab[self.index2word[widx]].count**power / train_words_pow
-            if widx >= vocab_size:
-                widx = vocab_size - 1
+        # compute the cumulative noise distribution over word indexes (i.e.
+        # count**power normalized by Z), then give each word a run of table
+        # slots proportional to its count**power, filled in one vectorized pass
+        counts = array([self.vocab[word].count for word in self.index2word], dtype=float64)
+        cum_probs = cumsum(counts**power)
+        bounds = rint(table_size * (cum_probs / cum_probs[-1])).astype(int64)
+        bounds[-1] = table_size
+        run_lens = diff(concatenate(([0], bounds)))
+        self.table = repeat(arange(vocab_size, dtype=uint32), run_lens)
         return
 
     def create_binary_tree(self):
@@ -263,7 +259,9 @@ class W2VSimple():
     def train(self, sentences, total_words=None, word_count=0, chunksize=100):
         """
         Update the model's neural weights from a sequence of sentences (can be a once-only generator stream).
-        Each sentence must be a list of unicode strings.
+        Each sentence must be a list of unicode strings, or an array of word indices (i.e. indices into
+        self.index2word), such as CorpusUtils.SentenceFileIterator yields given
+        words_to_keys={word: vocab.index} and unk_word=None.
 
         """
         if FAST_VERSION < 0:
@@ -312,11 +310,17 @@ class W2VSimple():
             thread.daemon = True  # make interrupting the process with ctrl+c easier
             thread.start()
 
+        index2vocab = [self.vocab[word] for word in self.index2word]
         def prepare_sentences():
             for sentence in sentences:
+                if isinstance(sentence, ndarray):
+                    # sentence is pre-encoded as indices into self.index2word
+                    words = [index2vocab[idx] for idx in sentence]
+                else:
+                    words = [self.vocab[word] for word in sentence if word in self.vocab]
                 # avoid calling random_sample() where prob >= 1, to speed things up a little:
-                sampled = [self.vocab[word] for word in sentence
-                    if word in self.vocab and (self.vocab[word].sample_probability >= 1.0 or self.vocab[word].sample_probability >= random.random_sample())]
+                sampled = [v for v in words
+                    if (v.sample_probability >= 1.0 or v.sample_probability >= random.random_sample())]
                 yield sampled
 
         # convert input strings to Vocab objects (eliding OOV/downsampled words), and start filling the jobs queue
@@ -395,11 +399,33 @@ class LineSentence(object):
             # Assume it is a file-like object and try treating it as such
             # Things that don't have seek will trigger an exception
             self.source.seek(0)
-            for line in self.source:
-                yield gs_utils.to_unicode(line).split()
+            for line in self._iter_lines(self.source):
+                yield line.split()
         except AttributeError:
             # If it didn't work like a file, use it as a string filename
             with gs_utils.smart_open(self.source) as fin:
-                for line in fin:
-                    yield gs_utils.to_unicode(line).split()
+                for line in self._iter_lines(fin):
+                    yield line.split()
+
+    def _iter_lines(self, fin, block_size=(1 << 22)):
+        """Read fin in large blocks, decoding each block of whole lines at once."""
+        tail = None
+        while True:
+            block = fin.read(block_size)
+            if not block:
+                break
+            if tail is None:
+                # files opened in text mode give str blocks, not bytes
+                tail = block[:0]
+                newline = b'\n' if isinstance(block, bytes) else u'\n'
+            block = tail + block
+            cut = block.rfind(newline)
+            if cut < 0:
+                tail = block
+                continue
+            tail = block[(cut+1):]
+            for line in gs_utils.to_unicode(block[:cut]).split(u'\n'):
+                yield line
+        if tail:
+            yield gs_utils.to_unicode(tail)
 